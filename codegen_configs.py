@@ -26,10 +26,10 @@ from codegen_helpers import CXXClass, CXXFunction
 PVFMM_HEADERS = ["pvfmm.hpp", ]
 PYBIND11_HEADERS = ["pybind11/pybind11.h", "pybind11/numpy.h"]
 
-PVFMM_SUBMODULES = ["kernel", "precomp_mat", "cheb_utils"]
+PVFMM_SUBMODULES = ["kernel", "precomp_mat", "cheb_utils", "fmm"]
 
 # the list ordering matters
-PVFMM_NUMPY_WRAPPERS = ["kernel", "cheb_utils"]
+PVFMM_NUMPY_WRAPPERS = ["utils", "kernel", "cheb_utils", "fmm"]
 
 PVFMM_CLASSES = []
 PVFMM_FUNCTIONS = []
@@ -45,6 +45,123 @@ def register_function(cxxfunc):
     PVFMM_FUNCTIONS.append(cxxfunc)
 
 
+# {{{ mod: kernel
+
+homogeneity_doc = """Returns the homogeneity degree d of the kernel, such that
+K(a x) = a^d K(x) for all a > 0, or None if the kernel is not homogeneous.
+
+:param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`
+""".replace('\n', '\\n')
+
+func_homogeneity = CXXFunction(function_name='homogeneity',
+                               in_module='kernel',
+                               namespace_prefix='pypvfmm::',
+                               docstring=homogeneity_doc,
+                               arg_names=['kernel'],
+                               )
+register_function(func_homogeneity)
+
+kernel_handle_doc = """An initialized kernel, shared by all the functions taking a
+kernel. Obtained from get_kernel_handle, which creates it once per kernel and
+dtype.""".replace('\n', '\\n')
+
+get_kernel_handle_doc = """Returns the (cached) handle of the kernel, which is
+initialized on first use.
+
+:param kernel: str, kernel information, see :mod:`pypvfmm.kernel`
+""".replace('\n', '\\n')
+
+register_kernel_doc = """Registers a compiled kernel function under the descriptor
+name, and returns its handle. The function has the signature
+void (const T* r_src, int src_cnt, const T* v_src, int dof,
+const T* r_trg, int trg_cnt, T* v_trg), and adds the potentials to v_trg.
+
+:param name: str, kernel descriptor of the new kernel
+:param function: int (function address) or PyCapsule
+:param src_dim: int, number of density components
+:param trg_dim: int, number of potential components
+:param homogeneity: int or None, homogeneity degree of the kernel
+""".replace('\n', '\\n')
+
+
+def wrap_kernel_handle(number_type):
+    class_kernel_handle = CXXClass(class_name="KernelHandle",
+                                   namespace_prefix="pypvfmm::",
+                                   template_args=[number_type, ],
+                                   type_str="_%s" % number_type,
+                                   in_module="kernel",
+                                   is_dynamic=False,
+                                   holder_type="std::shared_ptr")
+    class_kernel_handle.add_property(name="desc",
+                                     docstring="Kernel descriptor.")
+    class_kernel_handle.add_property(
+        name="homogeneity",
+        docstring="Homogeneity degree of the kernel, or None.")
+    class_kernel_handle.add_property(
+        name="src_dim", docstring="Number of density components.")
+    class_kernel_handle.add_property(
+        name="trg_dim", docstring="Number of potential components.")
+    register_class(class_kernel_handle)
+
+    func_get_kernel_handle = CXXFunction(function_name='get_kernel_handle',
+                                         in_module='kernel',
+                                         namespace_prefix='pypvfmm::',
+                                         docstring=get_kernel_handle_doc,
+                                         template_args=["%s" % number_type, ],
+                                         type_str='_%s' % number_type,
+                                         arg_names=['kernel'],
+                                         )
+    register_function(func_get_kernel_handle)
+
+    func_register_kernel = CXXFunction(function_name='register_kernel',
+                                       in_module='kernel',
+                                       namespace_prefix='pypvfmm::',
+                                       docstring=register_kernel_doc,
+                                       template_args=["%s" % number_type, ],
+                                       type_str='_%s' % number_type,
+                                       arg_names=['name', 'function', 'src_dim',
+                                                  'trg_dim', 'homogeneity'],
+                                       arg_default_vals={
+                                           'homogeneity': 'pybind11::none()'},
+                                       )
+    register_function(func_register_kernel)
+
+
+wrap_kernel_handle('double')
+wrap_kernel_handle('float')
+
+evaluate_doc = """Direct evaluation of the kernel sums at the targets, using pvfmm's
+vectorized kernel functions, multithreaded over tiles of targets.
+
+:param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`
+:param sources: numpy.array of shape (n_src, 3), source points
+:param densities: numpy.array of shape (n_src, src_dim), source densities
+:param targets: numpy.array of shape (n_trg, 3), target points
+:param out: numpy.array, optional C-contiguous array to store the result in
+
+:return: numpy.array of shape (n_trg, trg_dim), the potentials
+""".replace('\n', '\\n')
+
+
+def wrap_evaluate(number_type):
+    func_evaluate = CXXFunction(function_name='evaluate',
+                                in_module='kernel',
+                                namespace_prefix='pypvfmm::',
+                                docstring=evaluate_doc,
+                                template_args=["%s" % number_type, ],
+                                type_str='_%s' % number_type,
+                                arg_names=['kernel', 'sources', 'densities',
+                                           'targets', 'out'],
+                                arg_default_vals={'out': 'pybind11::none()'},
+                                )
+    register_function(func_evaluate)
+
+
+wrap_evaluate('double')
+wrap_evaluate('float')
+
+# }}} End mod: kernel
+
 # {{{ mod: precomp_mat
 
 class_precomp_mat = CXXClass(class_name="PrecompMat",
@@ -88,6 +205,127 @@ wrap_cheb_poly('double')
 wrap_cheb_poly('float')
 
 
+# cheb_poly_nd
+cheb_poly_nd_doc = '\\n'.join([
+    "Returns the values of all chebyshev polynomials up to degree d,",
+    "evaluated at every entry of the input array, which may have any shape",
+    "and strides. The result has shape (d+1, *in.shape) and is stored into",
+    "out if given. Like cheb_poly, points outside [-1, 1] give zeros.",
+    ])
+
+
+def wrap_cheb_poly_nd(number_type):
+    func_cheb_poly_nd = CXXFunction(function_name='cheb_poly_nd',
+                                    in_module='cheb_utils',
+                                    namespace_prefix='pypvfmm::',
+                                    docstring=cheb_poly_nd_doc,
+                                    template_args=["%s" % number_type, ],
+                                    type_str='_%s' % number_type,
+                                    arg_names=['d', 'in', 'out'],
+                                    arg_default_vals={'out': 'pybind11::none()'},
+                                    )
+    register_function(func_cheb_poly_nd)
+
+
+wrap_cheb_poly_nd('double')
+wrap_cheb_poly_nd('float')
+
+
+# cheb_eval
+cheb_eval_doc = """Evaluate the 3D Chebyshev expansions of many boxes. Target p
+is evaluated with the expansion of box box_ids[p], in the local coordinates
+2 * (x - center) / size of that box. Without box_ids, the boxes must be the
+leaves of an octree, and each target is evaluated with the box containing it.
+
+:param d: int, Chebyshev degree
+:param coeffs: numpy.array of shape (n_boxes, dof, n_coeffs), coefficients
+               in pvfmm's layout
+:param centers: numpy.array of shape (n_boxes, 3), box centers
+:param sizes: numpy.array of shape (n_boxes,), box sizes
+:param targets: numpy.array of shape (n_pts, 3), target points
+:param box_ids: numpy.array of int64 and shape (n_pts,), box of each
+                target, optional
+:param out: numpy.array, optional C-contiguous array to store the result in
+
+:return: numpy.array of shape (n_pts, dof), the values at the targets
+""".replace('\n', '\\n')
+
+
+def wrap_cheb_eval(number_type):
+    func_cheb_eval = CXXFunction(function_name='cheb_eval',
+                                 in_module='cheb_utils',
+                                 namespace_prefix='pypvfmm::',
+                                 docstring=cheb_eval_doc,
+                                 template_args=["%s" % number_type, ],
+                                 type_str='_%s' % number_type,
+                                 arg_names=['d', 'coeffs', 'centers', 'sizes',
+                                            'targets', 'box_ids', 'out'],
+                                 arg_default_vals={
+                                     'box_ids': 'pybind11::none()',
+                                     'out': 'pybind11::none()'},
+                                 )
+    register_function(func_cheb_eval)
+
+
+wrap_cheb_eval('double')
+wrap_cheb_eval('float')
+
+
+# cheb_approx_matrix
+cheb_approx_matrix_doc = """Matrix mapping function values at the Chebyshev
+nodes to Chebyshev coefficients (via pvfmm::cheb_approx).
+
+:param d: int, Chebyshev degree
+
+:return: numpy.array of shape ((d+1)^3, n_coeffs); the nodes are ordered
+         with x fastest, and the coefficients use pvfmm's layout
+""".replace('\n', '\\n')
+
+
+def wrap_cheb_approx_matrix(number_type):
+    func_cheb_approx_matrix = CXXFunction(function_name='cheb_approx_matrix',
+                                          in_module='cheb_utils',
+                                          namespace_prefix='pypvfmm::',
+                                          docstring=cheb_approx_matrix_doc,
+                                          template_args=["%s" % number_type, ],
+                                          type_str='_%s' % number_type,
+                                          arg_names=['d'],
+                                          )
+    register_function(func_cheb_approx_matrix)
+
+
+wrap_cheb_approx_matrix('double')
+wrap_cheb_approx_matrix('float')
+
+
+# cheb_diff_matrix
+cheb_diff_matrix_doc = """Matrix of the derivative of Chebyshev expansions
+(via pvfmm::cheb_diff), w.r.t. the coordinates of the unit box.
+
+:param d: int, Chebyshev degree
+:param diff_dim: int, direction of the derivative (0, 1, 2 for x, y, z)
+
+:return: numpy.array of shape (n_coeffs, n_coeffs); the coefficients of the
+         derivative are coeffs @ D
+""".replace('\n', '\\n')
+
+
+def wrap_cheb_diff_matrix(number_type):
+    func_cheb_diff_matrix = CXXFunction(function_name='cheb_diff_matrix',
+                                        in_module='cheb_utils',
+                                        namespace_prefix='pypvfmm::',
+                                        docstring=cheb_diff_matrix_doc,
+                                        template_args=["%s" % number_type, ],
+                                        type_str='_%s' % number_type,
+                                        arg_names=['d', 'diff_dim'],
+                                        )
+    register_function(func_cheb_diff_matrix)
+
+
+wrap_cheb_diff_matrix('double')
+wrap_cheb_diff_matrix('float')
+
+
 # integ
 integ_doc = """Compute integrals over pyramids in all directions.
 
@@ -95,25 +333,265 @@ integ_doc = """Compute integrals over pyramids in all directions.
 :param s: numpy.array, singular (target) point
 :param r: float, box size
 :param n: int, degree of the quadrature rule
-:param kernel: str, kernel information, see :mod:`pypvfmm.kernel`
+:param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`
+:param out: numpy.array, optional C-contiguous array to store the result in
 
-:return: numpy.array, the computed integrals
+:return: numpy.array, the computed integrals (out if given)
 """.replace('\n', '\\n')
 
 
-def wrap_integ(number_type):
+def wrap_integ(number_type, out_type=None):
+    """With *out_type*, the wrapper computes in *number_type* and returns
+    results in *out_type*.
+    """
+    if out_type is None:
+        template_args = ["%s" % number_type, ]
+        type_str = '_%s' % number_type
+    else:
+        template_args = ["%s" % number_type, "%s" % out_type]
+        type_str = '_mixed'
+
     func_cheb_poly = CXXFunction(function_name='integ',
                                  in_module='cheb_utils',
                                  namespace_prefix='pypvfmm::',
                                  docstring=integ_doc,
-                                 template_args=["%s" % number_type, ],
-                                 type_str='_%s' % number_type,
-                                 arg_names=['m', 's', 'r', 'n', 'kernel'],
+                                 template_args=template_args,
+                                 type_str=type_str,
+                                 arg_names=['m', 's', 'r', 'n', 'kernel', 'out'],
+                                 arg_default_vals={'out': 'pybind11::none()'},
                                  )
     register_function(func_cheb_poly)
 
 
 wrap_integ('double')
 wrap_integ('float')
+wrap_integ('double', 'float')
+
+
+# integ_batch
+integ_batch_doc = """Compute integrals over pyramids for a batch of target points.
+The targets are distributed across OpenMP threads, with the GIL released.
+
+:param m: int, Chebyshev degree
+:param targets: numpy.array of shape (N, 3), singular (target) points
+:param r: float, box size
+:param n: int, degree of the quadrature rule
+:param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`
+:param out: numpy.array, optional C-contiguous array to store the result in
+
+:return: numpy.array of shape (N, ...), the computed integrals, one row per target
+""".replace('\n', '\\n')
+
+
+def wrap_integ_batch(number_type, out_type=None):
+    """With *out_type*, the wrapper computes in *number_type* and returns
+    results in *out_type*.
+    """
+    if out_type is None:
+        template_args = ["%s" % number_type, ]
+        type_str = '_%s' % number_type
+    else:
+        template_args = ["%s" % number_type, "%s" % out_type]
+        type_str = '_mixed'
+
+    func_integ_batch = CXXFunction(function_name='integ_batch',
+                                   in_module='cheb_utils',
+                                   namespace_prefix='pypvfmm::',
+                                   docstring=integ_batch_doc,
+                                   template_args=template_args,
+                                   type_str=type_str,
+                                   arg_names=['m', 'targets', 'r', 'n', 'kernel',
+                                              'out'],
+                                   arg_default_vals={'out': 'pybind11::none()'},
+                                   )
+    register_function(func_integ_batch)
+
+
+wrap_integ_batch('double')
+wrap_integ_batch('float')
+wrap_integ_batch('double', 'float')
+
+
+# integ_adaptive
+integ_adaptive_doc = """Compute integrals over pyramids in all directions, raising
+the degree of the quadrature rule until the results of successive degrees
+agree to a relative tolerance.
+
+:param m: int, Chebyshev degree
+:param s: numpy.array, singular (target) point
+:param r: float, box size
+:param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`
+:param tol: float, relative tolerance
+:param n_init: int, initial degree of the quadrature rule
+:param n_max: int, maximum degree of the quadrature rule
+
+:return: tuple (numpy.array, int, bool), the computed integrals, the degree
+         of the quadrature rule used for them, and whether tol was met
+""".replace('\n', '\\n')
+
+
+def wrap_integ_adaptive(number_type):
+    func_integ_adaptive = CXXFunction(function_name='integ_adaptive',
+                                      in_module='cheb_utils',
+                                      namespace_prefix='pypvfmm::',
+                                      docstring=integ_adaptive_doc,
+                                      template_args=["%s" % number_type, ],
+                                      type_str='_%s' % number_type,
+                                      arg_names=['m', 's', 'r', 'kernel', 'tol',
+                                                 'n_init', 'n_max'],
+                                      )
+    register_function(func_integ_adaptive)
+
+
+wrap_integ_adaptive('double')
+wrap_integ_adaptive('float')
 
 # }}} End mod: cheb_utils
+
+# {{{ mod: fmm
+
+fmm_evaluate_doc = """Evaluation of the kernel sums at the targets with pvfmm's
+particle FMM. The points are mapped into the unit cube, by scaling for
+homogeneous kernels and by translation only for the others.
+
+:param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`
+:param sources: numpy.array of shape (n_src, 3), source points
+:param densities: numpy.array of shape (n_src, src_dim), source densities,
+                  or (n_rhs, n_src, src_dim) for several right-hand sides
+:param targets: numpy.array of shape (n_trg, 3), target points
+:param order: int, multipole order
+:param max_pts: int, maximum number of points per leaf box
+:param out: numpy.array, optional C-contiguous array to store the result in
+
+:return: numpy.array of shape (n_trg, trg_dim) or (n_rhs, n_trg, trg_dim),
+         the potentials
+""".replace('\n', '\\n')
+
+
+def wrap_fmm_evaluate(number_type):
+    func_fmm_evaluate = CXXFunction(function_name='fmm_evaluate',
+                                    in_module='fmm',
+                                    namespace_prefix='pypvfmm::',
+                                    docstring=fmm_evaluate_doc,
+                                    template_args=["%s" % number_type, ],
+                                    type_str='_%s' % number_type,
+                                    arg_names=['kernel', 'sources', 'densities',
+                                               'targets', 'order', 'max_pts',
+                                               'out'],
+                                    arg_default_vals={'out': 'pybind11::none()'},
+                                    )
+    register_function(func_fmm_evaluate)
+
+
+wrap_fmm_evaluate('double')
+wrap_fmm_evaluate('float')
+
+# point fmm
+point_fmm_doc = """Particle FMM with fixed sources and targets, set up once for
+repeated evaluations with different densities.""".replace('\n', '\\n')
+
+point_fmm_evaluate_doc = """Evaluates the kernel sums at the targets with the
+given densities of shape (n_src, src_dim), or (n_rhs, n_src, src_dim) for
+several right-hand sides, which are evaluated one after the other. The
+result, of shape (n_trg, trg_dim) or (n_rhs, n_trg, trg_dim), is written
+into out if given.""".replace('\n', '\\n')
+
+point_fmm_update_positions_doc = """Moves the sources and targets to new
+positions, updating the tree in place if the points stay in their leaf
+boxes, and rebuilding it otherwise. Returns whether the tree was updated in
+place.""".replace('\n', '\\n')
+
+
+def wrap_point_fmm(number_type):
+    class_point_fmm = CXXClass(class_name="PointFMM",
+                               namespace_prefix="pypvfmm::",
+                               template_args=[number_type, ],
+                               type_str="_%s" % number_type,
+                               in_module="fmm",
+                               is_dynamic=False)
+
+    class_point_fmm.add_member_func(is_constructor=True,
+                                    docstring=point_fmm_doc,
+                                    arg_names=["kernel", "sources", "targets",
+                                               "order", "max_pts"],
+                                    arg_types=[
+                                        "pybind11::object",
+                                        "pybind11::array_t<%s, "
+                                        "pybind11::array::c_style>"
+                                        % number_type,
+                                        "pybind11::array_t<%s, "
+                                        "pybind11::array::c_style>"
+                                        % number_type,
+                                        "int", "int"],
+                                    )
+
+    class_point_fmm.add_member_func(name="evaluate",
+                                    docstring=point_fmm_evaluate_doc,
+                                    arg_names=["densities", "out"],
+                                    arg_default_vals={
+                                        "out": "pybind11::none()"},
+                                    )
+
+    class_point_fmm.add_member_func(name="update_positions",
+                                    docstring=point_fmm_update_positions_doc,
+                                    arg_names=["sources", "targets"],
+                                    )
+
+    class_point_fmm.add_property(name="kernel", docstring="Kernel handle.")
+    class_point_fmm.add_property(name="order", docstring="Multipole order.")
+    class_point_fmm.add_property(name="n_sources",
+                                 docstring="Number of sources.")
+    class_point_fmm.add_property(name="n_targets",
+                                 docstring="Number of targets.")
+    class_point_fmm.add_property(name="src_dim",
+                                 docstring="Number of density components.")
+    class_point_fmm.add_property(name="trg_dim",
+                                 docstring="Number of potential components.")
+
+    register_class(class_point_fmm)
+
+
+wrap_point_fmm('double')
+wrap_point_fmm('float')
+
+# cheb fmm
+cheb_fmm_evaluate_doc = """Evaluation of the volume potential of a density with
+pvfmm's Chebyshev FMM. The density is given by its Chebyshev expansions over
+the leaves of an octree of the unit cube.
+
+:param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`
+:param cheb_deg: int, Chebyshev degree
+:param coeffs: numpy.array of shape (n_leaves, src_dim, n_coeffs), the
+               coefficients of the density in pvfmm's layout
+:param centers: numpy.array of shape (n_leaves, 3), leaf centers
+:param depths: numpy.array of int64 and shape (n_leaves,), leaf depths
+:param targets: numpy.array of shape (n_trg, 3), target points
+:param tol: float, tolerance of the refinement of the FMM tree
+:param order: int, multipole order
+:param max_pts: int, maximum number of targets per leaf box
+
+:return: tuple (centers, sizes, coeffs, target_values) of the leaves of the
+         FMM tree and the coefficients of the potential on them, of shape
+         (n_leaves, trg_dim, n_coeffs), and the potential at the targets
+""".replace('\n', '\\n')
+
+
+def wrap_cheb_fmm_evaluate(number_type):
+    func_cheb_fmm_evaluate = CXXFunction(function_name='cheb_fmm_evaluate',
+                                         in_module='fmm',
+                                         namespace_prefix='pypvfmm::',
+                                         docstring=cheb_fmm_evaluate_doc,
+                                         template_args=["%s" % number_type, ],
+                                         type_str='_%s' % number_type,
+                                         arg_names=['kernel', 'cheb_deg',
+                                                    'coeffs', 'centers',
+                                                    'depths', 'targets', 'tol',
+                                                    'order', 'max_pts'],
+                                         )
+    register_function(func_cheb_fmm_evaluate)
+
+
+wrap_cheb_fmm_evaluate('double')
+wrap_cheb_fmm_evaluate('float')
+
+# }}} End mod: fmm
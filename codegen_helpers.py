@@ -242,6 +242,8 @@ class CXXClassMemberFunc(CXXClassMemberBase):
             "docstring": self.docstring,
             "kwargs": self.generate_kwargs_code(),
             "arg_types": ", ".join(self.arg_types),
+            # filled in by the owning CXXClass
+            "class_id": "${class_id}",
             }
         if self.is_static:
             return self.static_template.render(**context)
@@ -251,19 +253,47 @@ class CXXClassMemberFunc(CXXClassMemberBase):
         return self.normal_template.render(**context)
 
 
+class CXXClassMemberProperty(CXXClassMemberBase):
+    """Read-only property of a C++ class, backed by a const getter.
+    """
+    property_template = Template(
+        '.def_property_readonly("${name}", &${class_id}::${name}, "${docstring}")')
+
+    def __init__(self, name, docstring=None):
+        self.name = name
+
+        if docstring:
+            self.docstring = docstring
+        else:
+            self.docstring = ""
+
+    def __str__(self):
+        context = {
+            "name": self.name,
+            "docstring": self.docstring,
+            # filled in by the owning CXXClass
+            "class_id": "${class_id}",
+            }
+        return self.property_template.render(**context)
+
+
 class CXXClass():
     """C++ class.
+
+    holder_type: smart pointer template managing the instances, e.g.
+    std::shared_ptr, needed when instances are shared with C++ code.
     """
     class_template = Template(
-        'pybind11::class_<${class_id}>(${mod_var}, "${class_name}"${dynamic_flag})${members};')  # noqa: E501
+        'pybind11::class_<${class_id}${holder}>(${mod_var}, "${class_name}"${dynamic_flag})${members};')  # noqa: E501
 
     def __init__(self, class_name, namespace_prefix="pvfmm::",
                  in_module='m', class_members=None,
                  template_args=None, type_str="Unknown",
-                 is_dynamic=True):
+                 is_dynamic=True, holder_type=None):
         self.class_name = class_name
         self.is_dynamic = is_dynamic
         self.type_str = type_str
+        self.holder_type = holder_type
 
         if in_module == 'm':
             self.in_module = in_module
@@ -276,7 +306,8 @@ class CXXClass():
             self.template_args = template_args
 
         self.class_instantiation = TemplateClassInst(
-            self.class_name, self.template_args)
+            self.class_name, self.template_args,
+            namespace_prefix=namespace_prefix)
 
         if class_members is None:
             self.class_members = []
@@ -291,6 +322,11 @@ class CXXClass():
         """
         self.class_members.append(CXXClassMemberFunc(*args, **kwargs))
 
+    def add_property(self, *args, **kwargs):
+        """Add a read-only property to the class.
+        """
+        self.class_members.append(CXXClassMemberProperty(*args, **kwargs))
+
     def __str__(self):
 
         if self.is_dynamic:
@@ -298,8 +334,15 @@ class CXXClass():
         else:
             dynamic_flag = ''
 
+        class_id = self.class_instantiation.get_class_id()
+        if self.holder_type:
+            holder = ', %s<%s>' % (self.holder_type, class_id)
+        else:
+            holder = ''
+
         context = {
-            "class_id": self.class_instantiation.get_class_id(),
+            "class_id": class_id,
+            "holder": holder,
             "class_name": self.class_name + self.type_str,
             "dynamic_flag": dynamic_flag,
             "mod_var": self.in_module,
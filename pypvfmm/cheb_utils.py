@@ -22,9 +22,30 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import os
+import json
+import warnings
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import numpy as np
-from pypvfmm.wrapper.cheb_utils import integ_double, integ_float
+from pypvfmm.wrapper.cheb_utils import integ_double, integ_float, integ_mixed
+from pypvfmm.wrapper.cheb_utils import (
+        integ_batch_double, integ_batch_float, integ_batch_mixed)
+from pypvfmm.wrapper.cheb_utils import integ_adaptive_double, integ_adaptive_float
 from pypvfmm.wrapper.cheb_utils import cheb_poly_float, cheb_poly_double
+from pypvfmm.wrapper.cheb_utils import cheb_poly_nd_float, cheb_poly_nd_double
+from pypvfmm.wrapper.cheb_utils import cheb_eval_float, cheb_eval_double
+from pypvfmm.wrapper.cheb_utils import (
+        cheb_approx_matrix_float, cheb_approx_matrix_double)
+from pypvfmm.wrapper.cheb_utils import (
+        cheb_diff_matrix_float, cheb_diff_matrix_double)
+from pypvfmm.kernel import (
+        get_kernel_handle, homogeneity, kernel_desc, kernel_family,
+        split_kernel)
 
 
 def cheb_poly(d, vec_in, n, vec_out):
@@ -39,35 +60,983 @@ def cheb_poly(d, vec_in, n, vec_out):
         return cheb_poly_double(d, vec_in, n, vec_out)
 
 
-def integ(m, s, r, n, kernel):
+def cheb_poly_nd(d, x, out=None):
+    """Evaluate all Chebyshev polynomials up to degree *d* at every entry
+    of *x*. Unlike :func:`cheb_poly`, *x* may have any shape and strides
+    (it is not copied), and the output is allocated if not given.
+    Points outside [-1, 1] give zeros, as with :func:`cheb_poly`.
+
+    :param d: int, Chebyshev degree
+    :param x: numpy.array, evaluation points
+    :param out: numpy.array of shape (d + 1, *x.shape), optional
+                C-contiguous array to store the result in
+
+    :return: numpy.array of shape (d + 1, *x.shape), where entry [k, ...]
+             is T_k(x[...]) (*out* if given)
+    """
+    assert isinstance(x, np.ndarray)
+    dtype = x.dtype
+
+    if dtype == np.float32:
+        return cheb_poly_nd_float(d, x, out)
+    elif dtype == np.float64:
+        return cheb_poly_nd_double(d, x, out)
+
+    raise NotImplementedError("No fallback wrapper for dtype %s." % str(dtype))
+
+
+# {{{ cached Chebyshev bases
+
+class ChebBasisCache(object):
+    """A bounded, thread-safe LRU store of Chebyshev basis (Vandermonde)
+    matrices, as computed by :func:`cheb_poly_nd`.
+
+    Each basis is built once per (degree, node set, dtype), where node sets
+    are identified by a hash of their values, and handed out as a
+    read-only array. Evaluating Chebyshev series on a known node set then
+    amounts to one matrix product against cached data, see
+    :meth:`evaluate`.
+
+    :param max_bytes: int, the least recently used bases are evicted when
+                      the cached bases take more than that many bytes
+    """
+
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes
+        self._bases = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(d, nodes):
+        """Returns the key of the basis of degree *d* on *nodes*."""
+        nodes = np.ascontiguousarray(nodes)
+        return (d, nodes.shape, nodes.dtype.str,
+                hashlib.sha1(nodes.tobytes()).hexdigest())
+
+    def get(self, d, nodes):
+        """Returns the basis of degree *d* on *nodes*.
+
+        :return: read-only numpy.array of shape (d+1, *nodes.shape), see
+                 :func:`cheb_poly_nd`
+        """
+        key = self.key(d, nodes)
+
+        with self._lock:
+            if key in self._bases:
+                self.hits += 1
+                # mark as most recently used
+                basis = self._bases.pop(key)
+                self._bases[key] = basis
+                return basis
+            self.misses += 1
+
+        basis = cheb_poly_nd(d, np.asarray(nodes))
+        basis.flags.writeable = False
+
+        with self._lock:
+            if key not in self._bases:
+                self._bases[key] = basis
+                self._nbytes += basis.nbytes
+                # keep at least the newest basis
+                while self._nbytes > self.max_bytes and len(self._bases) > 1:
+                    _, evicted = self._bases.popitem(last=False)
+                    self._nbytes -= evicted.nbytes
+                    self.evictions += 1
+            return self._bases[key]
+
+    def evaluate(self, coeffs, nodes):
+        """Evaluate Chebyshev series on *nodes* with one matrix product.
+
+        :param coeffs: numpy.array of shape (..., d+1), series coefficients
+        :param nodes: numpy.array, evaluation points
+
+        :return: numpy.array of shape (..., *nodes.shape)
+        """
+        coeffs = np.asarray(coeffs)
+        d = coeffs.shape[-1] - 1
+        basis = self.get(d, nodes)
+        result = coeffs.reshape(-1, d + 1).dot(basis.reshape(d + 1, -1))
+        return result.reshape(coeffs.shape[:-1] + basis.shape[1:])
+
+    def stats(self):
+        """Returns a dict of the hit/miss/eviction counts and the current
+        number and size of the cached bases.
+        """
+        with self._lock:
+            return {
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._bases),
+                    "nbytes": self._nbytes,
+                    }
+
+    def clear(self):
+        """Removes all cached bases and resets the statistics."""
+        with self._lock:
+            self._bases.clear()
+            self._nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+
+cheb_basis_cache = ChebBasisCache()
+
+
+def cheb_basis(d, nodes):
+    """Returns the basis of degree *d* on *nodes* from the default
+    :class:`ChebBasisCache`.
+    """
+    return cheb_basis_cache.get(d, nodes)
+
+# }}} End cached Chebyshev bases
+
+
+# {{{ 3D Chebyshev expansions
+
+
+def cheb_coeff_count(d):
+    """Returns the number of coefficients of a 3D Chebyshev expansion of
+    degree *d* (modes (i, j, k) with i + j + k <= d).
+    """
+    return (d + 1) * (d + 2) * (d + 3) // 6
+
+
+def _cheb_degree(n_coeffs):
+    d = 0
+    while cheb_coeff_count(d) < n_coeffs:
+        d += 1
+    if cheb_coeff_count(d) != n_coeffs:
+        raise ValueError("%d is not a valid number of Chebyshev coefficients."
+                         % n_coeffs)
+    return d
+
+
+def cheb_eval(coeffs, centers, sizes, targets, box_ids=None, out=None):
+    """Evaluate the 3D Chebyshev expansions of many boxes in one
+    (multithreaded) pass.
+
+    If *box_ids* is not given, the boxes must be the leaves of an octree
+    (e.g. the output of :func:`pypvfmm.fmm.cheb_fmm`), and the box
+    containing each target is looked up in the C++ code.
+
+    Coefficients use pvfmm's layout: the modes (i, j, k) with
+    i + j + k <= d, i outermost, where k is the x-, j the y- and i the
+    z-mode. The expansion of a box with center c and size h is in the local
+    coordinates 2 * (x - c) / h.
+
+    :param coeffs: numpy.array of shape (n_boxes, n_coeffs), or
+                   (n_boxes, dof, n_coeffs) for vector-valued expansions
+    :param centers: numpy.array of shape (n_boxes, 3), box centers
+    :param sizes: float or numpy.array of shape (n_boxes,), box sizes
+    :param targets: numpy.array of shape (n_pts, 3), target points
+    :param box_ids: numpy.array of shape (n_pts,), optional index of the
+                    box containing each target
+    :param out: numpy.array, optional C-contiguous array to store the
+                result in
+
+    :return: numpy.array of shape (n_pts,) or (n_pts, dof), the values
+             at the targets
+    """
+    assert isinstance(coeffs, np.ndarray)
+    assert coeffs.ndim in (2, 3)
+
+    dtype = coeffs.dtype
+    n_boxes = coeffs.shape[0]
+    d = _cheb_degree(coeffs.shape[-1])
+
+    coeffs_3d = np.ascontiguousarray(
+        coeffs.reshape(n_boxes, -1, coeffs.shape[-1]))
+    centers = np.ascontiguousarray(centers, dtype=dtype)
+    sizes = np.ascontiguousarray(
+        np.broadcast_to(np.asarray(sizes, dtype=dtype), (n_boxes,)))
+    targets = np.ascontiguousarray(targets, dtype=dtype)
+    if box_ids is not None:
+        box_ids = np.ascontiguousarray(box_ids, dtype=np.int64)
+
+    if dtype == np.float32:
+        result = cheb_eval_float(d, coeffs_3d, centers, sizes, targets,
+                                 box_ids, out)
+    elif dtype == np.float64:
+        result = cheb_eval_double(d, coeffs_3d, centers, sizes, targets,
+                                  box_ids, out)
+    else:
+        raise NotImplementedError(
+            "No fallback wrapper for dtype %s." % str(dtype))
+
+    if coeffs.ndim == 2 and out is None:
+        return result.reshape(-1)
+    return result
+
+
+def cheb_nodes(d, dtype=np.float64):
+    """Returns the *d* + 1 Chebyshev nodes in [-1, 1] used by pvfmm, in
+    increasing order.
+    """
+    i = np.arange(d + 1, dtype=np.float64)
+    return (-np.cos((i + 0.5) * np.pi / (d + 1))).astype(dtype)
+
+
+def cheb_box_nodes(d, centers, sizes):
+    """Returns the tensor-product Chebyshev nodes of many boxes.
+
+    :param d: int, Chebyshev degree
+    :param centers: numpy.array of shape (n_boxes, 3), box centers
+    :param sizes: float or numpy.array of shape (n_boxes,), box sizes
+
+    :return: numpy.array of shape (n_boxes, (d+1)^3, 3), with x fastest
+    """
+    centers = np.asarray(centers)
+    dtype = centers.dtype
+    sizes = np.broadcast_to(np.asarray(sizes, dtype=dtype), (len(centers),))
+
+    x = cheb_nodes(d, dtype)
+    z, y, x = np.meshgrid(x, x, x, indexing="ij")
+    local_nodes = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=-1)
+
+    half_sizes = 0.5 * sizes[:, None, None]
+    return centers[:, None, :] + half_sizes * local_nodes[None, :, :]
+
+
+_cheb_approx_matrices = {}
+
+
+def cheb_approx_matrix(d, dtype=np.float64):
+    """Returns the (cached) matrix of shape ((d+1)^3, n_coeffs) mapping the
+    values at the nodes of :func:`cheb_box_nodes` to Chebyshev coefficients.
+    """
+    dtype = np.dtype(dtype)
+    key = (d, dtype.str)
+    if key not in _cheb_approx_matrices:
+        if dtype == np.float32:
+            mat = cheb_approx_matrix_float(d)
+        elif dtype == np.float64:
+            mat = cheb_approx_matrix_double(d)
+        else:
+            raise NotImplementedError(
+                "No fallback wrapper for dtype %s." % str(dtype))
+        mat.flags.writeable = False
+        _cheb_approx_matrices[key] = mat
+    return _cheb_approx_matrices[key]
+
+
+def cheb_approx(fn, d, centers, sizes):
+    """Fit the Chebyshev expansions of a function over many boxes.
+
+    *fn* is called only once, on the Chebyshev nodes of all boxes, and the
+    coefficients of all boxes are then obtained by a single matrix product.
+
+    :param fn: callable, taking a numpy.array of points of shape (n, 3) and
+               returning the values of shape (n,) or (n, dof)
+    :param d: int, Chebyshev degree
+    :param centers: numpy.array of shape (n_boxes, 3), box centers
+    :param sizes: float or numpy.array of shape (n_boxes,), box sizes
+
+    :return: numpy.array of shape (n_boxes, n_coeffs), or
+             (n_boxes, dof, n_coeffs) for vector-valued *fn*, in the
+             layout of :func:`cheb_eval`
+    """
+    centers = np.asarray(centers)
+    dtype = centers.dtype
+    n_boxes = len(centers)
+    n_nodes = (d + 1) ** 3
+
+    nodes = cheb_box_nodes(d, centers, sizes)
+    values = np.asarray(fn(nodes.reshape(-1, 3)), dtype=dtype)
+    if values.shape[0] != n_boxes * n_nodes:
+        raise ValueError("fn returned %d values for %d points."
+                         % (values.shape[0], n_boxes * n_nodes))
+
+    mat = cheb_approx_matrix(d, dtype)
+    if values.ndim == 1:
+        return values.reshape(n_boxes, n_nodes).dot(mat)
+
+    dof = values.shape[1]
+    values = values.reshape(n_boxes, n_nodes, dof).transpose(0, 2, 1)
+    return values.reshape(n_boxes * dof, n_nodes).dot(mat).reshape(
+            n_boxes, dof, -1)
+
+
+_cheb_diff_matrices = {}
+
+
+def cheb_diff_matrix(d, axis, dtype=np.float64):
+    """Returns the (cached) matrix of shape (n_coeffs, n_coeffs) mapping
+    Chebyshev coefficients to the coefficients of their derivative along
+    *axis* (0, 1, 2 for x, y, z), for a box of unit size.
+    """
+    dtype = np.dtype(dtype)
+    key = (d, axis, dtype.str)
+    if key not in _cheb_diff_matrices:
+        if dtype == np.float32:
+            mat = cheb_diff_matrix_float(d, axis)
+        elif dtype == np.float64:
+            mat = cheb_diff_matrix_double(d, axis)
+        else:
+            raise NotImplementedError(
+                "No fallback wrapper for dtype %s." % str(dtype))
+        mat.flags.writeable = False
+        _cheb_diff_matrices[key] = mat
+    return _cheb_diff_matrices[key]
+
+
+def cheb_grad_matrix(d, dtype=np.float64):
+    """Returns the matrix of shape (n_coeffs, 3 * n_coeffs) mapping
+    Chebyshev coefficients to the coefficients of the x-, y- and
+    z-derivatives, for a box of unit size.
+    """
+    dtype = np.dtype(dtype)
+    key = (d, "grad", dtype.str)
+    if key not in _cheb_diff_matrices:
+        mat = np.hstack([cheb_diff_matrix(d, axis, dtype) for axis in range(3)])
+        mat.flags.writeable = False
+        _cheb_diff_matrices[key] = mat
+    return _cheb_diff_matrices[key]
+
+
+def _apply_diff_matrix(coeffs, mat, sizes, out_shape, out):
+    """Computes coeffs @ mat / sizes for all boxes with one matrix product."""
+    n_boxes = coeffs.shape[0]
+    coeffs_2d = np.ascontiguousarray(coeffs).reshape(-1, mat.shape[0])
+
+    if out is None:
+        out = np.empty(out_shape, dtype=coeffs.dtype)
+    elif out.shape != out_shape:
+        raise ValueError("out should have shape %s." % str(out_shape))
+    np.dot(coeffs_2d, mat, out=out.reshape(-1, mat.shape[1]))
+
+    # scale from the unit box to the actual box sizes
+    if not (np.isscalar(sizes) and sizes == 1):
+        inv_sizes = 1 / np.broadcast_to(
+                np.asarray(sizes, dtype=coeffs.dtype), (n_boxes,))
+        out.reshape(n_boxes, -1)[...] *= inv_sizes[:, None]
+
+    return out
+
+
+def cheb_diff(coeffs, axis, sizes=1, mat=None, out=None):
+    """Differentiate the Chebyshev expansions of many boxes along *axis*
+    (0, 1, 2 for x, y, z) in one matrix product.
+
+    :param coeffs: numpy.array of shape (n_boxes, [dof,] n_coeffs), in the
+                   layout of :func:`cheb_eval`
+    :param axis: int, direction of the derivative
+    :param sizes: float or numpy.array of shape (n_boxes,), box sizes
+    :param mat: numpy.array, optional precomputed
+                :func:`cheb_diff_matrix` to reuse across calls
+    :param out: numpy.array, optional C-contiguous array to store the
+                result in
+
+    :return: numpy.array of the same shape as *coeffs*, the coefficients of
+             the derivatives
+    """
+    assert isinstance(coeffs, np.ndarray)
+    if mat is None:
+        mat = cheb_diff_matrix(_cheb_degree(coeffs.shape[-1]), axis,
+                               coeffs.dtype)
+    return _apply_diff_matrix(coeffs, mat, sizes, coeffs.shape, out)
+
+
+def cheb_grad(coeffs, sizes=1, mat=None, out=None):
+    """Compute the gradients of the Chebyshev expansions of many boxes in
+    one matrix product.
+
+    :param coeffs: numpy.array of shape (n_boxes, [dof,] n_coeffs), in the
+                   layout of :func:`cheb_eval`
+    :param sizes: float or numpy.array of shape (n_boxes,), box sizes
+    :param mat: numpy.array, optional precomputed
+                :func:`cheb_grad_matrix` to reuse across calls
+    :param out: numpy.array, optional C-contiguous array to store the
+                result in
+
+    :return: numpy.array of shape (n_boxes, [dof,] 3, n_coeffs), the
+             coefficients of the x-, y- and z-derivatives
+    """
+    assert isinstance(coeffs, np.ndarray)
+    n_coeffs = coeffs.shape[-1]
+    if mat is None:
+        mat = cheb_grad_matrix(_cheb_degree(n_coeffs), coeffs.dtype)
+    return _apply_diff_matrix(coeffs, mat, sizes,
+                              coeffs.shape[:-1] + (3, n_coeffs), out)
+
+# }}} End 3D Chebyshev expansions
+
+
+def integ(m, s, r, n, kernel, out=None, out_dtype=None):
     """Compute integrals over pyramids in all directions.
     The source region is [0, r]^3.
 
+    For repeated calls with the same kernel, pass the kernel handle from
+    :func:`pypvfmm.kernel.get_kernel_handle`, which is set up only once.
+
     :param m: int, Chebyshev degree
     :param s: numpy.array, singular (target) point
     :param r: float, box size
     :param n: int, degree of the quadrature rule
-    :param kernel: str, kernel information, see :mod:`pypvfmm.kernel`,
+    :param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`,
                    may also pass supported :mod:`sumpy` kernels.
+    :param out: numpy.array, optional C-contiguous array to store the
+                result in, e.g. a row of a larger table. Without it, the
+                result is returned without copying it out of pvfmm.
+    :param out_dtype: dtype of the result, defaults to the dtype of *out*
+                      if given, and to the dtype of *s* otherwise. The
+                      computation runs in the dtype of *s*, so that double
+                      precision targets with *out_dtype=numpy.float32* give
+                      double precision accuracy with single precision storage.
 
-    :return: numpy.array, the computed integrals
+    :return: numpy.array, the computed integrals (*out* if given)
     """
     assert isinstance(s, np.ndarray)
     assert len(s) == 3
 
     dtype = s.dtype
+    out_dtype = _get_out_dtype(dtype, out, out_dtype)
+    kernel, translation = _process_kernel(kernel, dtype)
+
+    if translation is not None:
+        result = integ(m, s, r, n, kernel, out_dtype=out_dtype)
+        return _translate_integ(result, kernel, translation, dtype, out)
+
+    if dtype == np.float32 and out_dtype == np.float32:
+        return integ_float(m, s, r, n, kernel, out)
+    elif dtype == np.float64 and out_dtype == np.float64:
+        return integ_double(m, s, r, n, kernel, out)
+    elif dtype == np.float64 and out_dtype == np.float32:
+        return integ_mixed(m, s, r, n, kernel, out)
+
+    raise NotImplementedError("No fallback wrapper for dtype %s -> %s."
+                              % (str(dtype), str(out_dtype)))
+
+
+def integ_batch(m, targets, r, n, kernel, out=None, out_dtype=None):
+    """Compute integrals over pyramids in all directions for a batch
+    of target points, in a single (multithreaded) call.
+    The source region is [0, r]^3.
+
+    :param m: int, Chebyshev degree
+    :param targets: numpy.array of shape (N, 3), singular (target) points
+    :param r: float, box size
+    :param n: int, degree of the quadrature rule
+    :param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`,
+                   may also pass supported :mod:`sumpy` kernels.
+    :param out: numpy.array, optional C-contiguous array to store the
+                result in
+    :param out_dtype: dtype of the result, see :func:`integ`
+
+    :return: numpy.array of shape (N, ...), where row i is the result
+             of :func:`integ` for targets[i] (*out* if given)
+    """
+    assert isinstance(targets, np.ndarray)
+    assert targets.ndim == 2 and targets.shape[1] == 3
+
+    dtype = targets.dtype
+    out_dtype = _get_out_dtype(dtype, out, out_dtype)
+    kernel, translation = _process_kernel(kernel, dtype)
+    targets = np.ascontiguousarray(targets)
+
+    if translation is not None:
+        result = integ_batch(m, targets, r, n, kernel, out_dtype=out_dtype)
+        return _translate_integ(result, kernel, translation, dtype, out)
+
+    if dtype == np.float32 and out_dtype == np.float32:
+        return integ_batch_float(m, targets, r, n, kernel, out)
+    elif dtype == np.float64 and out_dtype == np.float64:
+        return integ_batch_double(m, targets, r, n, kernel, out)
+    elif dtype == np.float64 and out_dtype == np.float32:
+        return integ_batch_mixed(m, targets, r, n, kernel, out)
+
+    raise NotImplementedError("No fallback wrapper for dtype %s -> %s."
+                              % (str(dtype), str(out_dtype)))
 
-    try:
-        from sumpy.kernel import Kernel
-        if isinstance(kernel, Kernel):
-            from pypvfmm.kernel import process_sumpy_kernel
-            kernel = process_sumpy_kernel(kernel)
-    except ImportError:
-        pass
+
+def integ_adaptive(m, s, r, kernel, tol=1e-8, n_init=None, n_max=300):
+    """Compute integrals over pyramids in all directions, choosing the
+    degree of the quadrature rule automatically.
+    The source region is [0, r]^3.
+
+    Starting from *n_init*, the degree is raised (by a factor of about 1.3
+    per step) until the results of two successive degrees agree to *tol*,
+    relative to their largest entry. The result of each degree serves as the
+    error estimate for the next one, so each step costs one :func:`integ`.
+
+    :param m: int, Chebyshev degree
+    :param s: numpy.array, singular (target) point
+    :param r: float, box size
+    :param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`,
+                   may also pass supported :mod:`sumpy` kernels.
+    :param tol: float, relative tolerance
+    :param n_init: int, initial degree of the quadrature rule, defaults
+                   to m + 1
+    :param n_max: int, maximum degree of the quadrature rule
+
+    :return: tuple (numpy.array, int), the computed integrals and the
+             degree of the quadrature rule used for them, which may be
+             reused for nearby targets
+    """
+    assert isinstance(s, np.ndarray)
+    assert len(s) == 3
+
+    dtype = s.dtype
+    kernel, translation = _process_kernel(kernel, dtype)
+
+    if n_init is None:
+        n_init = m + 1
 
     if dtype == np.float32:
-        return integ_float(m, s, r, n, kernel)
+        result, n, converged = integ_adaptive_float(
+            m, s, r, kernel, tol, n_init, n_max)
     elif dtype == np.float64:
-        return integ_double(m, s, r, n, kernel)
+        result, n, converged = integ_adaptive_double(
+            m, s, r, kernel, tol, n_init, n_max)
+    else:
+        raise NotImplementedError(
+            "No fallback wrapper for dtype %s." % str(dtype))
 
-    raise NotImplementedError("No fallback wrapper for dtype %s." % str(dtype))
+    if not converged:
+        warnings.warn("integ_adaptive did not reach tol=%g with n_max=%d."
+                      % (tol, n_max))
+
+    return _translate_integ(result, kernel, translation, dtype), n
+
+
+def integ_multilevel(m, s, rs, n, kernel):
+    """Compute :func:`integ` for boxes of several sizes, with the target
+    at the same relative position in every box.
+
+    For homogeneous kernels, the integrals are computed only once on the
+    unit box and rescaled: if K(a x) = a^d K(x), the result for box size r
+    is r^(3 + d) times the result for the unit box. Other kernels fall
+    back to direct computation for every box size.
+
+    :param m: int, Chebyshev degree
+    :param s: numpy.array of shape (3,) or (N, 3), singular (target) point(s)
+              relative to the box size, i.e. the target of the box [0, r]^3
+              is r * s
+    :param rs: sequence of floats, box sizes
+    :param n: int, degree of the quadrature rule
+    :param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`,
+                   may also pass supported :mod:`sumpy` kernels.
+
+    :return: numpy.array of shape (len(rs), ...), the computed integrals
+             for each box size
+    """
+    assert isinstance(s, np.ndarray)
+    assert s.shape[-1] == 3 and s.ndim in (1, 2)
+
+    kernel, translation = _process_kernel(kernel, s.dtype)
+    degree = homogeneity(kernel)
+
+    if s.ndim == 1:
+        integ_func = integ
+    else:
+        integ_func = integ_batch
+
+    if degree is None:
+        result = np.array([
+            integ_func(m, (r * s).astype(s.dtype), r, n, kernel)
+            for r in rs])
+    else:
+        unit_result = integ_func(m, s, 1, n, kernel)
+        scaling = np.asarray(rs, dtype=unit_result.dtype) ** (3 + degree)
+        result = scaling.reshape((-1,) + (1,) * unit_result.ndim) * unit_result
+
+    return _translate_integ(result, kernel, translation, s.dtype)
+
+
+# {{{ cube symmetries
+
+# How integ results of each kernel family (see kernel_family) transform under
+# the symmetries of the source box: components of "scalar" kernels are
+# invariant, while those of "vector" kernels (one component per target
+# dimension) rotate with the box.
+INTEG_SYMMETRY_TYPES = {
+        "LaplaceKernel, potential": "scalar",
+        "LapKnl3D": "scalar",
+        "LaplaceKernel, gradient": "vector",
+        "LapKnl3D, gradient": "vector",
+        "HelmholtzKernel, potential": "scalar",
+        "HelmKnl3D(k)": "scalar",
+        }
+
+
+def integ_symmetric(m, targets, r, n, kernel, decimals=12):
+    """Same as :func:`integ_batch`, but exploits the 48 symmetries of the
+    source box [0, r]^3.
+
+    Each target is mapped into the fundamental domain
+    0 <= t_0 <= t_1 <= t_2 (in box coordinates t = 2 * s / r - 1), :func:`integ`
+    is computed only once for every distinct image, and the results of the
+    other targets are obtained by permuting and sign-flipping Chebyshev modes.
+
+    :param decimals: int, images in the fundamental domain are identified
+                     after rounding their box coordinates to *decimals*
+                     decimal places.
+
+    Other parameters are the same as for :func:`integ_batch`. Only kernels
+    whose family is listed in :data:`INTEG_SYMMETRY_TYPES` are supported,
+    with any parameters.
+    """
+    assert isinstance(targets, np.ndarray)
+    assert targets.ndim == 2 and targets.shape[1] == 3
+
+    dtype = targets.dtype
+    kernel, translation = _process_kernel(kernel, dtype)
+    try:
+        symmetry_type = INTEG_SYMMETRY_TYPES[kernel_family(kernel)]
+    except KeyError:
+        raise ValueError("Cube symmetries are not supported for kernel %s."
+                         % kernel_desc(kernel))
+
+    n_targets = len(targets)
+
+    # decompose t = g(c) with (g c)_a = sigma_a c_{pi(a)}
+    t = 2 * targets.astype(np.float64) / r - 1
+    sigma = np.where(t < 0, -1, 1)
+    perm = np.argsort(np.abs(t), axis=1, kind="mergesort")
+    canonical = np.round(
+        np.take_along_axis(np.abs(t), perm, axis=1), decimals)
+    pi = np.argsort(perm, axis=1)
+
+    images, image_ids = np.unique(canonical, axis=0, return_inverse=True)
+    image_ids = image_ids.reshape(-1)
+    image_results = integ_batch(
+        m, ((images + 1) * (r / 2)).astype(dtype), r, n, kernel)
+
+    # pvfmm lists the Chebyshev modes with the x-mode varying fastest,
+    # bring the mode axes into coordinate order (x, y, z)
+    n_modes = m + 1
+    image_results = image_results.reshape(
+        len(images), -1, n_modes, n_modes, n_modes).transpose(0, 1, 4, 3, 2)
+
+    result = np.empty((n_targets, image_results[0].size), dtype=dtype)
+    mode_ids = np.arange(n_modes)
+
+    # targets sharing (pi, sigma) are transformed together
+    sign_bits = ((sigma < 0) * np.array([1, 2, 4])).sum(axis=1)
+    group_ids = (pi[:, 0] * 3 + pi[:, 1]) * 8 + sign_bits
+    for group_id in np.unique(group_ids):
+        members = np.nonzero(group_ids == group_id)[0]
+        g_pi = pi[members[0]]
+        g_sigma = sigma[members[0]]
+
+        group_results = image_results[image_ids[members]].transpose(
+            0, 1, 2 + g_pi[0], 2 + g_pi[1], 2 + g_pi[2])
+        if symmetry_type == "vector":
+            group_results = group_results[:, g_pi] * g_sigma.reshape(
+                1, 3, 1, 1, 1)
+
+        # T_k(-x) = (-1)^k T_k(x)
+        mode_signs = np.einsum("i,j,k->ijk",
+                               g_sigma[0] ** mode_ids,
+                               g_sigma[1] ** mode_ids,
+                               g_sigma[2] ** mode_ids)
+
+        result[members] = (group_results * mode_signs).transpose(
+            0, 1, 4, 3, 2).reshape(len(members), -1)
+
+    return _translate_integ(result, kernel, translation, dtype)
+
+# }}} End cube symmetries
+
+
+def _get_out_dtype(dtype, out, out_dtype):
+    if out_dtype is None:
+        if out is None:
+            return dtype
+        return out.dtype
+    return np.dtype(out_dtype)
+
+
+def _process_kernel(kernel, dtype):
+    """Convert kernel handles to kernel handles of the given dtype, and
+    supported :mod:`sumpy` kernels to pvfmm kernels, see
+    :func:`pypvfmm.kernel.split_kernel`. Descriptor strings are passed as is.
+
+    :return: tuple (kernel, translation), with the translation of sumpy
+             kernels to apply to the results, or None
+    """
+    kernel, translation = split_kernel(kernel)
+    if not isinstance(kernel, str):
+        kernel = get_kernel_handle(kernel, dtype)
+    return kernel, translation
+
+
+def _translate_integ(result, kernel, translation, dtype, out=None):
+    """Turns :func:`integ` results of the pvfmm kernel into those of the
+    sumpy kernel, see :func:`_process_kernel`.
+    """
+    if translation is None:
+        return result
+    handle = get_kernel_handle(kernel, dtype)
+    return translation.integ_values(result, handle.src_dim, handle.trg_dim,
+                                    out=out)
+
+
+# {{{ asyncio interface
+
+_async_executor = None
+
+
+def set_async_executor(executor):
+    """Sets the executor running the computations of the ``*_async``
+    functions, e.g. a :class:`concurrent.futures.ThreadPoolExecutor` with
+    a given number of workers. The wrapped computations release the GIL, so
+    that they run concurrently with the event loop.
+
+    The computations start when the awaitables returned by the ``*_async``
+    functions are first awaited, which must be within a running event loop.
+    """
+    global _async_executor
+    _async_executor = executor
+
+
+def get_async_executor():
+    """Returns the executor set by :func:`set_async_executor`, creating a
+    :class:`concurrent.futures.ThreadPoolExecutor` on first use.
+    """
+    global _async_executor
+    if _async_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _async_executor = ThreadPoolExecutor()
+    return _async_executor
+
+
+class _ExecutorAwaitable(object):
+    """Runs a function on an executor when first awaited, on behalf of the
+    event loop running the awaiting coroutine.
+    """
+
+    def __init__(self, executor, func):
+        self.executor = executor
+        self.func = func
+        self._future = None
+
+    def __await__(self):
+        import asyncio
+
+        if self._future is None:
+            executor = self.executor
+            if executor is None:
+                executor = get_async_executor()
+            # raises outside of a running event loop
+            loop = asyncio.get_running_loop()
+            self._future = loop.run_in_executor(executor, self.func)
+
+        return self._future.__await__()
+
+
+def _run_async(executor, func, *args, **kwargs):
+    from functools import partial
+    return _ExecutorAwaitable(executor, partial(func, *args, **kwargs))
+
+
+def integ_async(m, s, r, n, kernel, out=None, out_dtype=None, executor=None):
+    """Same as :func:`integ`, but returns an awaitable, with the computation
+    running on *executor* (defaults to :func:`get_async_executor`).
+    """
+    return _run_async(executor, integ, m, s, r, n, kernel,
+                      out=out, out_dtype=out_dtype)
+
+
+def integ_batch_async(m, targets, r, n, kernel, out=None, out_dtype=None,
+                      executor=None):
+    """Same as :func:`integ_batch`, but returns an awaitable, with the
+    computation running on *executor* (defaults to
+    :func:`get_async_executor`).
+    """
+    return _run_async(executor, integ_batch, m, targets, r, n, kernel,
+                      out=out, out_dtype=out_dtype)
+
+
+def integ_symmetric_async(m, targets, r, n, kernel, decimals=12,
+                          executor=None):
+    """Same as :func:`integ_symmetric`, but returns an awaitable, with the
+    computation running on *executor* (defaults to
+    :func:`get_async_executor`).
+    """
+    return _run_async(executor, integ_symmetric, m, targets, r, n, kernel,
+                      decimals=decimals)
+
+
+def integ_adaptive_async(m, s, r, kernel, tol=1e-8, n_init=None, n_max=300,
+                         executor=None):
+    """Same as :func:`integ_adaptive`, but returns an awaitable, with the
+    computation running on *executor* (defaults to
+    :func:`get_async_executor`).
+    """
+    return _run_async(executor, integ_adaptive, m, s, r, kernel,
+                      tol=tol, n_init=n_init, n_max=n_max)
+
+# }}} End asyncio interface
+
+
+# {{{ persistent result store
+
+class IntegCache(object):
+    """Persistent on-disk store for the results of :func:`integ`.
+
+    Results are keyed by (m, s, r, n, kernel descriptor, dtype), stored as
+    ``.npy`` shards under *cache_dir*, and handed back as read-only memory
+    maps, so that cache hits do not copy any data. An index file records the
+    size of every shard, and hits mark the shard as recently used by touching
+    its modification time; once the shards take more than *max_bytes*, the
+    least recently used ones are evicted.
+
+    Shards are written atomically, so that hits read them without locking.
+    Updates to the index are serialized with a lock file, so that the store
+    can be shared by concurrent processes.
+    """
+    index_name = "index.json"
+    lock_name = "index.lock"
+
+    def __init__(self, cache_dir, max_bytes=2**30):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created by a concurrent process
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    # {{{ index management
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.cache_dir, self.lock_name), "a") as lock_file:
+            try:
+                import fcntl
+            except ImportError:
+                # no advisory locking available (e.g. on Windows)
+                fcntl = None
+
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.index_name), "r") as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".json.tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.rename(tmp_path, os.path.join(self.cache_dir, self.index_name))
+
+    def _shard_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def _evict(self, index):
+        """Remove least recently used shards until the store fits."""
+        last_used = {}
+        for key in list(index):
+            try:
+                last_used[key] = os.path.getmtime(self._shard_path(key))
+            except OSError:
+                # stale index entry
+                del index[key]
+
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=last_used.get):
+            if total <= self.max_bytes:
+                break
+            total -= index.pop(key)["size"]
+            try:
+                os.remove(self._shard_path(key))
+            except OSError:
+                pass
+
+    # }}} End index management
+
+    def key(self, m, s, r, n, kernel):
+        """Returns the cache key of an :func:`integ` call.
+        """
+        s = np.asarray(s)
+        kernel, translation = split_kernel(kernel)
+        key = (int(m), tuple(float(x) for x in s.ravel()), float(r), int(n),
+               kernel_desc(kernel), s.dtype.str)
+        if translation is not None:
+            key += tuple(translation[1:])
+        key_str = repr(key)
+        return hashlib.sha1(key_str.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the stored result as a read-only memory map, or *None*
+        if *key* is not in the store.
+        """
+        path = self._shard_path(key)
+        try:
+            result = np.load(path, mmap_mode="r")
+        except (IOError, OSError):
+            return None
+
+        try:
+            # access times are not reliable (e.g. with noatime mounts)
+            os.utime(path, None)
+        except OSError:
+            # evicted meanwhile, the memory map stays valid
+            pass
+
+        return result
+
+    def put(self, key, value):
+        """Stores *value* under *key*.
+        """
+        value = np.asarray(value)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".npy.tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, value)
+        size = os.path.getsize(tmp_path)
+
+        with self._locked():
+            os.rename(tmp_path, self._shard_path(key))
+            index = self._read_index()
+            index[key] = {"size": size}
+            self._evict(index)
+            self._write_index(index)
+
+    def clear(self):
+        """Removes all stored results.
+        """
+        with self._locked():
+            for key in self._read_index():
+                try:
+                    os.remove(self._shard_path(key))
+                except OSError:
+                    pass
+            self._write_index({})
+
+    def integ(self, m, s, r, n, kernel):
+        """Same as :func:`integ`, but served from the store when possible.
+
+        :return: read-only memory map of the stored result, both on hits and
+                 on misses
+        """
+        key = self.key(m, s, r, n, kernel)
+        result = self.get(key)
+        if result is None:
+            value = integ(m, s, r, n, kernel)
+            self.put(key, value)
+            result = self.get(key)
+            if result is None:
+                # evicted right away, e.g. larger than the whole store
+                value.flags.writeable = False
+                result = value
+        return result
+
+# }}} End persistent result store
@@ -0,0 +1,379 @@
+from __future__ import division, absolute_import, print_function
+
+__copyright__ = "Copyright (C) 2019 Xiaoyu Wei"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from pypvfmm.kernel import get_kernel_handle, split_kernel
+from pypvfmm.cheb_utils import cheb_approx
+from pypvfmm.wrapper.fmm import fmm_evaluate_double, fmm_evaluate_float
+from pypvfmm.wrapper.fmm import PointFMM_double, PointFMM_float
+from pypvfmm.wrapper.fmm import cheb_fmm_evaluate_double, cheb_fmm_evaluate_float
+
+
+def evaluate(kernel, sources, densities, targets, order=10, max_pts=100,
+             out=None):
+    """Evaluation of the kernel sums at the targets with pvfmm's particle FMM,
+    which runs in O(N) time, see :func:`pypvfmm.kernel.evaluate` for direct
+    evaluation.
+
+    pvfmm's octree spans the unit cube, into which the points are mapped.
+    The points of homogeneous kernels are scaled to fit, and the potentials
+    scaled back. The points of other kernels (e.g. Helmholtz kernels) are
+    only translated, and must fit into a box slightly smaller than the unit
+    cube.
+
+    The translation operators of each kernel and multipole order are
+    precomputed on first use, and kept for later calls.
+
+    :param kernel: str or kernel handle, may also pass supported
+                   :mod:`sumpy` kernels.
+    :param sources: numpy.array of shape (n_src, 3), source points
+    :param densities: numpy.array of shape (n_src,) or (n_src, src_dim),
+                      source densities, or of shape (n_rhs, n_src, src_dim)
+                      for several right-hand sides
+    :param targets: numpy.array of shape (n_trg, 3), target points
+    :param order: int, multipole order
+    :param max_pts: int, maximum number of points per leaf box
+    :param out: numpy.array, optional C-contiguous array to store the
+                result in
+
+    :return: numpy.array of shape (n_trg, trg_dim), or (n_trg,) for scalar
+             densities and potentials, or of shape (n_rhs, n_trg, trg_dim)
+    """
+    assert isinstance(sources, np.ndarray)
+    dtype = sources.dtype
+    kernel, translation = split_kernel(kernel)
+    kernel = get_kernel_handle(kernel, dtype)
+    densities = np.ascontiguousarray(densities, dtype=dtype)
+    targets = np.ascontiguousarray(targets, dtype=dtype)
+
+    scalar_densities = densities.ndim == 1
+    kernel_out = out
+    if translation is not None:
+        densities = translation.source_densities(densities, kernel.src_dim)
+        kernel_out = None
+
+    if dtype == np.float32:
+        result = fmm_evaluate_float(kernel, sources, densities, targets,
+                                    order, max_pts, kernel_out)
+    elif dtype == np.float64:
+        result = fmm_evaluate_double(kernel, sources, densities, targets,
+                                     order, max_pts, kernel_out)
+    else:
+        raise NotImplementedError(
+            "No fallback wrapper for dtype %s." % str(dtype))
+
+    if translation is not None:
+        result = translation.target_values(result, out=out)
+
+    if scalar_densities and result.shape[-1] == 1 and out is None:
+        return result.reshape(-1)
+    return result
+
+
+class PointFMM(object):
+    """Particle FMM with fixed sources and targets, e.g. for the matrix-vector
+    products of iterative solvers. The octree, the interaction lists and
+    the translation setup are built once; each call to :meth:`evaluate`
+    then only runs the passes of the FMM with new densities.
+
+    :param sources: numpy.array of shape (n_src, 3), source points
+    :param targets: numpy.array of shape (n_trg, 3), target points
+    :param kernel: str or kernel handle, may also pass supported
+                   :mod:`sumpy` kernels.
+    :param order: int, multipole order
+    :param max_pts: int, maximum number of points per leaf box
+
+    See :func:`evaluate` for the handling of the points.
+    """
+
+    def __init__(self, sources, targets, kernel, order=10, max_pts=100):
+        assert isinstance(sources, np.ndarray)
+        self.dtype = sources.dtype
+        kernel, self._translation = split_kernel(kernel)
+        kernel = get_kernel_handle(kernel, self.dtype)
+        targets = np.ascontiguousarray(targets, dtype=self.dtype)
+
+        if self.dtype == np.float32:
+            self._fmm = PointFMM_float(kernel, sources, targets, order, max_pts)
+        elif self.dtype == np.float64:
+            self._fmm = PointFMM_double(kernel, sources, targets, order, max_pts)
+        else:
+            raise NotImplementedError(
+                "No fallback wrapper for dtype %s." % str(self.dtype))
+
+    @property
+    def kernel(self):
+        return self._fmm.kernel
+
+    @property
+    def order(self):
+        return self._fmm.order
+
+    @property
+    def n_sources(self):
+        return self._fmm.n_sources
+
+    @property
+    def n_targets(self):
+        return self._fmm.n_targets
+
+    @property
+    def src_dim(self):
+        translation = self._translation
+        if translation is not None and translation.src_component is not None:
+            return 1
+        return self._fmm.src_dim
+
+    @property
+    def trg_dim(self):
+        translation = self._translation
+        if translation is not None and translation.trg_component is not None:
+            return 1
+        return self._fmm.trg_dim
+
+    @property
+    def shape(self):
+        """Shape of the matrix of the kernel sums."""
+        return (self.n_targets * self.trg_dim, self.n_sources * self.src_dim)
+
+    def evaluate(self, densities, out=None):
+        """Evaluates the kernel sums at the targets.
+
+        Several right-hand sides are evaluated in one call, which reuses
+        the octree and the FMM setup for each of them. They are not
+        batched: pvfmm runs the passes of the FMM once per right-hand side.
+
+        :param densities: numpy.array of shape (n_src,) or (n_src, src_dim),
+                          source densities, or of shape
+                          (n_rhs, n_src, src_dim) for several right-hand sides
+        :param out: numpy.array, optional C-contiguous array to store the
+                    result in
+
+        :return: numpy.array of shape (n_trg, trg_dim), or (n_trg,) for
+                 scalar densities and potentials, or of shape
+                 (n_rhs, n_trg, trg_dim)
+        """
+        densities = np.ascontiguousarray(densities, dtype=self.dtype)
+        scalar_densities = densities.ndim == 1
+
+        if self._translation is None:
+            result = self._fmm.evaluate(densities, out)
+        else:
+            densities = self._translation.source_densities(
+                densities, self._fmm.src_dim)
+            result = self._translation.target_values(
+                self._fmm.evaluate(densities, None), out=out)
+
+        if scalar_densities and result.shape[-1] == 1 and out is None:
+            return result.reshape(-1)
+        return result
+
+    def update_positions(self, sources, targets):
+        """Moves the sources and targets, e.g. between the time steps of a
+        particle simulation.
+
+        If every point stays inside its leaf box, the coordinates are
+        updated in the leaves of the existing octree, and only the FMM
+        setup is redone. As soon as a single point leaves its leaf box, the
+        whole octree is rebuilt. The translation operators are kept in
+        either case, and so is the map of the points into pvfmm's unit cube,
+        unless some point moves out of the unit cube.
+
+        :param sources: numpy.array of shape (n_src, 3), new source points
+        :param targets: numpy.array of shape (n_trg, 3), new target points
+
+        :return: bool, whether the octree was updated in place
+        """
+        sources = np.ascontiguousarray(sources, dtype=self.dtype)
+        targets = np.ascontiguousarray(targets, dtype=self.dtype)
+        return self._fmm.update_positions(sources, targets)
+
+    def aslinearoperator(self):
+        """Returns a :class:`scipy.sparse.linalg.LinearOperator` of shape
+        :attr:`shape`, acting on flattened densities.
+        """
+        from scipy.sparse.linalg import LinearOperator
+
+        def matvec(x):
+            densities = np.reshape(x, (self.n_sources, self.src_dim))
+            return self.evaluate(densities).reshape(-1)
+
+        def matmat(x):
+            n_rhs = x.shape[1]
+            shape = (n_rhs, self.n_sources, self.src_dim)
+            densities = np.reshape(np.transpose(x), shape)
+            return self.evaluate(densities).reshape(n_rhs, -1).T
+
+        return LinearOperator(self.shape, matvec=matvec, matmat=matmat,
+                              dtype=self.dtype)
+
+
+# {{{ volume FMM
+
+ChebFMMResult = namedtuple("ChebFMMResult", [
+    "centers", "sizes", "coeffs", "target_values"])
+
+_CHILD_OFFSETS = np.array([[x, y, z]
+                           for z in (-1, 1) for y in (-1, 1) for x in (-1, 1)])
+
+
+def _cheb_tail_mask(d):
+    """Returns the mask of the modes of total degree *d*, in pvfmm's layout
+    of Chebyshev coefficients.
+    """
+    return np.array([i + j + k == d
+                     for i in range(d + 1)
+                     for j in range(d + 1 - i)
+                     for k in range(d + 1 - i - j)])
+
+
+def _refine(fn, cheb_deg, tol, max_depth, dtype):
+    """Adaptive piecewise Chebyshev approximation of *fn* over the unit cube.
+
+    The octree is refined level by level: *fn* is called once per level, on
+    the Chebyshev nodes of all the new boxes, and the boxes whose
+    coefficients of the highest degree sum up to more than *tol* (pvfmm's
+    error estimate) are split.
+
+    :return: tuple (centers, depths, coeffs) of the leaves
+    """
+    tail = _cheb_tail_mask(cheb_deg)
+    leaf_centers, leaf_depths, leaf_coeffs = [], [], []
+
+    centers = np.full((1, 3), 0.5, dtype=dtype)
+    depth = 0
+    while len(centers):
+        coeffs = cheb_approx(fn, cheb_deg, centers, 0.5 ** depth)
+        coeffs = coeffs.reshape(len(centers), -1, coeffs.shape[-1])
+
+        if depth < max_depth:
+            refine = np.abs(coeffs[..., tail]).sum(axis=(1, 2)) > tol
+        else:
+            refine = np.zeros(len(centers), dtype=bool)
+
+        leaf_centers.append(centers[~refine])
+        leaf_depths.append(np.full((~refine).sum(), depth, dtype=np.int64))
+        leaf_coeffs.append(coeffs[~refine])
+
+        child_offsets = 0.25 * 0.5 ** depth * _CHILD_OFFSETS
+        centers = (centers[refine][:, None, :] + child_offsets).reshape(-1, 3)
+        centers = centers.astype(dtype)
+        depth += 1
+
+    return (np.concatenate(leaf_centers), np.concatenate(leaf_depths),
+            np.ascontiguousarray(np.concatenate(leaf_coeffs)))
+
+
+def cheb_fmm(fn, kernel, cheb_deg=8, tol=1e-6, order=10,
+             center=(0.5, 0.5, 0.5), size=1., targets=None, max_depth=10,
+             max_pts=100, dtype=np.float64):
+    """Evaluation of the volume potential of a density over a box with
+    pvfmm's Chebyshev FMM.
+
+    The density is first approximated by piecewise Chebyshev expansions,
+    refined adaptively level by level. *fn* is called once per level with
+    the Chebyshev nodes of all the boxes of that level, so it should be
+    vectorized. pvfmm then builds its tree from the piecewise expansion,
+    evaluated in C++.
+
+    As with :func:`evaluate`, the box is mapped to pvfmm's unit cube, which
+    is only allowed for boxes of another size than 1 if the kernel is
+    homogeneous.
+
+    :param fn: callable, taking a numpy.array of points of shape (n, 3) and
+               returning the density, of shape (n,) or (n, src_dim)
+    :param kernel: str or kernel handle, may also pass supported
+                   :mod:`sumpy` kernels.
+    :param cheb_deg: int, Chebyshev degree
+    :param tol: float, tolerance of the refinement, for the sum of the
+                absolute values of the coefficients of the highest degree
+    :param order: int, multipole order
+    :param center: the center of the box
+    :param size: float, the size of the box
+    :param targets: numpy.array of shape (n_trg, 3), optional target
+                    points inside the box
+    :param max_depth: int, maximum depth of the refinement
+    :param max_pts: int, maximum number of targets per leaf box
+    :param dtype: numpy.float32 or numpy.float64
+
+    :return: a :class:`ChebFMMResult` with the *centers* and *sizes* of the
+             leaves of pvfmm's tree, the Chebyshev coefficients *coeffs* of
+             the potential on them, of shape (n_leaves, trg_dim, n_coeffs)
+             in the layout of :func:`pypvfmm.cheb_utils.cheb_eval`, and the
+             potential at the targets, of shape (n_trg, trg_dim)
+    """
+    dtype = np.dtype(dtype)
+    kernel, translation = split_kernel(kernel)
+    kernel = get_kernel_handle(kernel, dtype)
+    center = np.asarray(center, dtype=dtype)
+    size = dtype.type(size)
+
+    if kernel.homogeneity is None:
+        if size != 1:
+            raise ValueError("The box of the non-homogeneous kernel %s "
+                             "cannot be rescaled to the unit cube."
+                             % kernel.desc)
+        potential_scale = 1
+    else:
+        potential_scale = size ** (3 + kernel.homogeneity)
+
+    def unit_fn(x):
+        values = fn(center + size * (x - 0.5))
+        if translation is not None:
+            values = translation.source_densities(values, kernel.src_dim)
+        return values
+
+    centers, depths, coeffs = _refine(unit_fn, cheb_deg, tol, max_depth,
+                                      dtype)
+
+    if targets is None:
+        targets = np.empty((0, 3), dtype=dtype)
+    targets = np.ascontiguousarray((targets - center) / size + 0.5,
+                                   dtype=dtype)
+
+    if dtype == np.float32:
+        cheb_fmm_evaluate = cheb_fmm_evaluate_float
+    elif dtype == np.float64:
+        cheb_fmm_evaluate = cheb_fmm_evaluate_double
+    else:
+        raise NotImplementedError(
+            "No fallback wrapper for dtype %s." % str(dtype))
+
+    leaf_centers, leaf_sizes, leaf_coeffs, target_values = cheb_fmm_evaluate(
+            kernel, cheb_deg, coeffs, centers, depths, targets, tol, order,
+            max_pts)
+
+    if translation is not None:
+        leaf_coeffs = translation.target_values(leaf_coeffs, axis=1)
+        target_values = translation.target_values(target_values)
+
+    return ChebFMMResult(
+            centers=center + size * (leaf_centers - 0.5),
+            sizes=size * leaf_sizes,
+            coeffs=potential_scale * leaf_coeffs,
+            target_values=potential_scale * target_values)
+
+# }}} End volume FMM
@@ -22,7 +22,16 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import threading
+from collections import namedtuple
+
 import numpy as np
+from pypvfmm.wrapper.kernel import homogeneity  # noqa: F401
+from pypvfmm.wrapper.kernel import evaluate_double, evaluate_float
+from pypvfmm.wrapper.kernel import KernelHandle_double, KernelHandle_float
+from pypvfmm.wrapper.kernel import (
+        get_kernel_handle_double, get_kernel_handle_float)
+from pypvfmm.wrapper.kernel import register_kernel_double, register_kernel_float
 
 try:
     from functools import partialmethod
@@ -48,6 +57,18 @@ class KernelBase():
         elif dtype == np.float64:
             self.dtype_str = 'double'
 
+    def params(self):
+        """Returns the list of (name, value) of the kernel parameters, which
+        are appended to the kernel descriptors.
+        """
+        return []
+
+    def handle(self, kernel_name):
+        """Returns the kernel handle of the named kernel, with the dtype of
+        this kernel container. See :func:`get_kernel_handle`.
+        """
+        return get_kernel_handle(getattr(self, kernel_name)(), self.dtype)
+
 
 class LaplaceKernel(KernelBase):
     __kernels__ = ['potential', 'gradient']
@@ -62,34 +83,455 @@ class BiotSavartKernel(KernelBase):
 
 
 class HelmholtzKernel(KernelBase):
+    """Helmholtz kernels exp(i k r) / (4 pi r), with complex densities and
+    potentials stored as (real, imaginary) pairs.
+
+    :param k: float, the wavenumber; if not given, the wavenumber built
+              into pvfmm is used.
+
+    Kernels with different wavenumbers are set up on first use and kept in
+    a bounded cache, see :func:`get_kernel_handle`.
+    """
     __kernels__ = ['potential']
 
+    def __init__(self, dtype=np.float64, k=None):
+        KernelBase.__init__(self, dtype)
+        self.k = k
+
+    def params(self):
+        if self.k is None:
+            return []
+        return [("k", self.k)]
+
 
 def add_kernels(kernel_container):
     """Add kernel bindings.
     """
     def kernel(self, kernel_name):
-        return "%s, %s" % (self.__class__.__name__, kernel_name)
+        # parameters are formatted as in the C++ code, which round trips
+        parts = ["%s, %s" % (self.__class__.__name__, kernel_name)]
+        parts.extend("%s=%.17g" % param for param in self.params())
+        return ", ".join(parts)
 
     for kernel_name in kernel_container.__kernels__:
         named_kernel = partialmethod(kernel, kernel_name=kernel_name)
         setattr(kernel_container, kernel_name, named_kernel)
 
 
-def process_sumpy_kernel(kernel):
-    """Parse sumpy kernels to feed to pvfmm.
+# {{{ sumpy kernel translation
+
+class SumpyKernelTranslation(namedtuple("SumpyKernelTranslation", [
+        "desc", "trg_component", "src_component", "scale", "dir_vec_name"])):
+    """How a :mod:`sumpy` kernel is computed with a pvfmm kernel.
+
+    The sumpy kernel equals *scale* times the *trg_component*-th potential
+    component due to the *src_component*-th density component of the
+    kernel *desc*, where a component of None stands for all components.
+    For directional target derivatives, *dir_vec_name* is the name of the
+    direction vector, with which the gradient is to be contracted at each
+    target.
     """
+
+    def handle(self, dtype=np.float64):
+        """Returns the kernel handle of *desc*, see :func:`get_kernel_handle`.
+        """
+        return get_kernel_handle(self.desc, dtype)
+
+    def is_identity(self):
+        """Returns whether the sumpy kernel is the kernel *desc* as a whole.
+        """
+        components = (self.trg_component, self.src_component,
+                      self.dir_vec_name)
+        return self.scale == 1 and all(c is None for c in components)
+
+    def source_densities(self, densities, src_dim):
+        """Returns the densities of *desc* for the densities of the sumpy
+        kernel, which have a trailing axis of length 1 or none at all.
+        """
+        if self.src_component is None:
+            return densities
+
+        densities = np.asarray(densities)
+        if densities.ndim > 1 and densities.shape[-1] == 1:
+            densities = densities[..., 0]
+        result = np.zeros(densities.shape + (src_dim,), dtype=densities.dtype)
+        result[..., self.src_component] = densities
+        return result
+
+    def target_values(self, values, axis=-1, out=None):
+        """Returns the values of the sumpy kernel for the *values* of *desc*,
+        whose potential components run along *axis*. The component axis is
+        kept, with length 1 if a single component is picked.
+        """
+        if self.trg_component is not None:
+            values = np.take(values, [self.trg_component], axis=axis)
+        if self.scale != 1:
+            values = self.scale * values
+        return _store(values, out)
+
+    def integ_values(self, values, src_dim, trg_dim, out=None):
+        """Returns the results of :func:`pypvfmm.cheb_utils.integ` for the
+        sumpy kernel, given those of *desc* along the last axis of *values*,
+        which holds the modes of each pair of density and potential
+        components (density components outermost).
+        """
+        shape = values.shape[:-1]
+        values = values.reshape(shape + (src_dim, trg_dim, -1))
+        if self.src_component is not None:
+            values = values[..., [self.src_component], :, :]
+        if self.trg_component is not None:
+            values = values[..., [self.trg_component], :]
+        if self.scale != 1:
+            values = self.scale * values
+        return _store(values.reshape(shape + (-1,)), out)
+
+
+def _store(values, out):
+    """Returns *values*, or *out* holding them if given."""
+    if out is None:
+        return values
+    np.copyto(out, np.reshape(values, out.shape))
+    return out
+
+
+_sumpy_translations = {}
+_sumpy_translations_lock = threading.Lock()
+
+
+def _sumpy_param(value, kernel_args, kernel):
+    """Returns the value of a kernel parameter, which sumpy gives either as
+    a number or as (a variable with) the name of a kernel argument.
+    """
+    name = getattr(value, "name", value)
+    if not isinstance(name, str):
+        return value
+    try:
+        return kernel_args[name]
+    except KeyError:
+        raise ValueError("The value of '%s' is needed to translate %s."
+                         % (name, repr(kernel)))
+
+
+def _translate_sumpy_kernel(kernel, kernel_args):
     if not kernel.dim == 3:
         raise ValueError("PvFMM only supports 3D kernels.")
 
-    from sumpy.kernel import DerivativeBase, LaplaceKernel
-    if isinstance(kernel, DerivativeBase):
-        if not isinstance(kernel.inner_kernel, LaplaceKernel):
+    # dispatch on class names, so that sumpy is not imported here
+    kernel_class = type(kernel).__name__
+
+    if kernel_class == "LaplaceKernel":
+        return SumpyKernelTranslation(LaplaceKernel().potential(),
+                                      None, None, 1., None)
+
+    elif kernel_class == "HelmholtzKernel":
+        k = kernel_args.get(kernel.helmholtz_k_name)
+        if kernel.allow_evanescent or isinstance(k, complex):
+            raise ValueError("PvFMM does not support complex wavenumbers.")
+        return SumpyKernelTranslation(HelmholtzKernel(k=k).potential(),
+                                      None, None, 1., None)
+
+    elif kernel_class == "StokesletKernel":
+        mu = _sumpy_param(kernel.viscosity_mu, kernel_args, kernel)
+        # sumpy's Stokeslet is -1/(8 pi mu) (I/r + d d^T/r^3)
+        return SumpyKernelTranslation(StokesKernel().velocity(),
+                                      kernel.icomp, kernel.jcomp,
+                                      -1. / mu, None)
+
+    elif kernel_class == "StressletKernel":
+        # sumpy's stresslet is 3/(4 pi) d_i d_j d_k / r^5, pvfmm's stress of a
+        # Stokeslet is the negative of it
+        return SumpyKernelTranslation(StokesKernel().stress(),
+                                      3 * kernel.icomp + kernel.jcomp,
+                                      kernel.kcomp, -1., None)
+
+    elif kernel_class in ("AxisTargetDerivative", "AxisSourceDerivative",
+                          "DirectionalTargetDerivative"):
+        if type(kernel.inner_kernel).__name__ != "LaplaceKernel":
             raise ValueError("PvFMM does not support computing derivatives of %s."
-                             % str(kernel.inner_kernel))
-        return str(kernel.inner_kernel) + ', gradient'
+                             % repr(kernel.inner_kernel))
+
+        gradient = LaplaceKernel().gradient()
+        if kernel_class == "AxisTargetDerivative":
+            return SumpyKernelTranslation(gradient, kernel.axis, None, 1., None)
+        elif kernel_class == "AxisSourceDerivative":
+            # the kernel only depends on the target minus the source
+            return SumpyKernelTranslation(gradient, kernel.axis, None, -1., None)
+        return SumpyKernelTranslation(gradient, None, None, 1.,
+                                      kernel.dir_vec_name)
+
+    raise ValueError("PvFMM does not support %s." % repr(kernel))
+
+
+def translate_sumpy_kernel(kernel, **kernel_args):
+    """Translate a :mod:`sumpy` kernel to a pvfmm kernel. Translations are
+    cached, so that repeated calls are cheap; unsupported kernels raise a
+    :exc:`ValueError`.
+
+    Supported are the 3D Laplace, Helmholtz (with real wavenumbers),
+    Stokeslet and stresslet kernels, and the target (axis or directional)
+    and source (axis) derivatives of the Laplace kernel.
+
+    :param kernel: :class:`sumpy.kernel.Kernel`
+    :param kernel_args: values of the kernel arguments, such as the
+                        Helmholtz wavenumber or the viscosity. Without a
+                        wavenumber, the Helmholtz kernel built into pvfmm is
+                        used.
+
+    :return: :class:`SumpyKernelTranslation`
+    """
+    key = (kernel, tuple(sorted(kernel_args.items())))
+
+    with _sumpy_translations_lock:
+        try:
+            return _sumpy_translations[key]
+        except KeyError:
+            pass
+
+    translation = _translate_sumpy_kernel(kernel, kernel_args)
+    with _sumpy_translations_lock:
+        return _sumpy_translations.setdefault(key, translation)
+
+
+def process_sumpy_kernel(kernel):
+    """Parse sumpy kernels to feed to pvfmm.
+
+    Only sumpy kernels that equal a pvfmm kernel as a whole are accepted,
+    others raise a :exc:`ValueError`, see :func:`split_kernel`. The
+    Helmholtz kernel uses the wavenumber built into pvfmm.
+
+    :return: str, the kernel descriptor
+    """
+    translation = translate_sumpy_kernel(kernel)
+    if not translation.is_identity():
+        raise ValueError("%s is not a pvfmm kernel as a whole, see "
+                         "split_kernel." % repr(kernel))
+    return translation.desc
+
+
+def split_kernel(kernel):
+    """Splits a kernel into the pvfmm kernel to compute with and the
+    :class:`SumpyKernelTranslation` to apply to the results, which is None
+    for pvfmm kernels and sumpy kernels that equal a pvfmm kernel.
+
+    The functions taking kernels accept supported sumpy kernels this way,
+    except for directional derivatives, whose direction vectors cannot be
+    passed to them. Kernels with arguments (e.g. the viscosity of
+    Stokeslets) are passed as their translation, see
+    :func:`translate_sumpy_kernel`.
+
+    :param kernel: str or kernel handle, a supported :mod:`sumpy` kernel,
+                   or a :class:`SumpyKernelTranslation`
+
+    :return: tuple (str or kernel handle, SumpyKernelTranslation or None)
+    """
+    if isinstance(kernel, (str,) + KERNEL_HANDLE_TYPES):
+        return kernel, None
+
+    translation = kernel
+    if not isinstance(translation, SumpyKernelTranslation):
+        translation = translate_sumpy_kernel(kernel)
+    if translation.dir_vec_name is not None:
+        raise ValueError("The direction vectors of %s cannot be passed, see "
+                         "translate_sumpy_kernel." % repr(kernel))
+
+    if translation.is_identity():
+        return translation.desc, None
+    return translation.desc, translation
+
+# }}} End sumpy kernel translation
+
+
+# {{{ kernel handles
+
+KERNEL_HANDLE_TYPES = (KernelHandle_double, KernelHandle_float)
+
+
+def get_kernel_handle(kernel, dtype=np.float64):
+    """Returns the handle of a kernel, which is initialized once and cached
+    per kernel and dtype. Kernel handles are accepted by all functions
+    taking a kernel in place of descriptor strings, and save looking up and
+    setting up the kernel on each call.
+
+    :param kernel: str, kernel information, may also pass supported
+                   :mod:`sumpy` kernels, or a kernel handle (of any dtype)
+    :param dtype: numpy.float32 or numpy.float64
+
+    :return: KernelHandle_double or KernelHandle_float
+    """
+    dtype = np.dtype(dtype)
+
+    if isinstance(kernel, KERNEL_HANDLE_TYPES):
+        if isinstance(kernel, _kernel_handle_type(dtype)):
+            return kernel
+        kernel = kernel.desc
+    elif not isinstance(kernel, str):
+        kernel = process_sumpy_kernel(kernel)
+
+    if dtype == np.float32:
+        return get_kernel_handle_float(kernel)
+    elif dtype == np.float64:
+        return get_kernel_handle_double(kernel)
+
+    raise NotImplementedError("No fallback wrapper for dtype %s." % str(dtype))
+
+
+def _kernel_handle_type(dtype):
+    if dtype == np.float32:
+        return KernelHandle_float
+    elif dtype == np.float64:
+        return KernelHandle_double
+
+    raise NotImplementedError("No fallback wrapper for dtype %s." % str(dtype))
+
+
+def kernel_desc(kernel):
+    """Returns the descriptor string of a kernel given by its descriptor,
+    its handle, or as a supported :mod:`sumpy` kernel.
+    """
+    if isinstance(kernel, KERNEL_HANDLE_TYPES):
+        return kernel.desc
+    elif isinstance(kernel, str):
+        return kernel
+    return process_sumpy_kernel(kernel)
+
+
+def kernel_family(kernel):
+    """Returns the descriptor string of a kernel without its parameters,
+    e.g. ``"HelmholtzKernel, potential"`` for
+    ``"HelmholtzKernel, potential, k=2"``.
+    """
+    parts = kernel_desc(kernel).split(", ")
+    while len(parts) > 1 and "=" in parts[-1]:
+        parts.pop()
+    return ", ".join(parts)
+
+
+_registered_kernels = set()
+
+
+def _function_address(function):
+    """Returns the address of a ctypes or cffi function pointer. Other
+    objects (addresses, PyCapsules) are passed as is.
+    """
+    import ctypes
+    if isinstance(function, ctypes._CFuncPtr):
+        return ctypes.cast(function, ctypes.c_void_p).value
+
+    try:
+        import cffi
+    except ImportError:
+        return function
+
+    ffi = cffi.FFI()
+    if isinstance(function, ffi.CData):
+        return int(ffi.cast("uintptr_t", function))
+    return function
+
+
+def register_kernel(name, function, src_dim, trg_dim, homogeneity_degree=None,
+                    dtype=np.float64):
+    """Registers a compiled kernel, which can then be used by its name (or
+    its handle) wherever a kernel is expected, and is called directly from
+    the C++ code.
+
+    The kernel function must have the C signature (with ``T`` being
+    ``double`` or ``float`` as per *dtype*)::
+
+        void kernel(const T* r_src, int src_cnt, const T* v_src, int dof,
+                    const T* r_trg, int trg_cnt, T* v_trg);
+
+    It adds the potentials of the sources at ``r_src`` (``src_cnt`` x 3),
+    with densities ``v_src`` (``src_cnt`` x ``dof`` x *src_dim*), to
+    ``v_trg`` (``trg_cnt`` x ``dof`` x *trg_dim*) at the targets ``r_trg``
+    (``trg_cnt`` x 3). It may be called from several threads at once.
+
+    Only the function address is stored, so the function (and the library
+    it comes from) must be kept alive while the kernel is in use.
+    Registered kernels take up one of the slots for runtime kernels for
+    good, see :class:`HelmholtzKernel`.
+
+    :param name: str, the kernel descriptor of the new kernel
+    :param function: ctypes or cffi function pointer, PyCapsule, or the
+                     function address as an int
+    :param src_dim: int, number of density components
+    :param trg_dim: int, number of potential components
+    :param homogeneity_degree: int, homogeneity degree of the kernel, if any
+    :param dtype: numpy.float32 or numpy.float64
+
+    :return: the kernel handle
+    """
+    dtype = np.dtype(dtype)
+    address = _function_address(function)
+
+    if dtype == np.float32:
+        handle = register_kernel_float(name, address, src_dim, trg_dim,
+                                       homogeneity_degree)
+    elif dtype == np.float64:
+        handle = register_kernel_double(name, address, src_dim, trg_dim,
+                                        homogeneity_degree)
+    else:
+        raise NotImplementedError(
+            "No fallback wrapper for dtype %s." % str(dtype))
+
+    _registered_kernels.add(name)
+    return handle
+
+
+def is_registered_kernel(kernel):
+    """Returns whether a kernel was added by :func:`register_kernel`. Such
+    kernels only exist in the process that registered them (and in its
+    forked children).
+    """
+    return kernel_desc(kernel) in _registered_kernels
+
+# }}} End kernel handles
+
+
+def evaluate(kernel, sources, densities, targets, out=None):
+    """Direct evaluation of the kernel sums at the targets, with pvfmm's
+    vectorized kernel functions, multithreaded over tiles of targets.
+
+    :param kernel: str or kernel handle, may also pass supported
+                   :mod:`sumpy` kernels.
+    :param sources: numpy.array of shape (n_src, 3), source points
+    :param densities: numpy.array of shape (n_src,) or (n_src, src_dim),
+                      source densities
+    :param targets: numpy.array of shape (n_trg, 3), target points
+    :param out: numpy.array, optional C-contiguous array to store the
+                result in
+
+    :return: numpy.array of shape (n_trg, trg_dim), or (n_trg,) for scalar
+             densities and potentials
+    """
+    assert isinstance(sources, np.ndarray)
+    dtype = sources.dtype
+    kernel, translation = split_kernel(kernel)
+    kernel = get_kernel_handle(kernel, dtype)
+    densities = np.ascontiguousarray(densities, dtype=dtype)
+    targets = np.ascontiguousarray(targets, dtype=dtype)
+
+    scalar_densities = densities.ndim == 1
+    kernel_out = out
+    if translation is not None:
+        densities = translation.source_densities(densities, kernel.src_dim)
+        kernel_out = None
+
+    if dtype == np.float32:
+        result = evaluate_float(kernel, sources, densities, targets,
+                                kernel_out)
+    elif dtype == np.float64:
+        result = evaluate_double(kernel, sources, densities, targets,
+                                 kernel_out)
+    else:
+        raise NotImplementedError(
+            "No fallback wrapper for dtype %s." % str(dtype))
+
+    if translation is not None:
+        result = translation.target_values(result, out=out)
 
-    return str(kernel)
+    if scalar_densities and result.shape[-1] == 1 and out is None:
+        return result.reshape(-1)
+    return result
 
 
 add_kernels(LaplaceKernel)
@@ -0,0 +1,240 @@
+from __future__ import division, absolute_import, print_function
+
+__copyright__ = "Copyright (C) 2019 Xiaoyu Wei"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+from pypvfmm.kernel import kernel_desc, is_registered_kernel, split_kernel
+
+
+def _save_atomic(path, value):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, value)
+    os.rename(tmp_path, path)
+
+
+def _compute_chunk(args):
+    """Worker: computes one chunk of the table and writes it to disk."""
+    from pypvfmm.cheb_utils import integ_batch
+    m, targets, r, n, kernel, out_dtype, path = args
+    _save_atomic(path, integ_batch(m, targets, r, n, kernel,
+                                   out_dtype=out_dtype))
+    return path
+
+
+class TableBuilder(object):
+    """Builds a table of :func:`pypvfmm.cheb_utils.integ` results over a set
+    of targets and box sizes, with a pool of worker processes.
+
+    The work is split into chunks of targets for each box size. Every
+    finished chunk is written to *workdir* right away, so that an
+    interrupted build resumes from the chunks already on disk. Once all
+    chunks are done, they are merged into a single ``.npy`` table of shape
+    (len(rs), len(targets), ...), which is returned as a memory map.
+
+    Each worker runs :func:`~pypvfmm.cheb_utils.integ_batch`, which is itself
+    multithreaded; set ``OMP_NUM_THREADS`` accordingly to avoid
+    oversubscribing the node. The workers receive the kernel descriptor, so
+    kernels added by :func:`~pypvfmm.kernel.register_kernel` are not
+    supported.
+
+    :param workdir: str, directory holding the chunks and the merged table
+    :param m: int, Chebyshev degree
+    :param targets: numpy.array of shape (N, 3), singular (target) points
+    :param rs: sequence of floats, box sizes
+    :param n: int, degree of the quadrature rule
+    :param kernel: str or kernel handle, see :mod:`pypvfmm.kernel`,
+                   may also pass supported :mod:`sumpy` kernels.
+    :param chunk_size: int, number of targets per chunk
+    :param out_dtype: dtype of the table, see
+                      :func:`~pypvfmm.cheb_utils.integ`
+    """
+    manifest_name = "manifest.json"
+    table_name = "table.npy"
+
+    def __init__(self, workdir, m, targets, rs, n, kernel,
+                 chunk_size=1024, out_dtype=None):
+        assert isinstance(targets, np.ndarray)
+        assert targets.ndim == 2 and targets.shape[1] == 3
+
+        self.workdir = os.path.abspath(workdir)
+        self.m = m
+        self.targets = np.ascontiguousarray(targets)
+        self.rs = [float(r) for r in rs]
+        if len(self.targets) == 0 or len(self.rs) == 0:
+            raise ValueError("The table should have at least one target "
+                             "and one box size.")
+        self.n = n
+        # descriptors (and translations of sumpy kernels), unlike kernel
+        # handles, can be sent to the workers, which know all kernels but
+        # registered ones (unless forked)
+        pvfmm_kernel, self.translation = split_kernel(kernel)
+        if is_registered_kernel(pvfmm_kernel):
+            raise ValueError("Registered kernels are not available in the "
+                             "worker processes: %s." % kernel_desc(pvfmm_kernel))
+        self.kernel = kernel_desc(pvfmm_kernel)
+        self.chunk_size = chunk_size
+        if out_dtype is None:
+            out_dtype = targets.dtype
+        self.out_dtype = np.dtype(out_dtype)
+
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        self._check_manifest()
+
+    @property
+    def table_path(self):
+        return os.path.join(self.workdir, self.table_name)
+
+    def _manifest(self):
+        manifest = {
+                "m": self.m,
+                "targets_sha1": hashlib.sha1(self.targets.tobytes()).hexdigest(),
+                "n_targets": len(self.targets),
+                "dtype": self.targets.dtype.str,
+                "rs": self.rs,
+                "n": self.n,
+                "kernel": self.kernel,
+                "chunk_size": self.chunk_size,
+                "out_dtype": self.out_dtype.str,
+                }
+        if self.translation is not None:
+            manifest["translation"] = list(self.translation[1:])
+        return manifest
+
+    def _check_manifest(self):
+        """Makes sure that existing checkpoints belong to the same table."""
+        manifest_path = os.path.join(self.workdir, self.manifest_name)
+        manifest = self._manifest()
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                if json.load(f) != manifest:
+                    raise ValueError("%s holds checkpoints of a different table."
+                                     % self.workdir)
+        else:
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f)
+
+    def chunk_path(self, ir, ichunk):
+        return os.path.join(self.workdir, "chunk_%d_%d.npy" % (ir, ichunk))
+
+    def chunks(self):
+        """Returns the list of (box size index, chunk index) of all chunks."""
+        n_chunks = -(-len(self.targets) // self.chunk_size)
+        return [(ir, ichunk)
+                for ir in range(len(self.rs)) for ichunk in range(n_chunks)]
+
+    def pending_chunks(self):
+        """Returns the chunks that are not on disk yet."""
+        return [chunk for chunk in self.chunks()
+                if not os.path.exists(self.chunk_path(*chunk))]
+
+    def build(self, max_workers=None):
+        """Computes all pending chunks and merges them into the table.
+
+        :param max_workers: int, number of worker processes, defaults to
+                            the number of processors
+
+        :return: numpy.memmap, the merged table (read-only)
+        """
+        if os.path.exists(self.table_path):
+            return np.load(self.table_path, mmap_mode="r")
+
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        kernel = self.kernel
+        if self.translation is not None:
+            kernel = self.translation
+
+        tasks = [(self.m,
+                  self.targets[ichunk * self.chunk_size:
+                               (ichunk + 1) * self.chunk_size],
+                  self.rs[ir], self.n, kernel, self.out_dtype,
+                  self.chunk_path(ir, ichunk))
+                 for ir, ichunk in self.pending_chunks()]
+
+        if tasks:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(_compute_chunk, task)
+                           for task in tasks]
+                for future in as_completed(futures):
+                    # re-raise errors of the workers
+                    future.result()
+
+        return self.merge()
+
+    def merge(self, keep_chunks=False):
+        """Merges the chunks into the table.
+
+        :param keep_chunks: bool, whether to keep the chunk files after
+                            merging
+
+        :return: numpy.memmap, the merged table (read-only)
+        """
+        pending = self.pending_chunks()
+        if pending:
+            raise RuntimeError("%d chunks are not computed yet." % len(pending))
+
+        first_chunk = np.load(self.chunk_path(0, 0), mmap_mode="r")
+        shape = (len(self.rs), len(self.targets)) + first_chunk.shape[1:]
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.workdir, suffix=".tmp")
+        os.close(fd)
+        table = np.lib.format.open_memmap(tmp_path, mode="w+",
+                                          dtype=self.out_dtype, shape=shape)
+        for ir, ichunk in self.chunks():
+            chunk = np.load(self.chunk_path(ir, ichunk), mmap_mode="r")
+            start = ichunk * self.chunk_size
+            table[ir, start:start + len(chunk)] = chunk
+        table.flush()
+        del table
+        os.rename(tmp_path, self.table_path)
+
+        if not keep_chunks:
+            for chunk in self.chunks():
+                os.remove(self.chunk_path(*chunk))
+
+        return np.load(self.table_path, mmap_mode="r")
+
+    def clear(self):
+        """Removes the work directory, including the merged table."""
+        shutil.rmtree(self.workdir)
+
+
+def build_table(workdir, m, targets, rs, n, kernel, chunk_size=1024,
+                out_dtype=None, max_workers=None):
+    """Builds (or resumes building) a table of
+    :func:`pypvfmm.cheb_utils.integ` results, see :class:`TableBuilder`.
+
+    :return: numpy.memmap of shape (len(rs), len(targets), ...), the table
+    """
+    builder = TableBuilder(workdir, m, targets, rs, n, kernel,
+                           chunk_size=chunk_size, out_dtype=out_dtype)
+    return builder.build(max_workers=max_workers)
@@ -49,30 +49,502 @@ namespace pypvfmm{
     }
 
 
+  // Number of values returned by pvfmm::integ for a single target:
+  // (m+1)^3 Chebyshev modes for each kernel component.
   template <class T>
+    ssize_t integ_size(int m, const pvfmm::Kernel<T> &kernel){
+      return (m + 1) * (m + 1) * (m + 1)
+        * kernel.ker_dim[0] * kernel.ker_dim[1];
+    }
+
+
+  // Same as cheb_poly, but for an input array of any shape and strides.
+  // The result has shape (d+1, *in.shape), and is stored into out if given.
+  template <class T>
+    pybind11::array cheb_poly_nd(
+        int d,
+        pybind11::array_t<T> in,
+        pybind11::object out){
+      if ( d < 0 )
+        throw std::runtime_error("d should be non-negative");
+
+      const ssize_t ndim = in.ndim();
+      const ssize_t n = in.size();
+      std::vector<ssize_t> shape(in.shape(), in.shape() + ndim);
+      std::vector<ssize_t> strides(in.strides(), in.strides() + ndim);
+
+      std::vector<ssize_t> result_shape = {d + 1};
+      result_shape.insert(result_shape.end(), shape.begin(), shape.end());
+
+      auto result = prepare_output<T>(out, result_shape);
+      if ( result.ndim() != ndim + 1
+          || !std::equal(result_shape.begin(), result_shape.end(),
+                         result.shape()) )
+        throw std::runtime_error("out should be of shape (d+1, *in.shape)");
+
+      const char* in_ptr = (const char*) in.data();
+      T* out_ptr = result.mutable_data();
+
+      {
+        pybind11::gil_scoped_release release;
+
+        #pragma omp parallel for schedule(static) if (n > 4096)
+        for (ssize_t i = 0; i < n; ++i) {
+          // byte offset of the i-th entry in C order
+          ssize_t offset = 0;
+          for (ssize_t k = ndim - 1, idx = i; k >= 0; --k) {
+            offset += (idx % shape[k]) * strides[k];
+            idx /= shape[k];
+          }
+          T x = *((const T*) (in_ptr + offset));
+
+          // same as pvfmm::cheb_poly, points outside [-1, 1] give zeros
+          bool inside = (std::abs(x) <= 1);
+          if ( !inside ) x = 0;
+          T y0 = inside ? 1 : 0;
+          T y1 = x;
+
+          out_ptr[i] = y0;
+          if ( d > 0 )
+            out_ptr[n + i] = y1;
+          for (int j = 2; j <= d; ++j) {
+            T y2 = 2 * x * y1 - y0;
+            out_ptr[j * n + i] = y2;
+            y0 = y1;
+            y1 = y2;
+          }
+        }
+      }
+
+      return result;
+    }
+
+
+  // Number of coefficients of a 3D Chebyshev expansion of degree d.
+  inline ssize_t cheb_coeff_count(int d){
+    return (d + 1) * (d + 2) * (d + 3) / 6;
+  }
+
+
+  // Evaluates the Chebyshev expansion with dof components (coeffs of
+  // shape (dof, n_coeffs)) at the point x of the local coordinates of its
+  // box. p holds 3 * (d + 1) values of scratch space.
+  template <class T>
+    void cheb_eval_point(int d, const T* coeffs, ssize_t dof, const T* x,
+        T* p, T* out){
+      for (int dim = 0; dim < 3; ++dim) {
+        T* p_dim = &p[dim * (d + 1)];
+        p_dim[0] = 1;
+        if ( d > 0 ) p_dim[1] = x[dim];
+        for (int k = 2; k <= d; ++k)
+          p_dim[k] = 2 * x[dim] * p_dim[k - 1] - p_dim[k - 2];
+      }
+      const T* px = &p[0];
+      const T* py = &p[d + 1];
+      const T* pz = &p[2 * (d + 1)];
+
+      const T* c = coeffs;
+      for (ssize_t l = 0; l < dof; ++l) {
+        T val = 0;
+        for (int i = 0; i <= d; ++i)
+          for (int j = 0; i + j <= d; ++j) {
+            T val_k = 0;
+            for (int k = 0; i + j + k <= d; ++k)
+              val_k += (*c++) * px[k];
+            val += val_k * py[j] * pz[i];
+          }
+        out[l] = val;
+      }
+    }
+
+
+  // Finds the box containing a point, among boxes that are the leaves of an
+  // octree: cubes of sizes h / 2^depth (h being the largest size) that lie
+  // on the grid of their size. The boxes are looked up by their depth and
+  // integer coordinates, packed into a key of 4 + 3 * 20 bits.
+  template <class T>
+    class BoxLocator {
+      public:
+        static constexpr int max_depth = 15;
+        static constexpr int64_t max_index = int64_t(1) << 20;
+
+        BoxLocator(const T* centers, const T* sizes, ssize_t n_boxes)
+          : m_width(0) {
+          if ( n_boxes == 0 )
+            return;
+
+          // the lower corner of a largest box lies on every grid
+          ssize_t ilargest = 0;
+          for (ssize_t ibox = 0; ibox < n_boxes; ++ibox)
+            if ( sizes[ibox] > sizes[ilargest] )
+              ilargest = ibox;
+          m_width = sizes[ilargest];
+
+          // shift the origin by whole boxes, so that indices are nonnegative
+          for (int k = 0; k < 3; ++k) {
+            T lowest = centers[3 * ilargest + k];
+            for (ssize_t ibox = 0; ibox < n_boxes; ++ibox)
+              lowest = std::min(lowest,
+                  centers[3 * ibox + k] - sizes[ibox] / 2);
+            const T ref = centers[3 * ilargest + k] - m_width / 2;
+            m_origin[k] = ref - m_width * std::ceil((ref - lowest) / m_width);
+          }
+
+          const T tol = std::sqrt(std::numeric_limits<T>::epsilon());
+          for (ssize_t ibox = 0; ibox < n_boxes; ++ibox) {
+            const int depth = (int) std::lround(
+                std::log2(m_width / sizes[ibox]));
+            const T size = std::ldexp(m_width, -depth);
+            if ( depth < 0 || depth > max_depth
+                || std::abs(sizes[ibox] - size) > tol * size )
+              throw std::runtime_error(
+                  "the boxes are not the leaves of an octree");
+
+            int64_t index[3];
+            for (int k = 0; k < 3; ++k) {
+              const T t = (centers[3 * ibox + k] - m_origin[k]) / size - T(0.5);
+              index[k] = std::llround(t);
+              if ( std::abs(t - index[k]) > tol || index[k] >= max_index )
+                throw std::runtime_error(
+                    "the boxes are not the leaves of an octree");
+            }
+
+            if ( !m_boxes.emplace(key(depth, index), ibox).second )
+              throw std::runtime_error("the boxes overlap");
+            if ( std::find(m_depths.begin(), m_depths.end(), depth)
+                == m_depths.end() )
+              m_depths.push_back(depth);
+          }
+          std::sort(m_depths.begin(), m_depths.end());
+        }
+
+        // Returns the index of the box containing x, or -1 if there is
+        // none. Points on the faces shared by boxes may go to either box.
+        ssize_t find(const T* x) const {
+          for (int depth : m_depths) {
+            const T size = std::ldexp(m_width, -depth);
+
+            // a point on a grid plane is also tried in the cell below it
+            int64_t lo[3], hi[3];
+            for (int k = 0; k < 3; ++k) {
+              const T t = (x[k] - m_origin[k]) / size;
+              hi[k] = (int64_t) std::floor(t);
+              lo[k] = (int64_t) std::ceil(t) - 1;
+            }
+
+            for (int corner = 0; corner < 8; ++corner) {
+              int64_t index[3];
+              bool valid = true;
+              for (int k = 0; k < 3; ++k) {
+                index[k] = (corner >> k) & 1 ? lo[k] : hi[k];
+                valid = valid && index[k] >= 0 && index[k] < max_index;
+              }
+              if ( !valid )
+                continue;
+
+              auto query = m_boxes.find(key(depth, index));
+              if ( query != m_boxes.end() )
+                return query->second;
+            }
+          }
+          return -1;
+        }
+
+      private:
+        static uint64_t key(int depth, const int64_t* index) {
+          return (uint64_t(depth) << 60) | (uint64_t(index[0]) << 40)
+            | (uint64_t(index[1]) << 20) | uint64_t(index[2]);
+        }
+
+        T m_width;
+        T m_origin[3];
+        std::vector<int> m_depths;
+        std::unordered_map<uint64_t, ssize_t> m_boxes;
+    };
+
+
+  // Evaluates the 3D Chebyshev expansions of many boxes at once. Target p is
+  // evaluated with the expansion of box box_ids[p], in the local coordinates
+  // 2 * (x - center) / size of that box. If box_ids is None, the boxes must
+  // be the leaves of an octree, and each target is evaluated with the box
+  // containing it.
+  //
+  // Coefficients use pvfmm's layout: for each dof, the modes (i, j, k) with
+  // i + j + k <= d, i outermost, where k is the x-, j the y- and i the z-mode.
+  template <class T>
+    pybind11::array cheb_eval(
+        int d,
+        pybind11::array_t<T, pybind11::array::c_style> coeffs,
+        pybind11::array_t<T, pybind11::array::c_style> centers,
+        pybind11::array_t<T, pybind11::array::c_style> sizes,
+        pybind11::array_t<T, pybind11::array::c_style> targets,
+        pybind11::object box_ids,
+        pybind11::object out){
+      const ssize_t n_coeffs = cheb_coeff_count(d);
+
+      // check input dimensions
+      if ( coeffs.ndim() != 3 || coeffs.shape(2) != n_coeffs )
+        throw std::runtime_error(
+            "coeffs should be a NumPy array of shape (n_boxes, dof, n_coeffs)");
+      const ssize_t n_boxes = coeffs.shape(0);
+      const ssize_t dof = coeffs.shape(1);
+
+      if ( centers.ndim() != 2 || centers.shape(0) != n_boxes
+          || centers.shape(1) != 3 )
+        throw std::runtime_error(
+            "centers should be a NumPy array of shape (n_boxes, 3)");
+      if ( sizes.ndim() != 1 || sizes.shape(0) != n_boxes )
+        throw std::runtime_error(
+            "sizes should be a NumPy array of shape (n_boxes,)");
+      if ( targets.ndim() != 2 || targets.shape(1) != 3 )
+        throw std::runtime_error(
+            "targets should be a NumPy array of shape (n_pts, 3)");
+      const ssize_t n_pts = targets.shape(0);
+
+      const T* coeffs_ptr = coeffs.data();
+      const T* centers_ptr = centers.data();
+      const T* sizes_ptr = sizes.data();
+      const T* targets_ptr = targets.data();
+
+      // either the given box of each target, or a lookup of the boxes
+      pybind11::array_t<int64_t, pybind11::array::c_style> box_ids_arr;
+      const int64_t* box_ids_ptr = nullptr;
+      std::unique_ptr<BoxLocator<T>> locator;
+      if ( box_ids.is_none() ) {
+        locator.reset(new BoxLocator<T>(centers_ptr, sizes_ptr, n_boxes));
+      } else {
+        box_ids_arr = pybind11::array_t<int64_t,
+                    pybind11::array::c_style>::ensure(box_ids);
+        if ( !box_ids_arr || box_ids_arr.ndim() != 1
+            || box_ids_arr.shape(0) != n_pts )
+          throw std::runtime_error(
+              "box_ids should be a NumPy array of shape (n_pts,)");
+
+        box_ids_ptr = box_ids_arr.data();
+        for (ssize_t ipt = 0; ipt < n_pts; ++ipt)
+          if ( box_ids_ptr[ipt] < 0 || box_ids_ptr[ipt] >= n_boxes )
+            throw std::runtime_error("box_ids out of range");
+      }
+
+      auto result = prepare_output<T>(out, {n_pts, dof});
+      T* result_ptr = result.mutable_data();
+
+      {
+        pybind11::gil_scoped_release release;
+
+        OMPExceptions exceptions;
+        #pragma omp parallel
+        {
+          // Chebyshev polynomials in x, y and z
+          std::vector<T> p(3 * (d + 1));
+
+          #pragma omp for schedule(static)
+          for (ssize_t ipt = 0; ipt < n_pts; ++ipt) {
+            const T* target = targets_ptr + 3 * ipt;
+            const ssize_t ibox = box_ids_ptr ? box_ids_ptr[ipt]
+              : locator->find(target);
+            if ( ibox < 0 ) {
+              exceptions.run([&](){
+                  throw std::runtime_error(
+                      "target " + std::to_string(ipt) + " is not in any box");
+                  });
+              continue;
+            }
+
+            T x[3];
+            for (int dim = 0; dim < 3; ++dim)
+              x[dim] = 2 * (target[dim] - centers_ptr[3 * ibox + dim])
+                / sizes_ptr[ibox];
+
+            cheb_eval_point(d, coeffs_ptr + ibox * dof * n_coeffs, dof,
+                x, &p[0], result_ptr + ipt * dof);
+          }
+        }
+        exceptions.rethrow();
+      }
+
+      return result;
+    }
+
+
+  // Matrix of pvfmm::cheb_approx, mapping the values at the (d+1)^3
+  // Chebyshev nodes (x fastest) to the Chebyshev coefficients, with shape
+  // ((d+1)^3, n_coeffs). Fitting many boxes then takes one matrix product.
+  template <class T>
+    pybind11::array cheb_approx_matrix(int d){
+      if ( d < 0 )
+        throw std::runtime_error("d should be non-negative");
+
+      const ssize_t n_nodes = (d + 1) * (d + 1) * (d + 1);
+      const ssize_t n_coeffs = cheb_coeff_count(d);
+
+      // approximate the indicator function of every node at once,
+      // one per degree of freedom
+      std::vector<T> fn_v(n_nodes * n_nodes, 0);
+      for (ssize_t i = 0; i < n_nodes; ++i)
+        fn_v[i * n_nodes + i] = 1;
+      std::vector<T> M(n_nodes * n_coeffs);
+
+      {
+        pybind11::gil_scoped_release release;
+        pvfmm::cheb_approx<T, T>(&fn_v[0], d, n_nodes, &M[0]);
+      }
+
+      return vector_to_array(std::move(M)).reshape({n_nodes, n_coeffs});
+    }
+
+
+  // Matrix of pvfmm::cheb_diff along diff_dim (0, 1, 2 for x, y, z), with
+  // shape (n_coeffs, n_coeffs), so that the coefficients of the derivative
+  // are coeffs @ D. Derivatives are w.r.t. the coordinates of the unit box.
+  template <class T>
+    pybind11::array cheb_diff_matrix(int d, int diff_dim){
+      if ( d < 0 )
+        throw std::runtime_error("d should be non-negative");
+      if ( diff_dim < 0 || diff_dim > 2 )
+        throw std::runtime_error("diff_dim should be 0, 1 or 2");
+
+      const ssize_t n_coeffs = cheb_coeff_count(d);
+
+      // differentiate every mode at once, one per degree of freedom
+      pvfmm::Vector<T> A(n_coeffs * n_coeffs);
+      pvfmm::Vector<T> B(n_coeffs * n_coeffs);
+      A.SetZero();
+      for (ssize_t i = 0; i < n_coeffs; ++i)
+        A[i * n_coeffs + i] = 1;
+
+      {
+        pybind11::gil_scoped_release release;
+        pvfmm::cheb_diff<T>(A, d, diff_dim, B);
+      }
+
+      std::vector<T> D(&B[0], &B[0] + n_coeffs * n_coeffs);
+      return vector_to_array(std::move(D)).reshape({n_coeffs, n_coeffs});
+    }
+
+
+  // Computes in T and returns the result as Tout, so that e.g. the
+  // quadrature can run in double precision while emitting float results.
+  template <class T, class Tout = T>
     pybind11::array integ(
         int m,
         pybind11::array_t<T, pybind11::array::c_style> s,
-        T r, int n, const std::string &kernel_desc){
+        T r, int n, pybind11::object kernel_spec,
+        pybind11::object out){
 
-      auto kernel = get_kernel<T>(kernel_desc);
+      auto handle = resolve_kernel<T>(kernel_spec);
+      const pvfmm::Kernel<T> &kernel = handle->kernel();
 
       auto sbuf = s.request();
       T* s_ptr = (T*) sbuf.ptr;
 
-      std::vector<T> U = pvfmm::integ<T>(m, s_ptr, r, n, kernel);
-
-      constexpr int Udim = 1;
-      const std::array<size_t, Udim> Ushape = {U.size()};
-      const std::array<size_t, Udim> Ustrides = {sizeof(T)};
-      
-      return pybind11::array(
-          pybind11::buffer_info(U.data(),
-            sizeof(T), pybind11::format_descriptor<T>::value,
-            Udim, Ushape, Ustrides)
-          );
+      std::vector<T> U;
+      {
+        pybind11::gil_scoped_release release;
+        U = pvfmm::integ<T>(m, s_ptr, r, n, kernel);
+      }
+
+      return store_result<Tout>(std::move(U), out);
+    }
+
+
+  // Evaluates integ for n_targets targets into result (n_targets x Usize).
+  // Must be called with the GIL released.
+  template <class T, class Tout>
+    void integ_targets(
+        int m, T* s_ptr, ssize_t n_targets, T r, int n,
+        const pvfmm::Kernel<T> &kernel, Tout* result_ptr){
+      const ssize_t Usize = integ_size(m, kernel);
+
+      OMPExceptions exceptions;
+      #pragma omp parallel for schedule(dynamic)
+      for (ssize_t i = 0; i < n_targets; ++i) {
+        exceptions.run([&](){
+            std::vector<T> U = pvfmm::integ<T>(m, s_ptr + 3 * i, r, n, kernel);
+            std::copy(U.begin(), U.end(), result_ptr + i * Usize);
+            });
+      }
+      exceptions.rethrow();
+    }
+
+
+  template <class T, class Tout = T>
+    pybind11::array integ_batch(
+        int m,
+        pybind11::array_t<T, pybind11::array::c_style> targets,
+        T r, int n, pybind11::object kernel_spec,
+        pybind11::object out){
+      // check input dimensions
+      if ( targets.ndim() != 2 || targets.shape(1) != 3 )
+        throw std::runtime_error("targets should be a NumPy array of shape (N, 3)");
+
+      // the handle's kernel is fully set up, so it can be shared by threads
+      auto handle = resolve_kernel<T>(kernel_spec);
+      const pvfmm::Kernel<T> &kernel = handle->kernel();
+
+      const ssize_t n_targets = targets.shape(0);
+      T* s_ptr = (T*) targets.request().ptr;
+
+      auto result = prepare_output<Tout>(
+          out, {n_targets, integ_size(m, kernel)});
+      Tout* result_ptr = (Tout*) result.request().ptr;
+
+      {
+        pybind11::gil_scoped_release release;
+        integ_targets(m, s_ptr, n_targets, r, n, kernel, result_ptr);
+      }
+
+      return result;
     }
 
 
+  // Raises the quadrature degree, starting from n_init, until the results
+  // of two successive degrees agree to tol (relative to the largest entry).
+  // Returns the last result, its quadrature degree and whether tol was met.
+  template <class T>
+    pybind11::tuple integ_adaptive(
+        int m,
+        pybind11::array_t<T, pybind11::array::c_style> s,
+        T r, pybind11::object kernel_spec,
+        T tol, int n_init, int n_max){
+      if ( s.size() != 3 )
+        throw std::runtime_error("s should hold 3 values");
+
+      auto handle = resolve_kernel<T>(kernel_spec);
+      const pvfmm::Kernel<T> &kernel = handle->kernel();
+
+      T* s_ptr = (T*) s.request().ptr;
+
+      int n = n_init;
+      bool converged = false;
+      std::vector<T> U;
+      {
+        pybind11::gil_scoped_release release;
+
+        U = pvfmm::integ<T>(m, s_ptr, r, n, kernel);
+        while (n < n_max) {
+          // same growth rate as pvfmm::cheb_integ
+          int n_next = std::min(n_max,
+              std::max(n + 1, (int) std::round(n * 1.3)));
+          std::vector<T> U_next = pvfmm::integ<T>(m, s_ptr, r, n_next, kernel);
+
+          T err = 0, scale = 0;
+          for (size_t i = 0; i < U.size(); ++i) {
+            err = std::max(err, std::abs(U_next[i] - U[i]));
+            scale = std::max(scale, std::abs(U_next[i]));
+          }
+
+          U = std::move(U_next);
+          n = n_next;
+          if (err <= tol * scale) {
+            converged = true;
+            break;
+          }
+        }
+      }
+
+      return pybind11::make_tuple(vector_to_array(std::move(U)), n, converged);
+    }
+
 
 } // end of namespace pypvfmm
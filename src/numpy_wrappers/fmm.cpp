@@ -0,0 +1,721 @@
+/* ---------------------------------------------------------------------
+**
+** Copyright (C) 2019 Xiaoyu Wei
+**
+** Permission is hereby granted, free of charge, to any person obtaining a copy
+** of this software and associated documentation files (the "Software"), to deal
+** in the Software without restriction, including without limitation the rights
+** to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+** copies of the Software, and to permit persons to whom the Software is
+** furnished to do so, subject to the following conditions:
+** 
+** The above copyright notice and this permission notice shall be included in
+** all copies or substantial portions of the Software.
+** 
+** THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+** IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+** FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+** AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+** LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+** OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+** THE SOFTWARE.
+**
+** -------------------------------------------------------------------*/
+
+
+
+namespace pypvfmm{
+
+  // {{{ mpi
+
+  // Finalizes MPI at exit if the wrapper initialized it (defined below the
+  // translation operators, which it releases first).
+  inline void finalize_mpi();
+
+  // pvfmm works on MPI communicators. The wrapper runs each FMM on a single
+  // process, and initializes MPI on first use unless it is already
+  // initialized (e.g. by mpi4py). FMMs are run from any thread, several at
+  // a time, with the GIL released, which needs MPI_THREAD_MULTIPLE.
+  inline MPI_Comm &fmm_comm() {
+    static std::once_flag flag;
+    static int provided;
+    std::call_once(flag, [](){
+        int initialized;
+        MPI_Initialized(&initialized);
+        if (!initialized) {
+          MPI_Init_thread(NULL, NULL, MPI_THREAD_MULTIPLE, &provided);
+          std::atexit(finalize_mpi);
+        }
+        MPI_Query_thread(&provided);
+        });
+
+    if (provided < MPI_THREAD_MULTIPLE)
+      throw std::runtime_error(
+          "The FMM needs MPI initialized with MPI_THREAD_MULTIPLE.");
+
+    static MPI_Comm comm = MPI_COMM_SELF;
+    return comm;
+  }
+
+  // }}} End mpi
+
+  // {{{ translation operators
+
+  template <class T>
+    void initialize_fmm(pvfmm::PtFMM<T> &fmm, int order, int cheb_deg,
+        const pvfmm::Kernel<T> &kernel) {
+      fmm.Initialize(order, fmm_comm(), &kernel);
+    }
+
+  template <class T>
+    void initialize_fmm(pvfmm::ChebFMM<T> &fmm, int order, int cheb_deg,
+        const pvfmm::Kernel<T> &kernel) {
+      fmm.Initialize(order, cheb_deg, fmm_comm(), &kernel);
+    }
+
+  // The translation operators of the FMM for a kernel, multipole order and
+  // (for volume FMMs) Chebyshev degree. They are precomputed once and
+  // shared by all the trees using them; pvfmm works in their buffers when
+  // setting up and evaluating a tree, which is thus done while holding
+  // the mutex.
+  template <class T, class FMM>
+    class FMMMatrices {
+      public:
+        FMMMatrices(std::shared_ptr<KernelHandle<T>> handle, int order,
+            int cheb_deg)
+          : m_handle(handle), m_order(order), m_cheb_deg(cheb_deg) {
+          initialize_fmm(m_fmm, order, cheb_deg, m_handle->kernel());
+        }
+
+        FMMMatrices(const FMMMatrices &) = delete;
+        FMMMatrices &operator=(const FMMMatrices &) = delete;
+
+        const std::shared_ptr<KernelHandle<T>> &handle() const {
+          return m_handle;
+        }
+
+        int order() const { return m_order; }
+
+        int cheb_deg() const { return m_cheb_deg; }
+
+        FMM &fmm() { return m_fmm; }
+
+        std::mutex &mutex() { return m_mutex; }
+
+      private:
+        std::shared_ptr<KernelHandle<T>> m_handle;
+        int m_order;
+        int m_cheb_deg;
+        FMM m_fmm;
+        std::mutex m_mutex;
+    };
+
+  // Translation operators, created on first use. The least recently used
+  // ones are dropped once there are more than max_entries of them, and
+  // they are no longer referenced outside of the cache.
+  template <class T, class FMM>
+    class FMMMatricesCache {
+      public:
+        static constexpr size_t max_entries = 8;
+
+        static FMMMatricesCache &instance() {
+          static FMMMatricesCache cache;
+          return cache;
+        }
+
+        std::shared_ptr<FMMMatrices<T, FMM>> get(
+            const std::shared_ptr<KernelHandle<T>> &handle, int order,
+            int cheb_deg = 0) {
+          std::lock_guard<std::mutex> lock(m_mutex);
+
+          for (auto it = m_entries.begin(); it != m_entries.end(); ++it)
+            if ((*it)->handle() == handle && (*it)->order() == order
+                && (*it)->cheb_deg() == cheb_deg) {
+              m_entries.splice(m_entries.begin(), m_entries, it);
+              return *it;
+            }
+
+          auto matrices = std::make_shared<FMMMatrices<T, FMM>>(
+              handle, order, cheb_deg);
+          m_entries.push_front(matrices);
+
+          for (auto it = m_entries.rbegin();
+              m_entries.size() > max_entries && it != m_entries.rend(); )
+            if (it->use_count() == 1)
+              it = decltype(it)(m_entries.erase(std::next(it).base()));
+            else
+              ++it;
+
+          return matrices;
+        }
+
+        // Drops all cached operators; those still in use stay alive.
+        void clear() {
+          std::lock_guard<std::mutex> lock(m_mutex);
+          m_entries.clear();
+        }
+
+      private:
+        std::mutex m_mutex;
+        std::list<std::shared_ptr<FMMMatrices<T, FMM>>> m_entries;
+    };
+
+  // finalize_mpi is registered with atexit after the caches were created,
+  // so it runs before their destructors; the operators are released here
+  // while MPI is still available.
+  inline void finalize_mpi() {
+    FMMMatricesCache<float, pvfmm::PtFMM<float>>::instance().clear();
+    FMMMatricesCache<double, pvfmm::PtFMM<double>>::instance().clear();
+    FMMMatricesCache<float, pvfmm::ChebFMM<float>>::instance().clear();
+    FMMMatricesCache<double, pvfmm::ChebFMM<double>>::instance().clear();
+
+    int finalized;
+    MPI_Finalized(&finalized);
+    if (!finalized)
+      MPI_Finalize();
+  }
+
+  // }}} End translation operators
+
+  // {{{ point FMM
+
+  // Maps the points into the unit cube, where the octree of pvfmm lives:
+  // x -> (x - center) * scale + 1/2. Scaling is only allowed for
+  // homogeneous kernels, K(scale r) = scale^degree K(r), so that the
+  // potentials are recovered by a factor of scale^-degree. The points of
+  // other kernels are only translated, and must fit into the unit cube.
+  template <class T>
+    struct UnitCubeMap {
+      T center[3];
+      T scale;
+      T potential_scale;
+
+      UnitCubeMap(const T* sources, ssize_t n_src,
+          const T* targets, ssize_t n_trg, const KernelHandle<T> &handle) {
+        T lo[3], hi[3];
+        for (int k = 0; k < 3; ++k) {
+          lo[k] = std::numeric_limits<T>::max();
+          hi[k] = std::numeric_limits<T>::lowest();
+        }
+        for (const auto &points : {std::make_pair(sources, n_src),
+            std::make_pair(targets, n_trg)})
+          for (ssize_t i = 0; i < points.second; ++i)
+            for (int k = 0; k < 3; ++k) {
+              lo[k] = std::min(lo[k], points.first[3 * i + k]);
+              hi[k] = std::max(hi[k], points.first[3 * i + k]);
+            }
+
+        T extent = 0;
+        for (int k = 0; k < 3; ++k) {
+          center[k] = (lo[k] + hi[k]) / 2;
+          extent = std::max(extent, hi[k] - lo[k]);
+        }
+
+        // keep the points off the upper faces of the cube
+        const T width = 1 - T(1) / 64;
+        scale = 1;
+        potential_scale = 1;
+        if (handle.is_homogeneous()) {
+          if (extent > 0)
+            scale = width / extent;
+          potential_scale = std::pow(scale, -handle.degree());
+        } else if (extent >= width) {
+          throw std::runtime_error(
+              "the points of the non-homogeneous kernel " + handle.desc()
+              + " should fit into a box of size "
+              + std::to_string(width) + ", since they cannot be rescaled");
+        }
+      }
+
+      std::vector<T> apply(const T* points, ssize_t n) const {
+        std::vector<T> result(3 * n);
+        for (ssize_t i = 0; i < n; ++i)
+          for (int k = 0; k < 3; ++k)
+            result[3 * i + k] = (points[3 * i + k] - center[k]) * scale + T(0.5);
+        return result;
+      }
+
+      // Whether mapped points lie inside the unit cube [0, 1)^3.
+      static bool contains(const std::vector<T> &mapped) {
+        for (const T x : mapped)
+          if ( !(x >= 0 && x < 1) )
+            return false;
+        return true;
+      }
+    };
+
+  // Returns the number of right-hand sides: densities of shape
+  // (n_rhs, n_src, src_dim) hold n_rhs of them, and any other array of
+  // n_src * src_dim values a single one.
+  template <class T>
+    ssize_t check_densities(const pvfmm::Kernel<T> &kernel,
+        const pybind11::array_t<T, pybind11::array::c_style> &densities,
+        ssize_t n_src) {
+      const int src_dim = kernel.ker_dim[0];
+      if ( densities.ndim() == 3 ) {
+        if ( densities.shape(1) != n_src || densities.shape(2) != src_dim )
+          throw std::runtime_error(
+              "densities should be a NumPy array of shape (n_rhs, n_src, "
+              + std::to_string(src_dim) + ")");
+        return densities.shape(0);
+      }
+
+      if ( densities.size() != n_src * src_dim )
+        throw std::runtime_error(
+            "densities should be a NumPy array of shape (n_src, "
+            + std::to_string(src_dim) + ")");
+      return 1;
+    }
+
+  // A particle FMM with fixed sources and targets. The octree, the
+  // interaction lists and the translation setup are built once, and each
+  // evaluation only runs the passes of the FMM with the new densities.
+  template <class T>
+    class PointFMM {
+      public:
+        PointFMM(pybind11::object kernel_spec,
+            pybind11::array_t<T, pybind11::array::c_style> sources,
+            pybind11::array_t<T, pybind11::array::c_style> targets,
+            int order, int max_pts)
+          : m_handle(resolve_kernel<T>(kernel_spec)), m_order(order),
+            m_max_pts(max_pts), m_has_fmm_data(false) {
+          if ( sources.ndim() != 2 || sources.shape(1) != 3 )
+            throw std::runtime_error(
+                "sources should be a NumPy array of shape (n_src, 3)");
+          if ( targets.ndim() != 2 || targets.shape(1) != 3 )
+            throw std::runtime_error(
+                "targets should be a NumPy array of shape (n_trg, 3)");
+          if ( order < 1 )
+            throw std::runtime_error("order should be positive");
+          if ( max_pts < 1 )
+            throw std::runtime_error("max_pts should be positive");
+
+          m_n_src = sources.shape(0);
+          m_n_trg = targets.shape(0);
+          if (m_n_src == 0 || m_n_trg == 0)
+            return;
+
+          const T* sources_ptr = sources.data();
+          const T* targets_ptr = targets.data();
+
+          pybind11::gil_scoped_release release;
+
+          m_matrices = FMMMatricesCache<T, pvfmm::PtFMM<T>>::instance().get(
+              m_handle, order);
+          std::unique_ptr<UnitCubeMap<T>> unit_cube(new UnitCubeMap<T>(
+                sources_ptr, m_n_src, targets_ptr, m_n_trg, *m_handle));
+          std::vector<T> src_coord = unit_cube->apply(sources_ptr, m_n_src);
+          std::vector<T> trg_coord = unit_cube->apply(targets_ptr, m_n_trg);
+          build_tree(src_coord, trg_coord, std::move(unit_cube));
+        }
+
+        PointFMM(const PointFMM &) = delete;
+        PointFMM &operator=(const PointFMM &) = delete;
+
+        // out[t] = sum_s K(targets[t], sources[s]) densities[s], for one or
+        // several right-hand sides
+        pybind11::array evaluate(
+            pybind11::array_t<T, pybind11::array::c_style> densities,
+            pybind11::object out) {
+          const ssize_t n_rhs = check_densities(
+              m_handle->kernel(), densities, m_n_src);
+
+          const ssize_t n_values = m_n_trg * trg_dim();
+          auto result = densities.ndim() == 3
+            ? prepare_output<T>(out, {n_rhs, m_n_trg, trg_dim()})
+            : prepare_output<T>(out, {m_n_trg, trg_dim()});
+          T* result_ptr = result.mutable_data();
+          if (!m_tree) {
+            std::fill(result_ptr, result_ptr + n_rhs * n_values, T(0));
+            return result;
+          }
+
+          const T* densities_ptr = densities.data();
+          const ssize_t n_densities = m_n_src * src_dim();
+
+          {
+            pybind11::gil_scoped_release release;
+
+            std::vector<T> src_value(n_densities);
+            std::vector<T> trg_value;
+
+            // the right-hand sides share the tree and the setup, and are
+            // evaluated in a row
+            std::lock_guard<std::mutex> lock(m_matrices->mutex());
+            const T potential_scale = m_unit_cube->potential_scale;
+
+            for (ssize_t irhs = 0; irhs < n_rhs; ++irhs) {
+              const T* rhs_ptr = densities_ptr + irhs * n_densities;
+              std::copy(rhs_ptr, rhs_ptr + n_densities, src_value.begin());
+
+              if (m_has_fmm_data)
+                m_tree->ClearFMMData();
+              pvfmm::PtFMM_Evaluate(m_tree.get(), trg_value, m_n_trg,
+                  &src_value);
+              m_has_fmm_data = true;
+
+              T* rhs_result_ptr = result_ptr + irhs * n_values;
+              for (ssize_t i = 0; i < n_values; ++i)
+                rhs_result_ptr[i] = trg_value[i] * potential_scale;
+            }
+          }
+
+          return result;
+        }
+
+        // Moves the sources and targets to new positions. As long as the
+        // points stay inside their leaf boxes, their coordinates are updated
+        // in the leaves of the tree, which keeps its structure, and only the
+        // FMM setup is redone. Otherwise, the tree is rebuilt. The
+        // translation operators are kept in either case, and so is the unit
+        // cube map unless some point leaves the unit cube.
+        // Returns whether the tree was updated in place.
+        bool update_positions(
+            pybind11::array_t<T, pybind11::array::c_style> sources,
+            pybind11::array_t<T, pybind11::array::c_style> targets) {
+          if ( sources.ndim() != 2 || sources.shape(0) != m_n_src
+              || sources.shape(1) != 3 )
+            throw std::runtime_error(
+                "sources should be a NumPy array of shape (n_src, 3)");
+          if ( targets.ndim() != 2 || targets.shape(0) != m_n_trg
+              || targets.shape(1) != 3 )
+            throw std::runtime_error(
+                "targets should be a NumPy array of shape (n_trg, 3)");
+          if (!m_tree)
+            return true;
+
+          const T* sources_ptr = sources.data();
+          const T* targets_ptr = targets.data();
+
+          pybind11::gil_scoped_release release;
+
+          std::vector<T> src_coord = m_unit_cube->apply(sources_ptr, m_n_src);
+          std::vector<T> trg_coord = m_unit_cube->apply(targets_ptr, m_n_trg);
+
+          {
+            std::lock_guard<std::mutex> lock(m_matrices->mutex());
+            if (stay_in_leaves(src_coord, trg_coord)) {
+              move_in_leaves(src_coord, trg_coord);
+              m_tree->SetupFMM(&m_matrices->fmm());
+              return true;
+            }
+          }
+
+          std::unique_ptr<UnitCubeMap<T>> unit_cube;
+          if (!UnitCubeMap<T>::contains(src_coord)
+              || !UnitCubeMap<T>::contains(trg_coord)) {
+            unit_cube.reset(new UnitCubeMap<T>(
+                  sources_ptr, m_n_src, targets_ptr, m_n_trg, *m_handle));
+            src_coord = unit_cube->apply(sources_ptr, m_n_src);
+            trg_coord = unit_cube->apply(targets_ptr, m_n_trg);
+          }
+          build_tree(src_coord, trg_coord, std::move(unit_cube));
+          return false;
+        }
+
+        std::shared_ptr<KernelHandle<T>> kernel() const { return m_handle; }
+
+        int order() const { return m_order; }
+
+        ssize_t n_sources() const { return m_n_src; }
+
+        ssize_t n_targets() const { return m_n_trg; }
+
+        int src_dim() const { return m_handle->kernel().ker_dim[0]; }
+
+        int trg_dim() const { return m_handle->kernel().ker_dim[1]; }
+
+      private:
+        // Builds and sets up the tree of the points, given in the unit cube
+        // by unit_cube, or by the current map if unit_cube is null.
+        void build_tree(const std::vector<T> &src_coord,
+            const std::vector<T> &trg_coord,
+            std::unique_ptr<UnitCubeMap<T>> unit_cube) {
+          std::vector<T> src_value(m_n_src * m_handle->kernel().ker_dim[0]);
+          std::vector<T> surf_coord, surf_value;
+
+          std::unique_ptr<pvfmm::PtFMM_Tree<T>> tree(pvfmm::PtFMM_CreateTree(
+                src_coord, src_value, surf_coord, surf_value, trg_coord,
+                fmm_comm(), m_max_pts, pvfmm::FreeSpace));
+
+          std::lock_guard<std::mutex> lock(m_matrices->mutex());
+          tree->SetupFMM(&m_matrices->fmm());
+          if (unit_cube)
+            m_unit_cube = std::move(unit_cube);
+          m_tree = std::move(tree);
+          m_has_fmm_data = false;
+        }
+
+        // Whether the points (in the order of the input, indexed by the
+        // scatter indices of the leaves) are still inside the leaf boxes
+        // holding them.
+        bool stay_in_leaves(const std::vector<T> &src_coord,
+            const std::vector<T> &trg_coord) {
+          for (auto node : m_tree->GetNodeList()) {
+            if (!node->IsLeaf() || node->IsGhost())
+              continue;
+
+            const T* corner = node->Coord();
+            const T size = std::ldexp(T(1), -(int) node->Depth());
+            auto inside = [corner, size](const T* x) {
+              for (int k = 0; k < 3; ++k)
+                if ( !(x[k] >= corner[k] && x[k] < corner[k] + size) )
+                  return false;
+              return true;
+            };
+
+            for (size_t i = 0; i < node->src_scatter.Dim(); ++i)
+              if (!inside(&src_coord[3 * node->src_scatter[i]]))
+                return false;
+            for (size_t i = 0; i < node->trg_scatter.Dim(); ++i)
+              if (!inside(&trg_coord[3 * node->trg_scatter[i]]))
+                return false;
+          }
+          return true;
+        }
+
+        void move_in_leaves(const std::vector<T> &src_coord,
+            const std::vector<T> &trg_coord) {
+          for (auto node : m_tree->GetNodeList()) {
+            if (!node->IsLeaf() || node->IsGhost())
+              continue;
+
+            for (size_t i = 0; i < node->src_scatter.Dim(); ++i)
+              for (int k = 0; k < 3; ++k)
+                node->src_coord[3 * i + k]
+                  = src_coord[3 * node->src_scatter[i] + k];
+            for (size_t i = 0; i < node->trg_scatter.Dim(); ++i)
+              for (int k = 0; k < 3; ++k)
+                node->trg_coord[3 * i + k]
+                  = trg_coord[3 * node->trg_scatter[i] + k];
+          }
+        }
+
+        std::shared_ptr<KernelHandle<T>> m_handle;
+        int m_order;
+        int m_max_pts;
+        ssize_t m_n_src;
+        ssize_t m_n_trg;
+        std::shared_ptr<FMMMatrices<T, pvfmm::PtFMM<T>>> m_matrices;
+        std::unique_ptr<UnitCubeMap<T>> m_unit_cube;
+        std::unique_ptr<pvfmm::PtFMM_Tree<T>> m_tree;
+        bool m_has_fmm_data;
+    };
+
+  // Evaluates the kernel sums at the targets with pvfmm's particle FMM:
+  // out[t] = sum_s K(targets[t], sources[s]) densities[s].
+  template <class T>
+    pybind11::array fmm_evaluate(
+        pybind11::object kernel_spec,
+        pybind11::array_t<T, pybind11::array::c_style> sources,
+        pybind11::array_t<T, pybind11::array::c_style> densities,
+        pybind11::array_t<T, pybind11::array::c_style> targets,
+        int order, int max_pts, pybind11::object out){
+      auto handle = resolve_kernel<T>(kernel_spec);
+      if ( sources.ndim() == 2 )
+        check_densities(handle->kernel(), densities, sources.shape(0));
+
+      PointFMM<T> fmm(pybind11::cast(handle), sources, targets,
+          order, max_pts);
+      return fmm.evaluate(densities, out);
+    }
+
+  // }}} End point FMM
+
+  // {{{ volume FMM
+
+  // Piecewise Chebyshev expansion of a density over the leaves of an
+  // octree of the unit cube, which are looked up with a BoxLocator.
+  template <class T>
+    class PiecewiseCheb {
+      public:
+        static constexpr int max_depth = BoxLocator<T>::max_depth;
+
+        PiecewiseCheb(int d, ssize_t dof, const T* coeffs, const T* centers,
+            const int64_t* depths, ssize_t n_leaves)
+          : m_d(d), m_dof(dof), m_n_coeffs(cheb_coeff_count(d)),
+            m_coeffs(coeffs), m_centers(centers), m_depths(depths),
+            m_locator(centers, leaf_sizes(depths, n_leaves).data(),
+                n_leaves) {}
+
+        // Evaluates the density at n points, as pvfmm's input functions.
+        void evaluate(const T* coord, int n, T* out) const {
+          std::vector<T> p(3 * (m_d + 1));
+          for (int ipt = 0; ipt < n; ++ipt) {
+            const T* x = coord + 3 * ipt;
+            const ssize_t ileaf = m_locator.find(x);
+            if (ileaf < 0) {
+              std::fill(out + ipt * m_dof, out + (ipt + 1) * m_dof, T(0));
+              continue;
+            }
+
+            const T size = std::ldexp(T(1), -m_depths[ileaf]);
+            T local[3];
+            for (int k = 0; k < 3; ++k)
+              local[k] = 2 * (x[k] - m_centers[3 * ileaf + k]) / size;
+            cheb_eval_point(m_d, m_coeffs + ileaf * m_dof * m_n_coeffs,
+                m_dof, local, &p[0], out + ipt * m_dof);
+          }
+        }
+
+      private:
+        static std::vector<T> leaf_sizes(const int64_t* depths,
+            ssize_t n_leaves) {
+          std::vector<T> sizes(n_leaves);
+          for (ssize_t ileaf = 0; ileaf < n_leaves; ++ileaf) {
+            if (depths[ileaf] < 0 || depths[ileaf] > max_depth)
+              throw std::runtime_error(
+                  "leaf depths should be between 0 and "
+                  + std::to_string(max_depth));
+            sizes[ileaf] = std::ldexp(T(1), -depths[ileaf]);
+          }
+          return sizes;
+        }
+
+        int m_d;
+        ssize_t m_dof;
+        ssize_t m_n_coeffs;
+        const T* m_coeffs;
+        const T* m_centers;
+        const int64_t* m_depths;
+        BoxLocator<T> m_locator;
+    };
+
+  // pvfmm samples the density through a plain function pointer, which
+  // evaluates the piecewise expansion of the tree being built.
+  template <class T>
+    const PiecewiseCheb<T>* &active_density() {
+      static const PiecewiseCheb<T>* density = nullptr;
+      return density;
+    }
+
+  template <class T>
+    std::mutex &active_density_mutex() {
+      static std::mutex mutex;
+      return mutex;
+    }
+
+  template <class T>
+    void density_trampoline(const T* coord, int n, T* out) {
+      active_density<T>()->evaluate(coord, n, out);
+    }
+
+  // Builds pvfmm's Chebyshev tree of the density, sampling the piecewise
+  // expansion in place of a user function.
+  template <class T>
+    pvfmm::ChebFMM_Tree<T>* create_cheb_tree(
+        const PiecewiseCheb<T> &density, int cheb_deg, int dof,
+        std::vector<T> &trg_coord, T tol, int max_pts) {
+      std::lock_guard<std::mutex> lock(active_density_mutex<T>());
+
+      struct ActiveDensity {
+        explicit ActiveDensity(const PiecewiseCheb<T> &density) {
+          active_density<T>() = &density;
+        }
+        ~ActiveDensity() { active_density<T>() = nullptr; }
+      } active(density);
+
+      return pvfmm::ChebFMM_CreateTree(cheb_deg, dof, density_trampoline<T>,
+          trg_coord, fmm_comm(), tol, max_pts, pvfmm::FreeSpace);
+    }
+
+  // Evaluates the volume potential of a density, given as a piecewise
+  // Chebyshev expansion over the leaves of an octree of the unit cube,
+  // with pvfmm's Chebyshev FMM. Returns the leaves of the FMM tree, as
+  // (centers, sizes, coefficients of the potential), and the potential at
+  // the targets.
+  template <class T>
+    pybind11::tuple cheb_fmm_evaluate(
+        pybind11::object kernel_spec, int cheb_deg,
+        pybind11::array_t<T, pybind11::array::c_style> coeffs,
+        pybind11::array_t<T, pybind11::array::c_style> centers,
+        pybind11::array_t<int64_t, pybind11::array::c_style> depths,
+        pybind11::array_t<T, pybind11::array::c_style> targets,
+        T tol, int order, int max_pts){
+      auto handle = resolve_kernel<T>(kernel_spec);
+      const int src_dim = handle->kernel().ker_dim[0];
+      const int trg_dim = handle->kernel().ker_dim[1];
+      const ssize_t n_coeffs = cheb_coeff_count(cheb_deg);
+
+      // check input dimensions
+      if ( coeffs.ndim() != 3 || coeffs.shape(1) != src_dim
+          || coeffs.shape(2) != n_coeffs )
+        throw std::runtime_error(
+            "coeffs should be a NumPy array of shape (n_leaves, "
+            + std::to_string(src_dim) + ", " + std::to_string(n_coeffs) + ")");
+      const ssize_t n_leaves = coeffs.shape(0);
+      if ( centers.ndim() != 2 || centers.shape(0) != n_leaves
+          || centers.shape(1) != 3 )
+        throw std::runtime_error(
+            "centers should be a NumPy array of shape (n_leaves, 3)");
+      if ( depths.ndim() != 1 || depths.shape(0) != n_leaves )
+        throw std::runtime_error(
+            "depths should be a NumPy array of shape (n_leaves,)");
+      if ( targets.ndim() != 2 || targets.shape(1) != 3 )
+        throw std::runtime_error(
+            "targets should be a NumPy array of shape (n_trg, 3)");
+      const ssize_t n_trg = targets.shape(0);
+      if ( order < 1 )
+        throw std::runtime_error("order should be positive");
+
+      const T* targets_ptr = targets.data();
+      for (ssize_t i = 0; i < 3 * n_trg; ++i)
+        if ( !(targets_ptr[i] >= 0 && targets_ptr[i] < 1) )
+          throw std::runtime_error("targets should be inside the unit cube");
+
+      const T* coeffs_ptr = coeffs.data();
+      const T* centers_ptr = centers.data();
+      const int64_t* depths_ptr = depths.data();
+
+      std::vector<T> leaf_centers, leaf_sizes, leaf_coeffs, trg_value;
+
+      {
+        pybind11::gil_scoped_release release;
+
+        auto matrices = FMMMatricesCache<T, pvfmm::ChebFMM<T>>::instance().get(
+            handle, order, cheb_deg);
+        PiecewiseCheb<T> density(cheb_deg, src_dim, coeffs_ptr, centers_ptr,
+            depths_ptr, n_leaves);
+
+        std::vector<T> trg_coord(targets_ptr, targets_ptr + 3 * n_trg);
+        std::unique_ptr<pvfmm::ChebFMM_Tree<T>> tree(create_cheb_tree(
+              density, cheb_deg, src_dim, trg_coord, tol, max_pts));
+
+        {
+          std::lock_guard<std::mutex> lock(matrices->mutex());
+          tree->SetupFMM(&matrices->fmm());
+          pvfmm::ChebFMM_Evaluate(tree.get(), trg_value, n_trg);
+        }
+
+        // once evaluated, the Chebyshev data of the leaves holds the
+        // coefficients of the potential
+        for (auto node : tree->GetNodeList()) {
+          if (!node->IsLeaf() || node->IsGhost())
+            continue;
+
+          const T size = std::ldexp(T(1), -(int) node->Depth());
+          const T* corner = node->Coord();
+          for (int k = 0; k < 3; ++k)
+            leaf_centers.push_back(corner[k] + size / 2);
+          leaf_sizes.push_back(size);
+
+          const pvfmm::Vector<T> &data = node->ChebData();
+          if ( (ssize_t) data.Dim() != trg_dim * n_coeffs )
+            throw std::runtime_error(
+                "unexpected size of the potential coefficients");
+          for (size_t i = 0; i < data.Dim(); ++i)
+            leaf_coeffs.push_back(data[i]);
+        }
+      }
+
+      const ssize_t n_out = leaf_sizes.size();
+      return pybind11::make_tuple(
+          vector_to_array(std::move(leaf_centers), {n_out, 3}),
+          vector_to_array(std::move(leaf_sizes)),
+          vector_to_array(std::move(leaf_coeffs), {n_out, trg_dim, n_coeffs}),
+          vector_to_array(std::move(trg_value), {n_trg, trg_dim}));
+    }
+
+  // }}} End volume FMM
+
+} // end of namespace pypvfmm
@@ -87,4 +87,622 @@ namespace pypvfmm{
       }
     }
 
+  // Homogeneity degree d of the kernel, i.e. K(a x) = a^d K(x) for all a > 0.
+  // Returns false if the kernel is not homogeneous.
+  bool kernel_homogeneity(KernelKind kind, int &degree) {
+    switch(kind) {
+      case KernelKind::LaplacePotential:
+      case KernelKind::StokesVelocity:
+        degree = -1;
+        return true;
+
+      case KernelKind::LaplaceGradient:
+      case KernelKind::StokesPressure:
+      case KernelKind::StokesStress:
+      case KernelKind::StokesVelGrad:
+      case KernelKind::BiotSavartPotential:
+        degree = -2;
+        return true;
+
+      case KernelKind::HelmholtzPotential:
+        return false;
+    }
+    return false;
+  }
+
+  // A kernel that is looked up and initialized only once, and then shared
+  // by all the wrapped functions (see get_kernel_handle).
+  template <class T>
+    class KernelHandle {
+      public:
+        KernelHandle(const std::string &desc, const pvfmm::Kernel<T> &kernel,
+            bool is_homogeneous, int degree)
+          : m_desc(desc), m_kernel(kernel),
+            m_is_homogeneous(is_homogeneous), m_degree(degree) {
+          m_kernel.Initialize();
+        }
+
+        // the initialized kernel refers to itself, so it must not be copied
+        KernelHandle(const KernelHandle &) = delete;
+        KernelHandle &operator=(const KernelHandle &) = delete;
+
+        const std::string &desc() const { return m_desc; }
+
+        const pvfmm::Kernel<T> &kernel() const { return m_kernel; }
+
+        bool is_homogeneous() const { return m_is_homogeneous; }
+
+        int degree() const { return m_degree; }
+
+        int src_dim() const { return m_kernel.ker_dim[0]; }
+
+        int trg_dim() const { return m_kernel.ker_dim[1]; }
+
+        pybind11::object homogeneity() const {
+          if (m_is_homogeneous)
+            return pybind11::int_(m_degree);
+          return pybind11::none();
+        }
+
+      private:
+        std::string m_desc;
+        pvfmm::Kernel<T> m_kernel;
+        bool m_is_homogeneous;
+        int m_degree;
+    };
+
+  // {{{ runtime kernels
+
+  // pvfmm takes kernel functions as template arguments of BuildKernel, so
+  // kernels defined at runtime (e.g. with parameters) are dispatched through
+  // a fixed pool of slots, each with its own trampoline function.
+  constexpr int n_kernel_slots = 16;
+
+  template <class T>
+    using KernelFunction = std::function<void(
+        T* r_src, int src_cnt, T* v_src, int dof,
+        T* r_trg, int trg_cnt, T* v_trg, pvfmm::mem::MemoryManager* mem_mgr)>;
+
+  template <class T>
+    std::array<KernelFunction<T>, n_kernel_slots> &slot_functions() {
+      static std::array<KernelFunction<T>, n_kernel_slots> functions;
+      return functions;
+    }
+
+  template <class T, int slot>
+    void slot_kernel(T* r_src, int src_cnt, T* v_src, int dof,
+        T* r_trg, int trg_cnt, T* v_trg, pvfmm::mem::MemoryManager* mem_mgr) {
+      slot_functions<T>()[slot](
+          r_src, src_cnt, v_src, dof, r_trg, trg_cnt, v_trg, mem_mgr);
+    }
+
+  template <class T, int slot>
+    pvfmm::Kernel<T> build_kernel_in_slot(
+        const std::string &name, std::pair<int, int> ker_dim) {
+      return pvfmm::BuildKernel<T, slot_kernel<T, slot>>(
+          name.c_str(), 3, ker_dim);
+    }
+
+  // Picks build_kernel_in_slot<T, slot> for a slot known only at runtime.
+  template <class T, int slot = 0>
+    struct SlotKernelBuilder {
+      static pvfmm::Kernel<T> build(int s,
+          const std::string &name, std::pair<int, int> ker_dim) {
+        if ( s == slot )
+          return build_kernel_in_slot<T, slot>(name, ker_dim);
+        return SlotKernelBuilder<T, slot + 1>::build(s, name, ker_dim);
+      }
+    };
+
+  template <class T>
+    struct SlotKernelBuilder<T, n_kernel_slots> {
+      static pvfmm::Kernel<T> build(int s,
+          const std::string &name, std::pair<int, int> ker_dim) {
+        throw std::runtime_error("invalid kernel slot");
+      }
+    };
+
+  // SIMD vector type and reciprocal square root used by the micro-kernels
+  // below, chosen as for pvfmm's own kernels.
+  template <class T>
+    struct KernelVec {
+      typedef T type;
+      static const int newton_iter = 0;
+      static type rsqrt(type r2) {
+        return pvfmm::rsqrt_intrin0<type, T>(r2);
+      }
+    };
+
+#if !defined __MIC__ && defined __AVX__
+  template <>
+    struct KernelVec<double> {
+      typedef __m256d type;
+      static const int newton_iter = 2;
+      static type rsqrt(type r2) {
+        return pvfmm::rsqrt_intrin2<type, double>(r2);
+      }
+    };
+
+  template <>
+    struct KernelVec<float> {
+      typedef __m256 type;
+      static const int newton_iter = 1;
+      static type rsqrt(type r2) {
+        return pvfmm::rsqrt_intrin1<type, float>(r2);
+      }
+    };
+#elif !defined __MIC__ && defined __SSE3__
+  template <>
+    struct KernelVec<double> {
+      typedef __m128d type;
+      static const int newton_iter = 2;
+      static type rsqrt(type r2) {
+        return pvfmm::rsqrt_intrin2<type, double>(r2);
+      }
+    };
+
+  template <>
+    struct KernelVec<float> {
+      typedef __m128 type;
+      static const int newton_iter = 1;
+      static type rsqrt(type r2) {
+        return pvfmm::rsqrt_intrin1<type, float>(r2);
+      }
+    };
+#endif
+
+  // Wavenumber of the Helmholtz kernel being evaluated by the calling
+  // thread; micro-kernels are template arguments and take no parameters.
+  template <class T>
+    T &helmholtz_wavenumber() {
+      static thread_local T k = 0;
+      return k;
+    }
+
+  // pvfmm's Helmholtz micro-kernel (helmholtz_poten_uKernel), with the
+  // wavenumber taken from helmholtz_wavenumber() instead of fixed.
+  template <class Real_t>
+    void helmholtz_potential_ukernel(
+        pvfmm::Matrix<Real_t> &src_coord, pvfmm::Matrix<Real_t> &src_value,
+        pvfmm::Matrix<Real_t> &trg_coord, pvfmm::Matrix<Real_t> &trg_value) {
+      using namespace pvfmm;
+      typedef typename KernelVec<Real_t>::type Vec_t;
+      const size_t src_blk = 500;
+      const size_t vec_len = sizeof(Vec_t) / sizeof(Real_t);
+
+      // the Newton iterations of rsqrt scale 1/r by nwtn_scal
+      Real_t nwtn_scal = 1;
+      for (int i = 0; i < KernelVec<Real_t>::newton_iter; ++i)
+        nwtn_scal = 2 * nwtn_scal * nwtn_scal * nwtn_scal;
+      const Real_t oofp = 1.0 / (4 * nwtn_scal * const_pi<Real_t>());
+      const Vec_t mu = set_intrin<Vec_t, Real_t>(
+          helmholtz_wavenumber<Real_t>() / nwtn_scal);
+
+      const size_t src_cnt = src_coord.Dim(1);
+      const size_t trg_cnt = trg_coord.Dim(1);
+      for (size_t sblk = 0; sblk < src_cnt; sblk += src_blk) {
+        const size_t send = std::min(sblk + src_blk, src_cnt);
+        for (size_t t = 0; t < trg_cnt; t += vec_len) {
+          const Vec_t tx = load_intrin<Vec_t>(&trg_coord[0][t]);
+          const Vec_t ty = load_intrin<Vec_t>(&trg_coord[1][t]);
+          const Vec_t tz = load_intrin<Vec_t>(&trg_coord[2][t]);
+
+          Vec_t tvx = zero_intrin<Vec_t>();
+          Vec_t tvy = zero_intrin<Vec_t>();
+          for (size_t s = sblk; s < send; ++s) {
+            const Vec_t dx = sub_intrin(tx,
+                bcast_intrin<Vec_t>(&src_coord[0][s]));
+            const Vec_t dy = sub_intrin(ty,
+                bcast_intrin<Vec_t>(&src_coord[1][s]));
+            const Vec_t dz = sub_intrin(tz,
+                bcast_intrin<Vec_t>(&src_coord[2][s]));
+            const Vec_t svx = bcast_intrin<Vec_t>(&src_value[0][s]);
+            const Vec_t svy = bcast_intrin<Vec_t>(&src_value[1][s]);
+
+            Vec_t r2 = mul_intrin(dx, dx);
+            r2 = add_intrin(r2, mul_intrin(dy, dy));
+            r2 = add_intrin(r2, mul_intrin(dz, dz));
+
+            const Vec_t rinv = KernelVec<Real_t>::rsqrt(r2);
+            const Vec_t mu_r = mul_intrin(mu, mul_intrin(r2, rinv));
+            const Vec_t g0 = mul_intrin(cos_intrin(mu_r), rinv);
+            const Vec_t g1 = mul_intrin(sin_intrin(mu_r), rinv);
+            tvx = add_intrin(tvx,
+                sub_intrin(mul_intrin(svx, g0), mul_intrin(svy, g1)));
+            tvy = add_intrin(tvy,
+                add_intrin(mul_intrin(svx, g1), mul_intrin(svy, g0)));
+          }
+          tvx = add_intrin(mul_intrin(tvx, set_intrin<Vec_t, Real_t>(oofp)),
+              load_intrin<Vec_t>(&trg_value[0][t]));
+          tvy = add_intrin(mul_intrin(tvy, set_intrin<Vec_t, Real_t>(oofp)),
+              load_intrin<Vec_t>(&trg_value[1][t]));
+          store_intrin(&trg_value[0][t], tvx);
+          store_intrin(&trg_value[1][t], tvy);
+        }
+      }
+    }
+
+  // Helmholtz potential exp(i k r) / (4 pi r), with complex densities and
+  // potentials stored as (real, imaginary) pairs, as in pvfmm.
+  template <class T>
+    void helmholtz_potential(T k, T* r_src, int src_cnt, T* v_src, int dof,
+        T* r_trg, int trg_cnt, T* v_trg, pvfmm::mem::MemoryManager* mem_mgr) {
+      helmholtz_wavenumber<T>() = k;
+      pvfmm::generic_kernel<T, 2, 2, helmholtz_potential_ukernel<T>>(
+          r_src, src_cnt, v_src, dof, r_trg, trg_cnt, v_trg, mem_mgr);
+    }
+
+  enum ParametricKernelKind {
+    ParametricHelmholtzPotential = 1,
+  };
+
+  // Parametric kernels are described by "<kernel>, <name>=<value>, ...".
+  const std::unordered_map<std::string, std::pair<
+    ParametricKernelKind, std::vector<std::string>>>
+    parametric_kernel_map{
+      {"HelmholtzKernel, potential",
+        {ParametricKernelKind::ParametricHelmholtzPotential, {"k"}}},
+    };
+
+  // A kernel defined at runtime, before it is given a slot.
+  template <class T>
+    struct RuntimeKernel {
+      std::string desc;
+      KernelFunction<T> function;
+      std::pair<int, int> ker_dim;
+      bool is_homogeneous;
+      int degree;
+    };
+
+  // Parses the descriptor of a parametric kernel. The parameters in the
+  // descriptor of the result are formatted canonically, so that equal
+  // parameters give the same kernel.
+  template <class T>
+    RuntimeKernel<T> parse_parametric_kernel(const std::string &kernel_desc) {
+      std::vector<std::string> parts;
+      std::string::size_type start = 0, end;
+      while ((end = kernel_desc.find(", ", start)) != std::string::npos) {
+        parts.push_back(kernel_desc.substr(start, end - start));
+        start = end + 2;
+      }
+      parts.push_back(kernel_desc.substr(start));
+
+      auto invalid = std::runtime_error("Invalid kernel_desc: " + kernel_desc);
+      if (parts.size() < 2)
+        throw invalid;
+      auto query = parametric_kernel_map.find(parts[0] + ", " + parts[1]);
+      if (query == parametric_kernel_map.end())
+        throw invalid;
+
+      const auto &param_names = query->second.second;
+      if (parts.size() != 2 + param_names.size())
+        throw invalid;
+
+      std::ostringstream desc;
+      desc << query->first << std::setprecision(17);
+      std::vector<double> params;
+      for (size_t i = 0; i < param_names.size(); ++i) {
+        const std::string &part = parts[2 + i];
+        if (part.compare(0, param_names[i].size() + 1, param_names[i] + "="))
+          throw invalid;
+        const std::string value = part.substr(param_names[i].size() + 1);
+        size_t n_parsed = 0;
+        try {
+          params.push_back(std::stod(value, &n_parsed));
+        } catch (const std::exception &) {
+          throw invalid;
+        }
+        if (n_parsed != value.size())
+          throw invalid;
+        desc << ", " << param_names[i] << "=" << params.back();
+      }
+
+      RuntimeKernel<T> kernel;
+      kernel.desc = desc.str();
+      switch(query->second.first) {
+        case ParametricKernelKind::ParametricHelmholtzPotential:
+          {
+            const T k = params[0];
+            kernel.function = [k](T* r_src, int src_cnt, T* v_src, int dof,
+                T* r_trg, int trg_cnt, T* v_trg,
+                pvfmm::mem::MemoryManager* mem_mgr) {
+              helmholtz_potential<T>(k, r_src, src_cnt, v_src, dof,
+                  r_trg, trg_cnt, v_trg, mem_mgr);
+            };
+            kernel.ker_dim = std::make_pair(2, 2);
+            kernel.is_homogeneous = false;
+            kernel.degree = 0;
+          }
+          break;
+      }
+      return kernel;
+    }
+
+  // Handles of all kernels, created on first use. Runtime kernels take up
+  // a slot each; the least recently used ones are evicted to make room for
+  // new ones once they are no longer referenced outside of the registry.
+  template <class T>
+    class KernelRegistry {
+      public:
+        static KernelRegistry &instance() {
+          static KernelRegistry registry;
+          return registry;
+        }
+
+        std::shared_ptr<KernelHandle<T>> get(const std::string &kernel_desc) {
+          std::lock_guard<std::mutex> lock(m_mutex);
+
+          auto fixed = m_fixed.find(kernel_desc);
+          if (fixed != m_fixed.end())
+            return fixed->second;
+
+          auto query = kernel_map.find(kernel_desc);
+          if (query != kernel_map.end()) {
+            int degree = 0;
+            bool is_homogeneous = kernel_homogeneity(query->second, degree);
+            auto handle = std::make_shared<KernelHandle<T>>(
+                kernel_desc, get_kernel<T>(kernel_desc),
+                is_homogeneous, degree);
+            m_fixed.emplace(kernel_desc, handle);
+            return handle;
+          }
+
+          auto cached = find_runtime(kernel_desc);
+          if (cached)
+            return cached;
+
+          auto runtime_kernel = parse_parametric_kernel<T>(kernel_desc);
+          cached = find_runtime(runtime_kernel.desc);
+          if (cached)
+            return cached;
+          return add_runtime(runtime_kernel, false);
+        }
+
+        // Returns the handle of the kernel if it exists, or nullptr.
+        std::shared_ptr<KernelHandle<T>> find(const std::string &kernel_desc) {
+          std::lock_guard<std::mutex> lock(m_mutex);
+
+          auto fixed = m_fixed.find(kernel_desc);
+          if (fixed != m_fixed.end())
+            return fixed->second;
+          return find_runtime(kernel_desc);
+        }
+
+        // Adds a runtime kernel under its own name. Its slot is kept for
+        // the lifetime of the module.
+        std::shared_ptr<KernelHandle<T>> add(
+            const RuntimeKernel<T> &runtime_kernel) {
+          std::lock_guard<std::mutex> lock(m_mutex);
+
+          const std::string &desc = runtime_kernel.desc;
+          if (kernel_map.count(desc) || parametric_kernel_map.count(desc)
+              || find_runtime(desc))
+            throw std::runtime_error("Kernel " + desc + " is already defined");
+          return add_runtime(runtime_kernel, true);
+        }
+
+      private:
+        struct RuntimeEntry {
+          std::shared_ptr<KernelHandle<T>> handle;
+          int slot;
+          bool pinned;
+        };
+
+        KernelRegistry() {
+          for (int slot = n_kernel_slots - 1; slot >= 0; --slot)
+            m_free_slots.push_back(slot);
+        }
+
+        // Looks up a runtime kernel, marking it as most recently used.
+        std::shared_ptr<KernelHandle<T>> find_runtime(const std::string &desc) {
+          for (auto it = m_runtime.begin(); it != m_runtime.end(); ++it)
+            if (it->handle->desc() == desc) {
+              m_runtime.splice(m_runtime.begin(), m_runtime, it);
+              return it->handle;
+            }
+          return nullptr;
+        }
+
+        int acquire_slot() {
+          if (m_free_slots.empty()) {
+            // evict the least recently used kernel not referenced elsewhere
+            for (auto it = m_runtime.rbegin(); it != m_runtime.rend(); ++it)
+              if (!it->pinned && it->handle.use_count() == 1) {
+                m_free_slots.push_back(it->slot);
+                m_runtime.erase(std::next(it).base());
+                break;
+              }
+          }
+          if (m_free_slots.empty())
+            throw std::runtime_error(
+                "All " + std::to_string(n_kernel_slots)
+                + " kernel slots are in use, release some kernel handles");
+
+          int slot = m_free_slots.back();
+          m_free_slots.pop_back();
+          return slot;
+        }
+
+        std::shared_ptr<KernelHandle<T>> add_runtime(
+            const RuntimeKernel<T> &runtime_kernel, bool pinned) {
+          int slot = acquire_slot();
+          slot_functions<T>()[slot] = runtime_kernel.function;
+
+          std::shared_ptr<KernelHandle<T>> handle;
+          try {
+            handle = std::make_shared<KernelHandle<T>>(
+                runtime_kernel.desc,
+                SlotKernelBuilder<T>::build(slot, runtime_kernel.desc,
+                  runtime_kernel.ker_dim),
+                runtime_kernel.is_homogeneous, runtime_kernel.degree);
+          } catch (...) {
+            m_free_slots.push_back(slot);
+            throw;
+          }
+
+          m_runtime.push_front(RuntimeEntry{handle, slot, pinned});
+          return handle;
+        }
+
+        std::mutex m_mutex;
+        std::unordered_map<
+          std::string, std::shared_ptr<KernelHandle<T>>> m_fixed;
+        std::list<RuntimeEntry> m_runtime;
+        std::vector<int> m_free_slots;
+    };
+
+  // }}} End runtime kernels
+
+  // Compiled user kernel function, with the signature of pvfmm's kernel
+  // functions (without the memory manager). Potentials are added to v_trg.
+  template <class T>
+    using UserKernelFunction = void (*)(
+        const T* r_src, int src_cnt, const T* v_src, int dof,
+        const T* r_trg, int trg_cnt, T* v_trg);
+
+  // Registers a compiled kernel, given by its address or as a PyCapsule,
+  // under the descriptor name.
+  template <class T>
+    std::shared_ptr<KernelHandle<T>> register_kernel(
+        const std::string &name, pybind11::object function,
+        int src_dim, int trg_dim, pybind11::object homogeneity) {
+      void* address;
+      if (pybind11::isinstance<pybind11::capsule>(function)) {
+        PyObject* capsule = function.ptr();
+        address = PyCapsule_GetPointer(capsule, PyCapsule_GetName(capsule));
+        if (address == nullptr)
+          throw pybind11::error_already_set();
+      } else
+        address = reinterpret_cast<void*>(function.cast<uintptr_t>());
+
+      if (address == nullptr)
+        throw std::runtime_error("function should not be a null pointer");
+      if (src_dim < 1 || trg_dim < 1)
+        throw std::runtime_error("src_dim and trg_dim should be positive");
+
+      auto user_function = reinterpret_cast<UserKernelFunction<T>>(address);
+
+      RuntimeKernel<T> kernel;
+      kernel.desc = name;
+      kernel.function = [user_function](T* r_src, int src_cnt, T* v_src,
+          int dof, T* r_trg, int trg_cnt, T* v_trg,
+          pvfmm::mem::MemoryManager* mem_mgr) {
+        user_function(r_src, src_cnt, v_src, dof, r_trg, trg_cnt, v_trg);
+      };
+      kernel.ker_dim = std::make_pair(src_dim, trg_dim);
+      kernel.is_homogeneous = !homogeneity.is_none();
+      kernel.degree = kernel.is_homogeneous ? homogeneity.cast<int>() : 0;
+
+      return KernelRegistry<T>::instance().add(kernel);
+    }
+
+  // Returns the handle of the kernel, creating it on first use.
+  template <class T>
+    std::shared_ptr<KernelHandle<T>> get_kernel_handle(
+        const std::string &kernel_desc) {
+      return KernelRegistry<T>::instance().get(kernel_desc);
+    }
+
+  // Accepts either a kernel handle or a kernel descriptor.
+  template <class T>
+    std::shared_ptr<KernelHandle<T>> resolve_kernel(pybind11::object kernel) {
+      if (pybind11::isinstance<KernelHandle<T>>(kernel))
+        return kernel.cast<std::shared_ptr<KernelHandle<T>>>();
+      if (pybind11::isinstance<pybind11::str>(kernel))
+        return get_kernel_handle<T>(kernel.cast<std::string>());
+      throw std::runtime_error(
+          "kernel should be a kernel descriptor, or a kernel handle of "
+          "matching dtype");
+    }
+
+  pybind11::object homogeneity(pybind11::object kernel) {
+    if (pybind11::isinstance<KernelHandle<double>>(kernel))
+      return kernel.cast<KernelHandle<double>&>().homogeneity();
+    if (pybind11::isinstance<KernelHandle<float>>(kernel))
+      return kernel.cast<KernelHandle<float>&>().homogeneity();
+
+    const std::string kernel_desc = kernel.cast<std::string>();
+    auto query = kernel_map.find(kernel_desc);
+    if (query == kernel_map.end()) {
+      // registered kernels
+      if (auto handle = KernelRegistry<double>::instance().find(kernel_desc))
+        return handle->homogeneity();
+      if (auto handle = KernelRegistry<float>::instance().find(kernel_desc))
+        return handle->homogeneity();
+
+      auto runtime_kernel = parse_parametric_kernel<double>(kernel_desc);
+      if (runtime_kernel.is_homogeneous)
+        return pybind11::int_(runtime_kernel.degree);
+      return pybind11::none();
+    }
+
+    int degree;
+    if (kernel_homogeneity(query->second, degree))
+      return pybind11::int_(degree);
+    return pybind11::none();
+  }
+
+  // Direct evaluation of the kernel sums at the targets:
+  // out[t] = sum_s K(targets[t], sources[s]) densities[s].
+  template <class T>
+    pybind11::array evaluate(
+        pybind11::object kernel_spec,
+        pybind11::array_t<T, pybind11::array::c_style> sources,
+        pybind11::array_t<T, pybind11::array::c_style> densities,
+        pybind11::array_t<T, pybind11::array::c_style> targets,
+        pybind11::object out){
+      auto handle = resolve_kernel<T>(kernel_spec);
+      const pvfmm::Kernel<T> &kernel = handle->kernel();
+      const int src_dim = kernel.ker_dim[0];
+      const int trg_dim = kernel.ker_dim[1];
+
+      // check input dimensions
+      if ( sources.ndim() != 2 || sources.shape(1) != 3 )
+        throw std::runtime_error(
+            "sources should be a NumPy array of shape (n_src, 3)");
+      const ssize_t n_src = sources.shape(0);
+      if ( densities.size() != n_src * src_dim )
+        throw std::runtime_error(
+            "densities should be a NumPy array of shape (n_src, "
+            + std::to_string(src_dim) + ")");
+      if ( targets.ndim() != 2 || targets.shape(1) != 3 )
+        throw std::runtime_error(
+            "targets should be a NumPy array of shape (n_trg, 3)");
+      const ssize_t n_trg = targets.shape(0);
+
+      auto result = prepare_output<T>(out, {n_trg, trg_dim});
+
+      // the kernel functions take non-const pointers, but do not write
+      // to their inputs
+      T* sources_ptr = const_cast<T*>(sources.data());
+      T* densities_ptr = const_cast<T*>(densities.data());
+      T* targets_ptr = const_cast<T*>(targets.data());
+      T* result_ptr = result.mutable_data();
+
+      {
+        pybind11::gil_scoped_release release;
+
+        // the kernel functions accumulate into their output
+        std::fill(result_ptr, result_ptr + n_trg * trg_dim, T(0));
+
+        const ssize_t tile = 256;
+        const ssize_t n_tiles = (n_trg + tile - 1) / tile;
+
+        OMPExceptions exceptions;
+        #pragma omp parallel for schedule(dynamic)
+        for (ssize_t itile = 0; itile < n_tiles; ++itile) {
+          exceptions.run([&](){
+              const ssize_t start = itile * tile;
+              const ssize_t count = std::min(tile, n_trg - start);
+              kernel.ker_poten(sources_ptr, n_src, densities_ptr, 1,
+                  targets_ptr + 3 * start, count,
+                  result_ptr + trg_dim * start, NULL);
+              });
+        }
+        exceptions.rethrow();
+      }
+
+      return result;
+    }
+
 } // end of namespace pypvfmm
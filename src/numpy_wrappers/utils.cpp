@@ -0,0 +1,121 @@
+/* ---------------------------------------------------------------------
+**
+** Copyright (C) 2019 Xiaoyu Wei
+**
+** Permission is hereby granted, free of charge, to any person obtaining a copy
+** of this software and associated documentation files (the "Software"), to deal
+** in the Software without restriction, including without limitation the rights
+** to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+** copies of the Software, and to permit persons to whom the Software is
+** furnished to do so, subject to the following conditions:
+** 
+** The above copyright notice and this permission notice shall be included in
+** all copies or substantial portions of the Software.
+** 
+** THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+** IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+** FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+** AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+** LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+** OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+** THE SOFTWARE.
+**
+** -------------------------------------------------------------------*/
+
+
+namespace pypvfmm{
+
+  // Hands the storage of U over to NumPy, without copying.
+  template <class T>
+    pybind11::array_t<T> vector_to_array(std::vector<T> &&U){
+      auto U_ptr = new std::vector<T>(std::move(U));
+      pybind11::capsule owner(U_ptr, [](void* ptr){
+          delete reinterpret_cast<std::vector<T>*>(ptr);
+          });
+
+      return pybind11::array_t<T>(
+          {(ssize_t) U_ptr->size()}, {(ssize_t) sizeof(T)},
+          U_ptr->data(), owner);
+    }
+
+
+  // Same as above, as a C-contiguous array of the given shape.
+  template <class T>
+    pybind11::array_t<T> vector_to_array(std::vector<T> &&U,
+        const std::vector<ssize_t> &shape){
+      auto U_ptr = new std::vector<T>(std::move(U));
+      pybind11::capsule owner(U_ptr, [](void* ptr){
+          delete reinterpret_cast<std::vector<T>*>(ptr);
+          });
+
+      return pybind11::array_t<T>(shape, U_ptr->data(), owner);
+    }
+
+
+  // Returns out as a writable C-contiguous array holding size values,
+  // or a newly allocated array of the given shape if out is None.
+  template <class T>
+    pybind11::array_t<T, pybind11::array::c_style> prepare_output(
+        pybind11::object out, const std::vector<ssize_t> &shape){
+      if ( out.is_none() )
+        return pybind11::array_t<T, pybind11::array::c_style>(shape);
+
+      if ( !pybind11::array_t<T, pybind11::array::c_style>::check_(out) )
+        throw std::runtime_error(
+            "out should be a C-contiguous NumPy array of matching dtype");
+
+      auto arr = pybind11::reinterpret_borrow<
+        pybind11::array_t<T, pybind11::array::c_style>>(out);
+      if ( !arr.writeable() )
+        throw std::runtime_error("out should be writeable");
+
+      ssize_t size = 1;
+      for (auto extent : shape) size *= extent;
+      if ( arr.size() != size )
+        throw std::runtime_error(
+            "out should hold " + std::to_string(size) + " values");
+
+      return arr;
+    }
+
+
+  // Returns U as a NumPy array of Tout, stored into out if given.
+  // U is handed over without copying if no conversion is needed.
+  template <class Tout, class T>
+    pybind11::array store_result(std::vector<T> &&U, pybind11::object out){
+      if ( std::is_same<T, Tout>::value && out.is_none() )
+        return vector_to_array(std::move(U));
+
+      auto result = prepare_output<Tout>(out, {(ssize_t) U.size()});
+      std::copy(U.begin(), U.end(), (Tout*) result.request().ptr);
+      return result;
+    }
+
+
+  // Exceptions must not leave an OpenMP parallel region, which would call
+  // std::terminate. Loop bodies are run through run(), which keeps the
+  // first exception thrown, and rethrow() raises it after the region.
+  class OMPExceptions {
+    public:
+      template <class F>
+        void run(F f) {
+          try {
+            f();
+          } catch (...) {
+            std::lock_guard<std::mutex> lock(m_mutex);
+            if ( !m_exception )
+              m_exception = std::current_exception();
+          }
+        }
+
+      void rethrow() {
+        if ( m_exception )
+          std::rethrow_exception(m_exception);
+      }
+
+    private:
+      std::exception_ptr m_exception;
+      std::mutex m_mutex;
+  };
+
+} // end of namespace pypvfmm
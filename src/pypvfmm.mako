@@ -1,8 +1,16 @@
 #include <mpi.h>
 #include <omp.h>
 #include <iostream>
+#include <iomanip>
+#include <limits>
+#include <sstream>
+#include <exception>
+#include <functional>
+#include <memory>
+#include <mutex>
 #include <any>
 #include <array>
+#include <list>
 #include <vector>
 #include <string>
 #include <unordered_map>
@@ -22,6 +22,9 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import os
+
+import pytest
 import numpy as np
 from numpy.polynomial.chebyshev import chebval
 from pypvfmm import cheb_utils, kernel
@@ -77,3 +80,347 @@ def test_integ_double():
     lap_ker = kernel.LaplaceKernel().potential()
     uu = cheb_utils.integ_double(deg, spoint, sbox_r, npts, lap_ker)
     assert uu.dtype == np.float64
+
+
+def test_integ_batch():
+    deg = 3
+    npts = 20
+    sbox_r = 1.5
+    targets = np.array([[0, 0, 0], [0.2, 0.5, 0.7], [1.5, 1.5, 0.1]],
+                       dtype=np.float64)
+    lap_ker = kernel.LaplaceKernel().potential()
+    uu = cheb_utils.integ_batch(deg, targets, sbox_r, npts, lap_ker)
+    assert uu.dtype == np.float64
+    assert uu.shape[0] == len(targets)
+    for target, u in zip(targets, uu):
+        assert np.allclose(
+            u, cheb_utils.integ(deg, target, sbox_r, npts, lap_ker))
+
+
+def test_integ_cache(tmpdir):
+    deg = 3
+    npts = 20
+    spoint = np.array([0.1, 0.2, 0.3], dtype=np.float64)
+    sbox_r = 1.5
+    lap_ker = kernel.LaplaceKernel().potential()
+
+    cache = cheb_utils.IntegCache(str(tmpdir))
+    uu = cache.integ(deg, spoint, sbox_r, npts, lap_ker)
+    # misses return the stored result, like hits
+    assert isinstance(uu, np.memmap)
+    assert not uu.flags.writeable
+
+    # a fresh store over the same directory sees the stored result
+    cache = cheb_utils.IntegCache(str(tmpdir))
+    key = cache.key(deg, spoint, sbox_r, npts, lap_ker)
+    hit = cache.get(key)
+    assert isinstance(hit, np.memmap)
+    assert not hit.flags.writeable
+    assert np.array_equal(hit, uu)
+
+    # shrinking the size cap evicts the least recently used result
+    cache = cheb_utils.IntegCache(str(tmpdir), max_bytes=int(1.5 * hit.nbytes))
+    cache.integ(deg, spoint + 0.1, sbox_r, npts, lap_ker)
+    assert cache.get(key) is None
+
+
+def test_integ_cache_recency(tmpdir):
+    cache = cheb_utils.IntegCache(str(tmpdir), max_bytes=2 * 8 * 100 + 256)
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, np.full(100, i, dtype=np.float64))
+        os.utime(os.path.join(str(tmpdir), key + ".npy"), (i, i))
+
+    # a hit marks the result as recently used, so the other one is evicted
+    assert cache.get("a")[0] == 0
+    cache.put("c", np.full(100, 2, dtype=np.float64))
+    assert cache.get("b") is None
+    assert cache.get("a")[0] == 0
+
+
+def test_integ_symmetric():
+    deg = 3
+    npts = 20
+    sbox_r = 1.5
+    # a target together with some of its images under the cube symmetries
+    targets = np.array([[0.1, 0.2, 0.4],
+                        [0.4, 0.1, 0.2],
+                        [1.4, 0.2, 0.4],
+                        [0.2, 1.1, 1.3],
+                        [0.5, 0.7, 0.75]], dtype=np.float64)
+    for ker in [kernel.LaplaceKernel().potential(),
+                kernel.LaplaceKernel().gradient(),
+                kernel.HelmholtzKernel(k=2.).potential()]:
+        uu = cheb_utils.integ_symmetric(deg, targets, sbox_r, npts, ker)
+        uu_direct = cheb_utils.integ_batch(deg, targets, sbox_r, npts, ker)
+        assert np.allclose(uu, uu_direct)
+
+        # the mode and component layout assumed for integ, checked with a
+        # target whose image permutes the axes cyclically and flips them all
+        target = np.array([0.1, 0.6, 0.35], dtype=np.float64)
+        assert np.allclose(
+            cheb_utils.integ_symmetric(deg, target[None, :], sbox_r, npts,
+                                       ker)[0],
+            cheb_utils.integ(deg, target, sbox_r, npts, ker).reshape(-1))
+
+
+def test_integ_multilevel():
+    deg = 3
+    npts = 20
+    spoint = np.array([0.1, 0.2, 0.3], dtype=np.float64)
+    sbox_rs = [0.25, 0.5, 1.5]
+    for ker in [kernel.LaplaceKernel().potential(),
+                kernel.HelmholtzKernel().potential()]:
+        uu = cheb_utils.integ_multilevel(deg, spoint, sbox_rs, npts, ker)
+        assert uu.shape[0] == len(sbox_rs)
+        for r, u in zip(sbox_rs, uu):
+            assert np.allclose(
+                u, cheb_utils.integ(deg, r * spoint, r, npts, ker))
+
+
+def test_integ_sumpy_derivative():
+    sumpy_kernel = pytest.importorskip("sumpy.kernel")
+    deg = 3
+    npts = 20
+    spoint = np.array([0.1, 0.2, 0.3], dtype=np.float64)
+    sbox_r = 1.5
+
+    grad = cheb_utils.integ(deg, spoint, sbox_r, npts,
+                            kernel.LaplaceKernel().gradient())
+    deriv = sumpy_kernel.AxisTargetDerivative(2, sumpy_kernel.LaplaceKernel(3))
+    uu = cheb_utils.integ(deg, spoint, sbox_r, npts, deriv)
+    assert np.allclose(uu, grad.reshape(3, -1)[2])
+
+
+def test_integ_out():
+    deg = 3
+    npts = 20
+    sbox_r = 1.5
+    targets = np.array([[0, 0, 0], [0.2, 0.5, 0.7]], dtype=np.float64)
+    lap_ker = kernel.LaplaceKernel().potential()
+
+    table = np.zeros((len(targets), (deg + 1)**3))
+    for i, target in enumerate(targets):
+        res = cheb_utils.integ(deg, target, sbox_r, npts, lap_ker, out=table[i])
+        assert np.array_equal(res, table[i])
+        assert np.allclose(
+            table[i], cheb_utils.integ(deg, target, sbox_r, npts, lap_ker))
+
+    batch_table = np.zeros_like(table)
+    cheb_utils.integ_batch(deg, targets, sbox_r, npts, lap_ker, out=batch_table)
+    assert np.allclose(batch_table, table)
+
+
+def test_integ_adaptive():
+    deg = 3
+    spoint = np.array([0.1, 0.2, 0.3], dtype=np.float64)
+    sbox_r = 1.5
+    lap_ker = kernel.LaplaceKernel().potential()
+    uu, npts = cheb_utils.integ_adaptive(deg, spoint, sbox_r, lap_ker, tol=1e-10)
+    assert npts > deg
+    assert np.allclose(
+        uu, cheb_utils.integ(deg, spoint, sbox_r, npts, lap_ker))
+
+
+def test_integ_mixed():
+    deg = 3
+    npts = 20
+    spoint = np.array([0.1, 0.2, 0.3], dtype=np.float64)
+    sbox_r = 1.5
+    lap_ker = kernel.LaplaceKernel().potential()
+    uu = cheb_utils.integ(deg, spoint, sbox_r, npts, lap_ker,
+                          out_dtype=np.float32)
+    assert uu.dtype == np.float32
+    uu_double = cheb_utils.integ(deg, spoint, sbox_r, npts, lap_ker)
+    assert np.array_equal(uu, uu_double.astype(np.float32))
+
+    targets = np.array([spoint, spoint + 0.5])
+    table = np.zeros((len(targets), (deg + 1)**3), dtype=np.float32)
+    cheb_utils.integ_batch(deg, targets, sbox_r, npts, lap_ker, out=table)
+    assert np.array_equal(table[0], uu)
+
+
+def test_integ_async():
+    asyncio = pytest.importorskip("asyncio")
+
+    deg = 3
+    npts = 20
+    sbox_r = 1.5
+    targets = np.array([[0, 0, 0], [0.2, 0.5, 0.7]], dtype=np.float64)
+    lap_ker = kernel.LaplaceKernel().potential()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        uu, uu_batch = loop.run_until_complete(asyncio.gather(
+            cheb_utils.integ_async(deg, targets[0], sbox_r, npts, lap_ker),
+            cheb_utils.integ_batch_async(deg, targets, sbox_r, npts, lap_ker)))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    assert np.allclose(
+        uu, cheb_utils.integ(deg, targets[0], sbox_r, npts, lap_ker))
+    assert np.allclose(uu_batch[0], uu)
+
+
+def test_cheb_poly_nd():
+    deg = 7
+    pts = np.linspace(-1, 1, 60, dtype=np.float64).reshape(3, 20)
+    # strided input
+    pts = pts[:, ::2]
+    out = cheb_utils.cheb_poly_nd(deg, pts)
+    assert out.shape == (deg + 1,) + pts.shape
+
+    cheb_coefs = np.zeros(deg + 1)
+    for m in range(deg + 1):
+        cheb_coefs.fill(0)
+        cheb_coefs[m] = 1
+        assert np.allclose(out[m], chebval(pts, cheb_coefs))
+
+    buf = np.empty_like(out)
+    assert cheb_utils.cheb_poly_nd(deg, pts, out=buf) is not None
+    assert np.array_equal(buf, out)
+
+    with pytest.raises(RuntimeError):
+        cheb_utils.cheb_poly_nd(deg, pts, out=np.empty(out.size))
+
+
+def test_cheb_eval():
+    deg = 4
+    n_coeffs = cheb_utils.cheb_coeff_count(deg)
+    rng = np.random.RandomState(0)
+    coeffs = rng.rand(2, n_coeffs)
+    centers = np.array([[0.25, 0.25, 0.25], [0.75, 0.25, 0.25]])
+    sizes = 0.5
+    targets = rng.rand(10, 3) * 0.5
+    targets[5:, 0] += 0.5
+    box_ids = np.array([0] * 5 + [1] * 5)
+
+    vals = cheb_utils.cheb_eval(coeffs, centers, sizes, targets, box_ids)
+    assert vals.shape == (len(targets),)
+
+    # reference: tensor-product evaluation with numpy
+    def t(k, x):
+        return chebval(x, np.eye(deg + 1)[k])
+
+    for target, ibox, val in zip(targets, box_ids, vals):
+        x, y, z = 2 * (target - centers[ibox]) / sizes
+        modes = [(i, j, k)
+                 for i in range(deg + 1)
+                 for j in range(deg + 1 - i)
+                 for k in range(deg + 1 - i - j)]
+        ref = sum(c * t(k, x) * t(j, y) * t(i, z)
+                  for c, (i, j, k) in zip(coeffs[ibox], modes))
+        assert np.isclose(val, ref)
+
+    # the boxes are leaves of an octree, so that they can be looked up
+    assert np.allclose(
+        cheb_utils.cheb_eval(coeffs, centers, sizes, targets), vals)
+
+
+def test_cheb_eval_box_lookup():
+    deg = 2
+    n_coeffs = cheb_utils.cheb_coeff_count(deg)
+    # a box of size 1/2 next to four of its eight children
+    centers = np.array([[1.25, 0.25, 0.25],
+                        [0.625, 0.125, 0.125], [0.875, 0.125, 0.125],
+                        [0.625, 0.375, 0.375], [0.875, 0.375, 0.125]])
+    sizes = np.array([0.5, 0.25, 0.25, 0.25, 0.25])
+    coeffs = np.zeros((5, n_coeffs))
+    coeffs[:, 0] = np.arange(5)
+
+    targets = centers + 0.1 * sizes[:, None]
+    assert np.allclose(
+        cheb_utils.cheb_eval(coeffs, centers, sizes, targets), np.arange(5))
+
+    # points on the outer faces belong to the boxes
+    targets = np.array([[1.5, 0.5, 0.5], [0.5, 0., 0.]])
+    assert np.allclose(
+        cheb_utils.cheb_eval(coeffs, centers, sizes, targets), [0, 1])
+
+    with pytest.raises(RuntimeError):
+        cheb_utils.cheb_eval(coeffs, centers, sizes, [[0.6, 0.4, 0.1]])
+    with pytest.raises(RuntimeError):
+        cheb_utils.cheb_eval(coeffs, centers + 0.1, sizes[::-1], targets)
+
+
+def test_cheb_approx():
+    deg = 8
+    centers = np.array([[0.25, 0.25, 0.75], [0.75, 0.5, 0.25]])
+    sizes = np.array([0.5, 0.25])
+
+    def fn(x):
+        return np.stack([np.sin(x[:, 0]) * x[:, 1], np.exp(x[:, 2])], axis=-1)
+
+    coeffs = cheb_utils.cheb_approx(fn, deg, centers, sizes)
+    assert coeffs.shape == (2, 2, cheb_utils.cheb_coeff_count(deg))
+
+    rng = np.random.RandomState(0)
+    targets = centers[[0, 1] * 5] + (rng.rand(10, 3) - 0.5) * sizes[[0, 1] * 5,
+                                                                   None]
+    vals = cheb_utils.cheb_eval(coeffs, centers, sizes, targets, [0, 1] * 5)
+    assert np.allclose(vals, fn(targets), atol=1e-8)
+
+
+def test_cheb_grad():
+    deg = 10
+    centers = np.array([[0.25, 0.25, 0.75], [0.75, 0.5, 0.25]])
+    sizes = np.array([0.5, 0.25])
+
+    def fn(x):
+        return np.sin(x[:, 0]) * x[:, 1] ** 2 + np.exp(x[:, 2])
+
+    def grad_fn(x):
+        return np.stack([np.cos(x[:, 0]) * x[:, 1] ** 2,
+                         2 * np.sin(x[:, 0]) * x[:, 1],
+                         np.exp(x[:, 2])], axis=-1)
+
+    coeffs = cheb_utils.cheb_approx(fn, deg, centers, sizes)
+    grad_coeffs = cheb_utils.cheb_grad(coeffs, sizes)
+    assert grad_coeffs.shape == (2, 3, coeffs.shape[-1])
+
+    targets = centers + 0.1 * sizes[:, None]
+    vals = cheb_utils.cheb_eval(grad_coeffs, centers, sizes, targets, [0, 1])
+    assert np.allclose(vals, grad_fn(targets), atol=1e-6)
+
+    # reusing a precomputed matrix
+    mat = cheb_utils.cheb_diff_matrix(deg, 1)
+    dy = cheb_utils.cheb_diff(coeffs, 1, sizes, mat=mat)
+    assert np.allclose(dy, grad_coeffs[:, 1])
+
+
+def test_cheb_basis_cache():
+    deg = 5
+    nodes = np.linspace(-1, 1, 16)
+    cache = cheb_utils.ChebBasisCache(max_bytes=(deg + 1) * nodes.nbytes)
+
+    basis = cache.get(deg, nodes)
+    assert not basis.flags.writeable
+    assert cache.get(deg, nodes.copy()) is basis
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    coeffs = np.random.RandomState(0).rand(3, deg + 1)
+    vals = cache.evaluate(coeffs, nodes)
+    assert vals.shape == (3, len(nodes))
+    for c, v in zip(coeffs, vals):
+        assert np.allclose(v, chebval(nodes, c))
+
+    # a second node set evicts the first one
+    cache.get(deg, nodes[::2])
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["entries"] == 1
+
+
+def test_integ_kernel_handle():
+    deg = 3
+    npts = 20
+    s = np.array([0.2, 0.3, 0.4])
+    lap_ker = kernel.LaplaceKernel().potential()
+    handle = kernel.get_kernel_handle(lap_ker)
+
+    ref = cheb_utils.integ(deg, s, 1., npts, lap_ker)
+    assert np.array_equal(cheb_utils.integ(deg, s, 1., npts, handle), ref)
+    # handles are converted to the dtype of the inputs
+    assert np.allclose(
+        cheb_utils.integ(deg, s.astype(np.float32), 1., npts, handle), ref,
+        rtol=1e-4)
@@ -0,0 +1,185 @@
+from __future__ import division, absolute_import, print_function
+
+__copyright__ = "Copyright (C) 2019 Xiaoyu Wei"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+
+import pytest
+import numpy as np
+from pypvfmm import fmm, kernel
+
+
+def rel_err(result, ref):
+    return np.linalg.norm(result - ref) / np.linalg.norm(ref)
+
+
+def test_fmm_laplace():
+    rng = np.random.RandomState(0)
+    # away from the unit cube, to be mapped there
+    sources = rng.rand(3000, 3) * 10 - 20
+    targets = rng.rand(2000, 3) * 10 - 20
+    densities = rng.rand(3000) - 0.5
+
+    lap_ker = kernel.LaplaceKernel().potential()
+    pot = fmm.evaluate(lap_ker, sources, densities, targets, order=10)
+    assert pot.shape == (2000,)
+
+    ref = kernel.evaluate(lap_ker, sources, densities, targets)
+    assert rel_err(pot, ref) < 1e-6
+
+    out = np.empty((2000, 1))
+    fmm.evaluate(lap_ker, sources, densities, targets, order=10, out=out)
+    assert np.allclose(out[:, 0], pot)
+
+
+def test_fmm_stokes():
+    rng = np.random.RandomState(0)
+    sources = rng.rand(1000, 3) * 1e-3
+    targets = rng.rand(500, 3) * 1e-3
+    densities = rng.rand(1000, 3)
+
+    stokes_ker = kernel.StokesKernel().handle("velocity")
+    vel = fmm.evaluate(stokes_ker, sources, densities, targets, order=10)
+    ref = kernel.evaluate(stokes_ker, sources, densities, targets)
+    assert vel.shape == (500, 3)
+    assert rel_err(vel, ref) < 1e-6
+
+
+def test_fmm_non_homogeneous():
+    rng = np.random.RandomState(0)
+    sources = rng.rand(500, 3) * 0.9 + 5
+    targets = rng.rand(300, 3) * 0.9 + 5
+    densities = rng.rand(500, 2)
+
+    helm_ker = kernel.HelmholtzKernel(k=3.).potential()
+    pot = fmm.evaluate(helm_ker, sources, densities, targets, order=10)
+    ref = kernel.evaluate(helm_ker, sources, densities, targets)
+    assert rel_err(pot, ref) < 1e-6
+
+    # cannot be rescaled into the unit cube
+    with pytest.raises(RuntimeError):
+        fmm.evaluate(helm_ker, 2 * sources, densities, targets, order=10)
+
+
+def test_point_fmm():
+    rng = np.random.RandomState(0)
+    sources = rng.rand(2000, 3)
+    targets = rng.rand(1000, 3)
+    lap_ker = kernel.LaplaceKernel().potential()
+
+    point_fmm = fmm.PointFMM(sources, targets, lap_ker, order=10)
+    assert point_fmm.shape == (1000, 2000)
+
+    # the setup is reused for new densities
+    for _ in range(3):
+        densities = rng.rand(2000)
+        pot = point_fmm.evaluate(densities)
+        ref = kernel.evaluate(lap_ker, sources, densities, targets)
+        assert rel_err(pot, ref) < 1e-6
+
+
+def test_point_fmm_linear_operator():
+    pytest.importorskip("scipy")
+    rng = np.random.RandomState(0)
+    sources = rng.rand(500, 3)
+    targets = rng.rand(300, 3)
+    densities = rng.rand(500, 3)
+
+    stokes_ker = kernel.StokesKernel().handle("velocity")
+    op = fmm.PointFMM(sources, targets, stokes_ker).aslinearoperator()
+    assert op.shape == (900, 1500)
+
+    ref = kernel.evaluate(stokes_ker, sources, densities, targets)
+    assert rel_err(op.matvec(densities.ravel()), ref.ravel()) < 1e-6
+
+
+def test_cheb_fmm_laplace():
+    # the Laplace volume potential of -lap(u) is u, for a Gaussian u that
+    # vanishes outside the box
+    a = 200.
+    center = np.array([1., 2., 3.])
+
+    def gaussian(x):
+        return np.exp(-a * ((x - center) ** 2).sum(axis=-1))
+
+    def density(x):
+        r2 = ((x - center) ** 2).sum(axis=-1)
+        return (6 * a - 4 * a ** 2 * r2) * gaussian(x)
+
+    rng = np.random.RandomState(0)
+    targets = center + (rng.rand(100, 3) - 0.5) * 0.5
+
+    lap_ker = kernel.LaplaceKernel().potential()
+    result = fmm.cheb_fmm(density, lap_ker, cheb_deg=8, tol=1e-6,
+                          center=center, size=1.5, targets=targets)
+    assert result.coeffs.shape == (len(result.sizes), 1, 165)
+    assert np.abs(result.target_values[:, 0] - gaussian(targets)).max() < 1e-4
+
+
+def test_point_fmm_update_positions():
+    rng = np.random.RandomState(0)
+    points = rng.rand(2000, 3)
+    densities = rng.rand(2000)
+    lap_ker = kernel.LaplaceKernel().potential()
+
+    point_fmm = fmm.PointFMM(points, points, lap_ker, order=10)
+
+    # small steps keep most points in their leaves, but not all of them
+    for step in [0, 1e-12, 1e-1]:
+        points = points + step * (rng.rand(2000, 3) - 0.5)
+        in_place = point_fmm.update_positions(points, points)
+        assert in_place == (step < 1e-1)
+
+        pot = point_fmm.evaluate(densities)
+        ref = kernel.evaluate(lap_ker, points, densities, points)
+        assert rel_err(pot, ref) < 1e-6
+
+    # rebuilt trees keep the map into the unit cube while the points stay
+    # inside it (when shrinking), and get a new one otherwise
+    for points in [0.5 * points, 3 * points]:
+        assert not point_fmm.update_positions(points, points)
+
+        pot = point_fmm.evaluate(densities)
+        ref = kernel.evaluate(lap_ker, points, densities, points)
+        assert rel_err(pot, ref) < 1e-6
+
+
+def test_point_fmm_multiple_rhs():
+    rng = np.random.RandomState(0)
+    sources = rng.rand(500, 3)
+    targets = rng.rand(300, 3)
+    densities = rng.rand(4, 500, 3)
+
+    stokes_ker = kernel.StokesKernel().handle("velocity")
+    point_fmm = fmm.PointFMM(sources, targets, stokes_ker)
+    pot = point_fmm.evaluate(densities)
+    assert pot.shape == (4, 300, 3)
+
+    for i in range(4):
+        ref = kernel.evaluate(stokes_ker, sources, densities[i], targets)
+        assert rel_err(pot[i], ref) < 1e-6
+
+    pytest.importorskip("scipy")
+    op = point_fmm.aslinearoperator()
+    x = densities.reshape(4, -1).T
+    ref = np.array([op.matvec(x[:, i]) for i in range(4)]).T
+    assert rel_err(op.matmat(x), ref) < 1e-6
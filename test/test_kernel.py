@@ -0,0 +1,238 @@
+from __future__ import division, absolute_import, print_function
+
+__copyright__ = "Copyright (C) 2019 Xiaoyu Wei"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import pytest
+import numpy as np
+from pypvfmm import kernel
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_evaluate_laplace(dtype):
+    rng = np.random.RandomState(0)
+    sources = rng.rand(300, 3).astype(dtype)
+    targets = rng.rand(500, 3).astype(dtype) + 2
+    densities = rng.rand(300).astype(dtype)
+
+    lap_ker = kernel.LaplaceKernel().potential()
+    pot = kernel.evaluate(lap_ker, sources, densities, targets)
+    assert pot.shape == (500,)
+    assert pot.dtype == dtype
+
+    dist = np.linalg.norm(targets[:, None, :] - sources[None, :, :], axis=-1)
+    ref = (densities / (4 * np.pi * dist)).sum(axis=-1)
+    rtol = 1e-10 if dtype == np.float64 else 1e-4
+    assert np.allclose(pot, ref, rtol=rtol)
+
+    out = np.empty((500, 1), dtype=dtype)
+    kernel.evaluate(lap_ker, sources, densities, targets, out=out)
+    assert np.allclose(out[:, 0], pot)
+
+
+def test_evaluate_stokes():
+    rng = np.random.RandomState(0)
+    sources = rng.rand(40, 3)
+    targets = rng.rand(30, 3) + 2
+    densities = rng.rand(40, 3)
+
+    stokes_ker = kernel.StokesKernel().velocity()
+    vel = kernel.evaluate(stokes_ker, sources, densities, targets)
+    assert vel.shape == (30, 3)
+
+    # Stokeslet: (f / r + (r . f) r / r^3) / (8 pi mu), with mu = 1
+    r = targets[:, None, :] - sources[None, :, :]
+    dist = np.linalg.norm(r, axis=-1)
+    rdotf = np.einsum("tsi,si->ts", r, densities)
+    stokeslet = densities[None, :, :] / dist[..., None]
+    stokeslet += rdotf[..., None] * r / dist[..., None] ** 3
+    ref = stokeslet.sum(axis=1) / (8 * np.pi)
+    assert np.allclose(vel, ref)
+
+
+def test_kernel_handle():
+    lap_ker = kernel.LaplaceKernel()
+    handle = lap_ker.handle("potential")
+    assert handle.desc == lap_ker.potential()
+    assert handle.homogeneity == -1
+    # handles are created once per kernel and dtype
+    assert kernel.get_kernel_handle(lap_ker.potential()) is handle
+    assert kernel.get_kernel_handle(handle, np.float32) is not handle
+
+    rng = np.random.RandomState(0)
+    sources = rng.rand(20, 3)
+    targets = rng.rand(10, 3) + 2
+    densities = rng.rand(20)
+    assert np.array_equal(
+        kernel.evaluate(handle, sources, densities, targets),
+        kernel.evaluate(handle.desc, sources, densities, targets))
+
+
+def test_helmholtz_wavenumber():
+    rng = np.random.RandomState(0)
+    sources = rng.rand(50, 3)
+    targets = rng.rand(20, 3) + 2
+    # complex densities as (real, imaginary) pairs
+    densities = rng.rand(50, 2)
+    dist = np.linalg.norm(targets[:, None, :] - sources[None, :, :], axis=-1)
+
+    for k in [1., 2.5, 1.]:
+        helm_ker = kernel.HelmholtzKernel(k=k)
+        assert helm_ker.potential() == "HelmholtzKernel, potential, k=%.17g" % k
+        pot = kernel.evaluate(helm_ker.handle("potential"), sources, densities,
+                              targets)
+
+        ref = (np.exp(1j * k * dist) / (4 * np.pi * dist)).dot(
+            densities[:, 0] + 1j * densities[:, 1])
+        assert np.allclose(pot[:, 0] + 1j * pot[:, 1], ref)
+
+    assert kernel.homogeneity(kernel.HelmholtzKernel(k=1.).potential()) is None
+    assert kernel.kernel_family(helm_ker.potential()) == \
+        "HelmholtzKernel, potential"
+
+    # the dtype stays the first positional argument
+    helm_ker = kernel.HelmholtzKernel(np.float32)
+    assert helm_ker.dtype == np.float32
+    assert helm_ker.potential() == "HelmholtzKernel, potential"
+
+
+def test_helmholtz_kernel_cache():
+    handles = [kernel.HelmholtzKernel(k=k).handle("potential") for k in [1., 2.]]
+    assert kernel.HelmholtzKernel(k=1.).handle("potential") is handles[0]
+
+    # kernels no longer in use are evicted to make room for new ones
+    for k in np.linspace(3, 4, 40):
+        kernel.HelmholtzKernel(k=k).handle("potential")
+    assert kernel.HelmholtzKernel(k=2.).handle("potential") is handles[1]
+
+
+def test_register_kernel():
+    import ctypes
+    ptr = ctypes.POINTER(ctypes.c_double)
+    kernel_type = ctypes.CFUNCTYPE(None, ptr, ctypes.c_int, ptr, ctypes.c_int,
+                                   ptr, ctypes.c_int, ptr)
+
+    # a (slow) Python callback standing in for a compiled Yukawa kernel
+    def yukawa(r_src, src_cnt, v_src, dof, r_trg, trg_cnt, v_trg):
+        src = np.ctypeslib.as_array(r_src, (src_cnt, 3))
+        trg = np.ctypeslib.as_array(r_trg, (trg_cnt, 3))
+        dens = np.ctypeslib.as_array(v_src, (src_cnt,))
+        dist = np.linalg.norm(trg[:, None, :] - src[None, :, :], axis=-1)
+        np.ctypeslib.as_array(v_trg, (trg_cnt,))[:] += (
+            np.exp(-dist) / dist).dot(dens)
+
+    yukawa_fn = kernel_type(yukawa)
+    handle = kernel.register_kernel("YukawaTestKernel, potential", yukawa_fn,
+                                    1, 1)
+    assert handle.desc == "YukawaTestKernel, potential"
+    assert kernel.homogeneity(handle.desc) is None
+
+    rng = np.random.RandomState(0)
+    sources = rng.rand(30, 3)
+    targets = rng.rand(600, 3) + 2
+    densities = rng.rand(30)
+    pot = kernel.evaluate(handle.desc, sources, densities, targets)
+
+    dist = np.linalg.norm(targets[:, None, :] - sources[None, :, :], axis=-1)
+    assert np.allclose(pot, (np.exp(-dist) / dist).dot(densities))
+
+    with pytest.raises(RuntimeError):
+        kernel.register_kernel(handle.desc, yukawa_fn, 1, 1)
+
+    # named capsules, as exported by compiled extensions
+    capsule_new = ctypes.pythonapi.PyCapsule_New
+    capsule_new.restype = ctypes.py_object
+    capsule_new.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p]
+    capsule_name = ctypes.create_string_buffer(b"yukawa")
+    capsule = capsule_new(ctypes.cast(yukawa_fn, ctypes.c_void_p).value,
+                          capsule_name, None)
+    capsule_handle = kernel.register_kernel(
+        "YukawaTestKernel, named capsule", capsule, 1, 1)
+    assert np.allclose(
+        kernel.evaluate(capsule_handle, sources, densities, targets), pot)
+
+
+def test_translate_sumpy_kernel():
+    sumpy_kernel = pytest.importorskip("sumpy.kernel")
+
+    lap = sumpy_kernel.LaplaceKernel(3)
+    translation = kernel.translate_sumpy_kernel(lap)
+    assert translation.desc == "LaplaceKernel, potential"
+    assert kernel.translate_sumpy_kernel(lap) is translation
+    assert kernel.process_sumpy_kernel(lap) == translation.desc
+
+    grad = kernel.translate_sumpy_kernel(
+            sumpy_kernel.AxisTargetDerivative(1, lap))
+    assert grad.desc == "LaplaceKernel, gradient"
+    assert grad.trg_component == 1
+
+    helm = kernel.translate_sumpy_kernel(sumpy_kernel.HelmholtzKernel(3), k=2.)
+    assert helm.desc == "HelmholtzKernel, potential, k=2"
+    assert helm.handle().desc == helm.desc
+
+    with pytest.raises(ValueError):
+        kernel.translate_sumpy_kernel(sumpy_kernel.BiharmonicKernel(3))
+
+
+def test_sumpy_stokeslet():
+    sumpy_kernel = pytest.importorskip("sumpy.kernel")
+    stokeslet = sumpy_kernel.StokesletKernel(3, 0, 1)
+
+    rng = np.random.RandomState(0)
+    sources = rng.rand(30, 3)
+    targets = rng.rand(40, 3) + 2
+    densities = rng.rand(30)
+
+    # the value of the viscosity is needed, which the translation holds
+    with pytest.raises(ValueError):
+        kernel.evaluate(stokeslet, sources, densities, targets)
+
+    mu = 2.
+    translation = kernel.translate_sumpy_kernel(stokeslet, mu=mu)
+    pot = kernel.evaluate(translation, sources, densities, targets)
+
+    d = targets[:, None, :] - sources[None, :, :]
+    r = np.linalg.norm(d, axis=-1)
+    ref = (-d[..., 0] * d[..., 1] / (8 * np.pi * mu * r ** 3)).dot(densities)
+    assert np.allclose(pot, ref)
+
+
+def test_sumpy_derivatives():
+    sumpy_kernel = pytest.importorskip("sumpy.kernel")
+    lap = sumpy_kernel.LaplaceKernel(3)
+
+    rng = np.random.RandomState(0)
+    sources = rng.rand(30, 3)
+    targets = rng.rand(40, 3) + 2
+    densities = rng.rand(30)
+    grad = kernel.evaluate(kernel.LaplaceKernel().gradient(), sources,
+                           densities, targets)
+
+    pot = kernel.evaluate(sumpy_kernel.AxisTargetDerivative(1, lap), sources,
+                          densities, targets)
+    assert pot.shape == (40,)
+    assert np.allclose(pot, grad[:, 1])
+
+    # the kernel only depends on the target minus the source
+    pot = kernel.evaluate(sumpy_kernel.AxisSourceDerivative(0, lap), sources,
+                          densities, targets)
+    assert np.allclose(pot, -grad[:, 0])
@@ -0,0 +1,74 @@
+from __future__ import division, absolute_import, print_function
+
+__copyright__ = "Copyright (C) 2019 Xiaoyu Wei"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import pytest
+import numpy as np
+from pypvfmm import cheb_utils, kernel, tables
+
+
+def test_build_table(tmpdir):
+    deg = 3
+    npts = 20
+    sbox_rs = [0.5, 1.5]
+    targets = np.random.RandomState(0).rand(10, 3)
+    lap_ker = kernel.LaplaceKernel().potential()
+
+    builder = tables.TableBuilder(str(tmpdir), deg, targets, sbox_rs, npts,
+                                  lap_ker, chunk_size=4)
+    assert len(builder.pending_chunks()) == 6
+
+    # simulate an interrupted build
+    np.save(builder.chunk_path(0, 1),
+            cheb_utils.integ_batch(deg, targets[4:8], sbox_rs[0], npts, lap_ker))
+    assert len(builder.pending_chunks()) == 5
+
+    table = builder.build(max_workers=2)
+    assert table.shape[:2] == (len(sbox_rs), len(targets))
+    for r, table_r in zip(sbox_rs, table):
+        assert np.allclose(
+            table_r, cheb_utils.integ_batch(deg, targets, r, npts, lap_ker))
+
+
+def test_build_table_registered_kernel(tmpdir):
+    import ctypes
+    ptr = ctypes.POINTER(ctypes.c_double)
+    kernel_type = ctypes.CFUNCTYPE(None, ptr, ctypes.c_int, ptr, ctypes.c_int,
+                                   ptr, ctypes.c_int, ptr)
+    null_kernel = kernel_type(lambda *args: None)
+    handle = kernel.register_kernel("TableTestKernel, potential", null_kernel,
+                                    1, 1)
+    assert kernel.is_registered_kernel(handle)
+
+    # registered kernels are unknown to spawned worker processes
+    targets = np.random.RandomState(0).rand(10, 3)
+    with pytest.raises(ValueError):
+        tables.TableBuilder(str(tmpdir), 3, targets, [1.], 20, handle)
+
+
+def test_build_table_empty(tmpdir):
+    lap_ker = kernel.LaplaceKernel().potential()
+    with pytest.raises(ValueError):
+        tables.TableBuilder(str(tmpdir), 3, np.empty((0, 3)), [1.], 20, lap_ker)
+    with pytest.raises(ValueError):
+        tables.TableBuilder(str(tmpdir), 3, np.zeros((1, 3)), [], 20, lap_ker)